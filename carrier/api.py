@@ -1,10 +1,21 @@
-from rest_framework import mixins, routers
+import codecs
+import csv
+import json
+
+from django.conf import settings
+from django.db import transaction
+from rest_framework import mixins, routers, status
+from rest_framework.decorators import detail_route
+from rest_framework.exceptions import ParseError, UnsupportedMediaType, ValidationError
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 
-from carrier.serializers import MessageSerializer
+from carrier.serializers import MessageSerializer, RecipientSerializer
+from carrier.utils import chunked
 
-from .models import Message
+from .enums import MessageStatus
+from .models import Message, Recipient
 
 all_views = []
 
@@ -36,17 +47,115 @@ class APIRouter(routers.DefaultRouter):
             self._register_view(view)
 
 
+def read_ndjson_records(stream):
+    for line_number, line in enumerate(codecs.iterdecode(stream, 'utf-8'), start=1):
+        if not line.strip():
+            continue
+
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise ParseError('Line {}: JSON parse error - {}'.format(line_number, e))
+
+        if not isinstance(record, dict):
+            raise ParseError('Line {}: Expected a JSON object.'.format(line_number))
+
+        yield line_number, record
+
+
+def read_csv_records(stream):
+    # The first line of the CSV is the header line
+    reader = csv.DictReader(codecs.iterdecode(stream, 'utf-8'))
+
+    for row in reader:
+        yield reader.line_num, {field: value for field, value in row.items() if field and value}
+
+
+RECIPIENT_RECORD_READERS = {
+    'application/x-ndjson': read_ndjson_records,
+    'text/csv': read_csv_records,
+}
+
+
 class MessageViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin, mixins.ListModelMixin, GenericViewSet):
     permission_classes = (IsAuthenticated,)
     queryset = Message.objects.all()
     serializer_class = MessageSerializer
 
     def perform_create(self, serializer):
-        from .tasks import send_message
+        from .tasks import queue_message
+
+        if 'recipients' not in serializer.validated_data:
+            # The recipients will be uploaded separately and the message is sent when it is finalized
+            serializer.save(status=MessageStatus.DRAFT)
+            return
 
         serializer.save()
 
-        send_message.delay(serializer.instance.id)
+        queue_message(serializer.instance)
+
+        # Queuing claims the message, so the response shows the stored status
+        serializer.instance.refresh_from_db()
+
+    @detail_route(methods=['post'])
+    def recipients(self, request, *args, **kwargs):
+        """Add recipients to a draft message from NDJSON or CSV data read and stored in chunks."""
+        message = self.get_object()
+
+        content_type = request.content_type.split(';')[0].strip()
+        if content_type not in RECIPIENT_RECORD_READERS:
+            raise UnsupportedMediaType(content_type)
+
+        if request.stream is None:
+            raise ParseError('No recipients.')
+
+        records = RECIPIENT_RECORD_READERS[content_type](request.stream)
+        batch_size = getattr(settings, 'CARRIER_BULK_CREATE_BATCH_SIZE', 1000)
+        created = 0
+
+        with transaction.atomic():
+            # Lock the message so it can't be finalized in the middle of the upload
+            message = Message.objects.select_for_update().get(pk=message.pk)
+
+            if message.status != MessageStatus.DRAFT:
+                raise ValidationError('Recipients can only be added to messages with status "{}".'.format(
+                    MessageStatus.DRAFT))
+
+            for chunk in chunked(records, batch_size):
+                serializer = RecipientSerializer(data=[record for _, record in chunk], many=True)
+
+                if not serializer.is_valid():
+                    raise ValidationError({
+                        'line {}'.format(line_number): errors
+                        for (line_number, _), errors in zip(chunk, serializer.errors) if errors
+                    })
+
+                Recipient.bulk_create_with_contacts(
+                    [Recipient(message=message, **item) for item in serializer.validated_data],
+                    batch_size=batch_size)
+                created += len(chunk)
+
+        return Response({'created': created}, status=status.HTTP_201_CREATED)
+
+    @detail_route(methods=['post'])
+    def finalize(self, request, *args, **kwargs):
+        """Queue a draft message for sending."""
+        from .tasks import queue_message
+
+        message = self.get_object()
+
+        if not message.recipients.exists():
+            raise ValidationError('No recipients.')
+
+        if not Message.objects.filter(pk=message.pk, status=MessageStatus.DRAFT).update(
+                status=MessageStatus.PENDING_INFO):
+            raise ValidationError('Only messages with status "{}" can be finalized.'.format(MessageStatus.DRAFT))
+
+        queue_message(message)
+
+        message.refresh_from_db()
+
+        return Response(self.get_serializer(message).data)
 
 
 register_view(MessageViewSet, 'message')
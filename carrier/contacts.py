@@ -0,0 +1,97 @@
+from collections import namedtuple
+from concurrent.futures import as_completed
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+from requests import RequestException
+
+from carrier.http import get_session
+from carrier.metrics import MetricsThreadPoolExecutor
+from carrier.utils import chunked
+
+ContactInfoPage = namedtuple('ContactInfoPage', ['contact_infos', 'fetched_at', 'error'])
+
+
+class ContactInfoClient:
+    """
+    Fetches contact information from CONTACT_INFO_URL in pages of uuids requested concurrently.
+
+    If CONTACT_INFO_CACHE names a cache from the CACHES setting, the responses are cached there for
+    CONTACT_INFO_TTL seconds and cached uuids are not requested again. The requests are made with the
+    "contact_info" client of the CARRIER_HTTP_CLIENTS setting unless another session is given.
+    """
+    cache_key_prefix = 'carrier:contact_info:'
+
+    def __init__(self, session=None):
+        self.url = settings.CONTACT_INFO_URL
+        self.auth = (settings.TUNNISTAMO_USERNAME, settings.TUNNISTAMO_PASSWORD)
+        self.page_size = getattr(settings, 'CONTACT_INFO_PAGE_SIZE', 100)
+        self.max_workers = getattr(settings, 'CONTACT_INFO_MAX_CONCURRENT_REQUESTS', 4)
+        self.timeout = getattr(settings, 'CONTACT_INFO_TIMEOUT', 30)
+        self.ttl = getattr(settings, 'CONTACT_INFO_TTL', None)
+
+        cache_alias = getattr(settings, 'CONTACT_INFO_CACHE', None)
+        self.cache = caches[cache_alias] if cache_alias else None
+
+        self.session = session or get_session('contact_info')
+
+    def get_cached(self, uuids):
+        keys = {self.cache_key_prefix + uuid: uuid for uuid in uuids}
+        cached = self.cache.get_many(list(keys))
+
+        return {keys[key]: value for key, value in cached.items()}
+
+    def set_cached(self, contact_infos, fetched_at):
+        self.cache.set_many({
+            self.cache_key_prefix + str(contact_id): (fetched_at, contact_info)
+            for contact_id, contact_info in contact_infos.items()
+        }, timeout=self.ttl)
+
+    def fetch_page(self, uuids):
+        url = '{}?ids={}'.format(self.url, ','.join(uuids))
+
+        r = self.session.get(url, auth=self.auth, timeout=self.timeout)
+        r.raise_for_status()
+
+        return r.json()
+
+    def fetch(self, uuids):
+        """
+        Yield a ContactInfoPage for every page of uuids as soon as the page has been fetched.
+
+        A failed page yields an error message instead of contact infos, the remaining pages are still fetched.
+        """
+        if self.cache:
+            cached = self.get_cached(uuids)
+
+            if cached:
+                # Report the oldest fetch time so the cached contacts don't outlive the TTL
+                yield ContactInfoPage(
+                    contact_infos={uuid: contact_info for uuid, (_, contact_info) in cached.items()},
+                    fetched_at=min(fetched_at for fetched_at, _ in cached.values()),
+                    error=None,
+                )
+                uuids = [uuid for uuid in uuids if uuid not in cached]
+
+        with MetricsThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.fetch_page, page): page for page in chunked(uuids, self.page_size)}
+
+            for future in as_completed(futures):
+                fetched_at = timezone.now()
+
+                try:
+                    contact_infos = future.result()
+                except (RequestException, ValueError) as e:
+                    yield ContactInfoPage(
+                        contact_infos=None,
+                        fetched_at=fetched_at,
+                        error='Error when trying to fetch contact info for {} recipient(s): "{}"'.format(
+                            len(futures[future]), e),
+                    )
+                    continue
+
+                if self.cache:
+                    self.set_cached(contact_infos, fetched_at)
+
+                yield ContactInfoPage(contact_infos=contact_infos, fetched_at=fetched_at, error=None)
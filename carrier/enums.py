@@ -20,6 +20,7 @@ class RecipientStatus(Enum):
 
 
 class MessageStatus(Enum):
+    DRAFT = 'draft'
     PENDING_INFO = 'pending_info'
     FETCHING_INFO = 'fetching_info'
     READY_TO_SEND = 'ready_to_send'
@@ -29,6 +30,7 @@ class MessageStatus(Enum):
     ARCHIVED = 'archived'
 
     class Labels:
+        DRAFT = _('Draft')
         PENDING_INFO = _('Pending information')
         FETCHING_INFO = _('Fetching information')
         SENDING = _('Sending')
@@ -37,6 +39,17 @@ class MessageStatus(Enum):
         ARCHIVED = _('Archived')
 
 
+class MessagePriority(Enum):
+    LOW = 'low'
+    NORMAL = 'normal'
+    HIGH = 'high'
+
+    class Labels:
+        LOW = _('Low')
+        NORMAL = _('Normal')
+        HIGH = _('High')
+
+
 class TransportType(Enum):
     EMAIL = 'email'
     PUSHBULLET = 'pushbullet'
@@ -0,0 +1,113 @@
+import os
+import threading
+from functools import partial
+
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from carrier.metrics import observe_request_latency
+
+HTTP_CLIENT_DEFAULTS = {
+    # Number of hosts to keep connection pools for and number of keep-alive connections per host
+    'pool_connections': 10,
+    'pool_maxsize': 10,
+    # Seconds to wait for connecting and for the response when a request doesn't give its own timeout
+    'timeout': 30,
+    # Retries of failed connections and of idempotent requests answered with one of the retry_statuses
+    'retries': 0,
+    'retry_backoff_factor': 0,
+    'retry_statuses': (),
+}
+
+_sessions = {}
+_sessions_pid = None
+_lock = threading.Lock()
+
+
+class HTTPClientAdapter(HTTPAdapter):
+    """HTTPAdapter using a default timeout for requests made without one."""
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        return super().send(request, **kwargs)
+
+
+def get_client_config(name):
+    """Return the configuration of the named client from CARRIER_HTTP_CLIENTS, completed with the defaults."""
+    clients = getattr(settings, 'CARRIER_HTTP_CLIENTS', {})
+
+    config = dict(HTTP_CLIENT_DEFAULTS)
+    config.update(clients.get('default', {}))
+    config.update(clients.get(name, {}))
+
+    return config
+
+
+def create_session(config):
+    retry = Retry(
+        total=config['retries'],
+        backoff_factor=config['retry_backoff_factor'],
+        status_forcelist=config['retry_statuses'],
+        raise_on_status=False,
+    )
+    adapter = HTTPClientAdapter(
+        timeout=config['timeout'],
+        pool_connections=config['pool_connections'],
+        pool_maxsize=config['pool_maxsize'],
+        max_retries=retry,
+    )
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def record_latency(client_name, response, *args, **kwargs):
+    observe_request_latency(client_name, response.elapsed.total_seconds())
+
+
+def get_session(name='default'):
+    """
+    Return the keep-alive session of the named client configured in the CARRIER_HTTP_CLIENTS setting.
+
+    The sessions are shared by all the threads of a process and created again in forked worker processes.
+    """
+    global _sessions_pid
+
+    with _lock:
+        if _sessions_pid != os.getpid():
+            # Connections opened by the parent process must not be used by its forked children
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+
+        if name not in _sessions:
+            session = create_session(get_client_config(name))
+            session.hooks['response'].append(partial(record_latency, name))
+            _sessions[name] = session
+
+        return _sessions[name]
+
+
+def close_sessions():
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+
+        _sessions.clear()
+
+
+@receiver(setting_changed)
+def reset_sessions(setting, **kwargs):
+    if setting == 'CARRIER_HTTP_CLIENTS':
+        close_sessions()
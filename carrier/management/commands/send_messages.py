@@ -1,9 +1,12 @@
 import argparse
 import re
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 from django.core.management.base import BaseCommand
+from django.db import connection
 
-from carrier.models import Message, MessageStatus
+from carrier.metrics import collect_metrics
+from carrier.models import Message, MessageStatus, SendReport
 from carrier.transports import get_transports
 
 
@@ -22,50 +25,139 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('message_id', nargs='*', type=is_uuidv4)
+        parser.add_argument('--workers', type=int, default=1, help='Number of messages sent concurrently.')
+        parser.add_argument('--limit', type=int, default=None, help='Maximum number of messages sent by this run.')
+        parser.add_argument('--batch-size', type=int, default=10,
+                            help='Maximum number of messages claimed at a time. With several workers, messages are '
+                                 'claimed as the workers become free. Other runs skip claimed messages.')
 
     def handle(self, *args, **options):
-        if options['message_id']:
-            message_ids = options['message_id']
+        transports = get_transports()
+
+        if not transports:
+            self.stdout.write(self.style.ERROR('No transports found! Please set CARRIER_TRANSPORT_CLASSES setting.'))
+            return
+
+        message_ids = options['message_id'] or None
+        workers = max(options['workers'], 1)
+        batch_size = max(options['batch_size'], 1)
+        # Messages left pending by this run are not claimed again before the next run
+        self.released_ids = set()
+
+        if workers == 1:
+            claimed_ids = self.send_sequentially(transports, options['limit'], batch_size, message_ids)
         else:
-            message_ids = list(Message.objects.filter(
-                status__in=[MessageStatus.PENDING_INFO, MessageStatus.READY_TO_SEND]).order_by(
-                'created_at').values_list('id', flat=True))
+            claimed_ids = self.send_concurrently(transports, workers, options['limit'], batch_size, message_ids)
 
-        if not message_ids:
+        for message_id in set(message_ids or []) - set(claimed_ids):
+            self.stdout.write(self.style.WARNING(
+                ' Message "{}" does not exist, is scheduled later or its status is not "{}" or "{}". '
+                'Skipping.'.format(message_id, MessageStatus.PENDING_INFO, MessageStatus.READY_TO_SEND)))
+
+        if not claimed_ids:
             self.stdout.write('No messages to send.')
+
+    def send_sequentially(self, transports, limit, batch_size, message_ids):
+        claimed_ids = []
+
+        for batch in self.claim_batches(limit, message_ids, lambda: batch_size):
+            claimed_ids.extend(str(message_id) for message_id in batch)
+
+            for message_id in batch:
+                self.send_message(message_id, transports)
+
+        return claimed_ids
+
+    def send_concurrently(self, transports, workers, limit, batch_size, message_ids):
+        claimed_ids = []
+        running = set()
+
+        def get_claim_size():
+            # Only as many messages are claimed as there are idle workers, other runs can send the rest meanwhile
+            return min(batch_size, workers - len(running))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for batch in self.claim_batches(limit, message_ids, get_claim_size):
+                claimed_ids.extend(str(message_id) for message_id in batch)
+                running.update(executor.submit(self.send_message_in_thread, message_id, transports)
+                               for message_id in batch)
+
+                if len(running) >= workers:
+                    # More messages are claimed as soon as a worker is free
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    running.difference_update(done)
+
+                    for future in done:
+                        future.result()
+
+            for future in running:
+                future.result()
+
+        return claimed_ids
+
+    def claim_batches(self, limit, message_ids, get_claim_size):
+        """Claim and yield lists of message ids until there are no messages left or limit is reached."""
+        claimed_count = 0
+
+        while limit is None or claimed_count < limit:
+            claim_size = get_claim_size() if limit is None else min(get_claim_size(), limit - claimed_count)
+            messages = Message.get_due_messages()
+            if message_ids is not None:
+                messages = messages.filter(id__in=message_ids)
+            if self.released_ids:
+                messages = messages.exclude(id__in=self.released_ids)
+
+            batch = Message.claim_for_sending(claim_size, messages)
+
+            if not batch:
+                return
+
+            claimed_count += len(batch)
+            yield batch
+
+    def send_message_in_thread(self, message_id, transports):
+        try:
+            self.send_message(message_id, transports)
+        finally:
+            # Every thread has a database connection of its own
+            connection.close()
+
+    def send_message(self, message_id, transports):
+        self.stdout.write('Message "{}":'.format(message_id))
+        message = Message.objects.get(pk=message_id)
+
+        with collect_metrics() as metrics:
+            errors = message.fetch_contact_info_for_recipients()
+
+            if not errors:
+                message.attach_contacts_to_recipients()
+                message.validate_recipients(transports)
+                result = message.send(transports)
+
+        SendReport.add(message.id, metrics.get_data())
+
+        if errors:
+            # Recipients without their contact info would be ignored, so the message is left for a later run
+            self.stdout.write(self.style.WARNING(' Contact info errors: ' + ', '.join(errors)))
+            self.stdout.write(self.style.WARNING(' Message "{}" left pending.'.format(message_id)))
+            Message.objects.filter(pk=message.pk, status=MessageStatus.FETCHING_INFO).update(
+                status=MessageStatus.PENDING_INFO, claimed_at=None, claim_token=None)
+            self.released_ids.add(message.pk)
             return
 
-        transports = get_transports()
+        if result.skipped:
+            self.stdout.write(self.style.WARNING(' Message "{}" is already being sent. Skipping.'.format(message_id)))
+            return
 
-        if not transports:
-            self.stdout.write(self.style.ERROR('No transports found! Please set CARRIER_TRANSPORT_CLASSES setting.'))
+        if result.errors:
+            self.stdout.write(self.style.WARNING(' Errors: ' + ', '.join(result.errors)))
+
+        if result.sent:
+            # finish_sending has stored the final status
+            self.stdout.write(self.style.WARNING(' Message "{}" Sent.'.format(message_id)))
             return
 
-        for message_id in message_ids:
-            self.stdout.write('Message "{}":'.format(message_id))
-            try:
-                message = Message.objects.get(pk=message_id)
-            except Message.DoesNotExist:
-                self.stdout.write(self.style.WARNING(' Message "{}" does not exist. Skipping.'.format(message_id)))
-                continue
-
-            if message.status not in [MessageStatus.PENDING_INFO, MessageStatus.READY_TO_SEND]:
-                self.stdout.write(self.style.WARNING(
-                    ' Message "{}" status is not "{}" or "{}". Skipping.'.format(
-                        message_id, MessageStatus.PENDING_INFO, MessageStatus.READY_TO_SEND)))
-                continue
-
-            message.fetch_contact_info_for_recipients()
-            message.attach_contacts_to_recipients()
-            message.validate_recipients(transports)
-            result = message.send(transports)
-
-            if result.sent:
-                self.stdout.write(self.style.WARNING(' Message "{}" Sent.'.format(message_id)))
-                message.status = MessageStatus.SENT
-
-            if result.errors:
-                self.stdout.write(self.style.WARNING(' Errors: ' + ', '.join(result.errors)))
-                message.status = MessageStatus.ERROR
-
-            message.save()
+        # Only a message this run still holds is failed, another worker may have started sending it meanwhile
+        Message.objects.filter(
+            pk=message.pk, status__in=[MessageStatus.FETCHING_INFO, MessageStatus.READY_TO_SEND]
+        ).update(status=MessageStatus.ERROR)
@@ -0,0 +1,200 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Upper bounds in seconds of the provider request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_local = threading.local()
+
+
+def merge_data(data, other, sign=1):
+    """Add the numbers of the nested dict other to data, or subtract them with sign=-1."""
+    for key, value in other.items():
+        if isinstance(value, dict):
+            merge_data(data.setdefault(key, {}), value, sign)
+        else:
+            data[key] = data.get(key, 0) + sign * value
+
+    return data
+
+
+def observe_request_latency(client_name, seconds):
+    """Record the latency of a provider request made by the HTTP client in the metrics collected by this thread."""
+    metrics = getattr(_local, 'metrics', None)
+
+    if metrics is not None:
+        metrics.observe_request_latency(client_name, seconds)
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+
+class CountingCursorWrapper:
+    """Cursor wrapper counting the queries executed with the wrapped cursor."""
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self.cursor.__exit__(exc_type, exc_value, traceback)
+
+    def execute(self, sql, params=None):
+        self.counter.count += 1
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.counter.count += 1
+        return self.cursor.executemany(sql, param_list)
+
+
+@contextmanager
+def count_queries():
+    """Count the queries made with the database connection of this thread inside the block."""
+    counter = QueryCounter()
+    connection = connections[DEFAULT_DB_ALIAS]
+    overridden = {name: connection.__dict__.get(name) for name in ('make_cursor', 'make_debug_cursor')}
+    make_cursor, make_debug_cursor = connection.make_cursor, connection.make_debug_cursor
+
+    connection.make_cursor = lambda cursor: CountingCursorWrapper(make_cursor(cursor), counter)
+    connection.make_debug_cursor = lambda cursor: CountingCursorWrapper(make_debug_cursor(cursor), counter)
+
+    try:
+        yield counter
+    finally:
+        # Restore the wrappers of an outer count_queries block or the methods of the connection
+        for name, value in overridden.items():
+            if value is None:
+                delattr(connection, name)
+            else:
+                setattr(connection, name, value)
+
+
+class SendMetrics:
+    """
+    Metrics of the stages of sending a message run in one task or command.
+
+    The data is a dict of numbers that can be merged with merge_data: the runs, seconds, database queries
+    and recipients of every stage, the same for the sends of every transport and the histograms of the
+    provider request latencies of every HTTP client.
+    """
+    def __init__(self):
+        self.data = {'stages': {}, 'transports': {}, 'requests': {}}
+        # The transports make their requests in threads of their own, see MetricsThreadPoolExecutor
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, recipients=0, transport_path=None):
+        if transport_path:
+            record = self.data['transports'].setdefault(transport_path, {})
+        else:
+            record = self.data['stages'].setdefault(name, {})
+
+        # The stage can add counts of its own, e.g. when it knows the number of recipients only at the end
+        counts = {'recipients': recipients}
+        started_at = time.perf_counter()
+
+        with count_queries() as counter:
+            try:
+                yield counts
+            finally:
+                with self.lock:
+                    merge_data(record, dict(counts, runs=1, seconds=time.perf_counter() - started_at,
+                                            queries=counter.count))
+
+    def observe_request_latency(self, client_name, seconds):
+        with self.lock:
+            histogram = self.data['requests'].setdefault(client_name, {
+                'buckets': {str(bound): 0 for bound in LATENCY_BUCKETS},
+                'count': 0,
+                'sum': 0,
+            })
+
+            for bound in LATENCY_BUCKETS:
+                if seconds <= bound:
+                    histogram['buckets'][str(bound)] += 1
+
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+
+    def get_data(self):
+        with self.lock:
+            return merge_data({}, self.data)
+
+
+@contextmanager
+def collect_metrics():
+    """Collect the metrics of the stages run by this thread inside the block into a SendMetrics."""
+    metrics = SendMetrics()
+    _local.metrics = metrics
+
+    try:
+        yield metrics
+    finally:
+        _local.metrics = None
+
+
+def run_with_metrics(metrics, fn, *args, **kwargs):
+    previous_metrics = getattr(_local, 'metrics', None)
+    _local.metrics = metrics
+
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _local.metrics = previous_metrics
+
+
+class MetricsThreadPoolExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor running the submitted calls with the metrics collected by the submitting thread."""
+    def submit(self, fn, *args, **kwargs):
+        metrics = getattr(_local, 'metrics', None)
+
+        if metrics is None:
+            return super().submit(fn, *args, **kwargs)
+
+        return super().submit(run_with_metrics, metrics, fn, *args, **kwargs)
+
+
+@contextmanager
+def stage(name, recipients=0, transport_path=None):
+    """
+    Record the duration, database queries and recipients of a stage of sending a message.
+
+    Yields a dict of counts the stage can update. Nothing is recorded outside collect_metrics.
+    """
+    metrics = getattr(_local, 'metrics', None)
+
+    if metrics is None:
+        yield {'recipients': recipients}
+        return
+
+    with metrics.stage(name, recipients=recipients, transport_path=transport_path) as counts:
+        yield counts
+
+
+def instrumented(stage_name):
+    """Decorator recording every call of the function as a stage. See stage."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 02:44
+from __future__ import unicode_literals
+
+import carrier.enums
+from django.db import migrations
+import enumfields.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carrier', '0011_message_status_send_at_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='priority',
+            field=enumfields.fields.EnumField(default='normal', enum=carrier.enums.MessagePriority, max_length=255),
+        ),
+    ]
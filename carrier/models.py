@@ -1,16 +1,26 @@
+import json
 import uuid
 from collections import defaultdict
+from datetime import timedelta
+from functools import reduce
+from operator import or_
 
-import requests
 from django.conf import settings
 from django.conf.global_settings import LANGUAGES
-from django.db import models
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import Case, F, IntegerField, Q, Value, When
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.utils import timezone
 from enumfields import EnumField
 
-from .enums import MessageStatus, RecipientStatus, TransportType
+from .contacts import ContactInfoClient
+from .enums import MessagePriority, MessageStatus, RecipientStatus, TransportType
+from .metrics import instrumented, merge_data, stage
+from .utils import bulk_update, bulk_upsert, chunked, get_bulk_create_batch_size, get_transport_path, queryset_chunks
+
+CONTACT_INFO_FIELDS = ('email', 'pushbullet_access_token', 'firebase_token', 'phone', 'language',
+                       'preferred_transport')
 
 
 class Contact(models.Model):
@@ -21,26 +31,234 @@ class Contact(models.Model):
     firebase_token = models.CharField(max_length=255, null=True, blank=True)
     language = models.CharField(max_length=7, choices=LANGUAGES, null=True, blank=True)
     preferred_transport = EnumField(TransportType, max_length=100, null=True, blank=True)
+    fetched_at = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def get_stale_before(cls):
+        """Return the time before which fetched contact info is stale, or None if it never goes stale."""
+        ttl = getattr(settings, 'CONTACT_INFO_TTL', None)
+
+        if ttl is None:
+            return None
+
+        return timezone.now() - timedelta(seconds=ttl)
+
+    @classmethod
+    def get_values_from_contact_info(cls, contact_info):
+        return {
+            'email': contact_info.get('email'),
+            'pushbullet_access_token': contact_info.get('pushbullet'),
+            'firebase_token': contact_info.get('firebase'),
+            'phone': contact_info.get('phone'),
+            'language': contact_info.get('language'),
+            'preferred_transport': cls._meta.get_field('preferred_transport').to_python(
+                contact_info.get('contact_method')),
+        }
+
+    @classmethod
+    def insert_or_update(cls, contacts):
+        """
+        Insert the new contacts, updating the ones another worker has inserted since they were looked up.
+
+        PostgreSQL does this in the INSERT queries. Other databases insert the contacts in a savepoint and
+        update the contacts that already exist if the insert fails.
+        """
+        fields = CONTACT_INFO_FIELDS + ('fetched_at',)
+
+        if connections[cls.objects.db].vendor == 'postgresql':
+            bulk_upsert(contacts, fields)
+            return
+
+        while contacts:
+            try:
+                with transaction.atomic(using=cls.objects.db):
+                    cls.objects.bulk_create(contacts)
+                return
+            except IntegrityError:
+                existing_ids = set(cls.objects.filter(
+                    id__in=[contact.id for contact in contacts]).values_list('id', flat=True))
+
+                if not existing_ids:
+                    raise
+
+            bulk_update([contact for contact in contacts if contact.id in existing_ids], fields)
+            contacts = [contact for contact in contacts if contact.id not in existing_ids]
+
+    @classmethod
+    def upsert_from_contact_info(cls, contact_infos, fetched_at=None):
+        """
+        Create or update contacts from a contact info response using a constant number of queries.
+
+        Returns the ids of the contacts in the response that have a contact method. Existing contacts that no
+        longer have one are cleared, so they are not used for sending nor fetched again before they go stale.
+        """
+        fetched_at = fetched_at or timezone.now()
+
+        values_by_id = {}
+        cleared_ids = []
+        for contact_id, contact_info in contact_infos.items():
+            if not contact_info.get('contact_method'):
+                cleared_ids.append(contact_id)
+                continue
+
+            values_by_id[uuid.UUID(str(contact_id))] = cls.get_values_from_contact_info(contact_info)
+
+        existing_contacts = cls.objects.in_bulk(list(values_by_id))
+
+        new_contacts = []
+        changed_contacts = []
+        unchanged_ids = []
+        for contact_id, values in values_by_id.items():
+            contact = existing_contacts.get(contact_id)
+
+            if contact is None:
+                new_contacts.append(cls(id=contact_id, fetched_at=fetched_at, **values))
+                continue
+
+            if any(getattr(contact, field_name) != value for field_name, value in values.items()):
+                for field_name, value in values.items():
+                    setattr(contact, field_name, value)
+                contact.fetched_at = fetched_at
+                changed_contacts.append(contact)
+            else:
+                unchanged_ids.append(contact_id)
+
+        cls.insert_or_update(new_contacts)
+        bulk_update(changed_contacts, CONTACT_INFO_FIELDS + ('fetched_at',))
+
+        for ids in chunked(unchanged_ids, getattr(settings, 'CARRIER_RECIPIENT_UPDATE_BATCH_SIZE', 1000)):
+            cls.objects.filter(id__in=ids).update(fetched_at=fetched_at)
+
+        cls.clear_contact_info(cleared_ids, fetched_at)
+
+        return list(values_by_id)
+
+    @classmethod
+    def clear_contact_info(cls, contact_ids, fetched_at):
+        """Clear the contact info of the existing contacts with the given ids, which may not all be valid uuids."""
+        valid_ids = []
+        for contact_id in contact_ids:
+            try:
+                valid_ids.append(uuid.UUID(str(contact_id)))
+            except ValueError:
+                # E.g. the contact info service reports an invalid user id
+                pass
+
+        cleared_values = {field_name: None for field_name in CONTACT_INFO_FIELDS}
+        for ids in chunked(valid_ids, getattr(settings, 'CARRIER_RECIPIENT_UPDATE_BATCH_SIZE', 1000)):
+            cls.objects.filter(id__in=ids).update(fetched_at=fetched_at, **cleared_values)
 
 
 class MessageSendResult:
-    def __init__(self, errors=None, warnings=None, sent=None):
+    def __init__(self, errors=None, warnings=None, sent=None, skipped=False):
         self.errors = errors
         self.warning = warnings
         self.sent = sent
+        # True when another worker started sending the message first
+        self.skipped = skipped
 
     def has_errors(self):
         return bool(self.errors)
 
 
+class ContentResolver:
+    """Finds the content for a language from contents that are loaded only once."""
+    def __init__(self, contents, content_languages):
+        self.contents_by_language = {}
+        for content in contents:
+            self.contents_by_language.setdefault(content.language, content)
+
+        # Sort available content languages by content_languages and use the first one as the fallback
+        ordered_languages = list(self.contents_by_language)
+        ordered_languages.sort(key=lambda x: content_languages.index(x) if x in content_languages else 9999)
+
+        self.fallback_content = self.contents_by_language[ordered_languages[0]] if ordered_languages else None
+
+    def get(self, language):
+        return self.contents_by_language.get(language, self.fallback_content)
+
+
 class Message(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     from_name = models.CharField(max_length=255, null=True, blank=True)
     from_email = models.CharField(max_length=255, null=True, blank=True)
     send_at = models.DateTimeField(null=True, blank=True)
     sent_at = models.DateTimeField(editable=False, null=True, blank=True)
-    created_at = models.DateTimeField(editable=False, blank=True, auto_now_add=True)
+    sending_started_at = models.DateTimeField(editable=False, null=True, blank=True)
+    claimed_at = models.DateTimeField(editable=False, null=True, blank=True)
+    claim_token = models.UUIDField(editable=False, null=True, blank=True)
+    created_at = models.DateTimeField(editable=False, blank=True, auto_now_add=True, db_index=True)
     status = EnumField(MessageStatus, max_length=255, default=MessageStatus.PENDING_INFO)
+    priority = EnumField(MessagePriority, max_length=255, default=MessagePriority.NORMAL)
+
+    # Messages in these statuses are waiting for a worker to send them
+    CLAIMABLE_STATUSES = (MessageStatus.PENDING_INFO, MessageStatus.READY_TO_SEND)
+
+    class Meta:
+        indexes = [
+            # Used to find the scheduled messages that are due
+            models.Index(fields=['status', 'send_at']),
+        ]
+
+    @classmethod
+    def get_due_messages(cls, send_before=None):
+        """Return the messages waiting to be sent that are not scheduled or are scheduled before send_before."""
+        send_before = send_before or timezone.now()
+
+        return cls.objects.filter(status__in=cls.CLAIMABLE_STATUSES).filter(
+            Q(send_at__isnull=True) | Q(send_at__lte=send_before))
+
+    @classmethod
+    def claim_for_sending(cls, limit, messages=None, claim_token=None):
+        """
+        Claim at most limit messages by moving them to FETCHING_INFO and return their ids.
+
+        The messages are claimed from the given queryset, by default the messages that are due now, in the order
+        of their priority. Rows locked by another claim are skipped, so concurrent workers never claim the same
+        message. The claim_token is stored to hand the claims over to prepare_message.
+        """
+        if messages is None:
+            messages = cls.get_due_messages()
+
+        priority_order = Case(*[
+            When(priority=priority, then=Value(order))
+            for order, priority in enumerate([MessagePriority.HIGH, MessagePriority.NORMAL, MessagePriority.LOW])
+        ], output_field=IntegerField())
+
+        with transaction.atomic():
+            message_ids = list(messages.select_for_update(skip_locked=True).filter(
+                status__in=cls.CLAIMABLE_STATUSES
+            ).annotate(priority_order=priority_order).order_by('priority_order', 'created_at').values_list(
+                'id', flat=True)[:limit])
+
+            # The status condition keeps databases without row locks from claiming a message twice
+            return [message_id for message_id in message_ids if cls.objects.filter(
+                id=message_id, status__in=cls.CLAIMABLE_STATUSES
+            ).update(status=MessageStatus.FETCHING_INFO, claimed_at=timezone.now(), claim_token=claim_token)]
+
+    @classmethod
+    def claim_for_preparation(cls, message_id, claim_token=None):
+        """
+        Claim the message for preparation and return a new claim token, or None if it could not be claimed.
+
+        Without a claim_token only a pending message is claimed. With one, the claim handed over by its holder is
+        taken over. The token is replaced either way, so the same claim can never be taken twice.
+        """
+        messages = cls.objects.filter(pk=message_id)
+        if claim_token:
+            messages = messages.filter(status=MessageStatus.FETCHING_INFO, claim_token=claim_token)
+        else:
+            messages = messages.filter(status=MessageStatus.PENDING_INFO)
+
+        new_claim_token = uuid.uuid4()
+        if not messages.update(status=MessageStatus.FETCHING_INFO, claimed_at=timezone.now(),
+                               claim_token=new_claim_token):
+            return None
+
+        return new_claim_token
+
+    def is_due(self):
+        return self.send_at is None or self.send_at <= timezone.now()
 
     def validate(self):
         errors = []
@@ -64,91 +282,201 @@ class Message(models.Model):
     def get_content_languages(self):
         return set(self.contents.all().values_list('language', flat=True))
 
+    def get_content_resolver(self):
+        return ContentResolver(self.contents.order_by('id'), settings.CARRIER_CONTENT_LANGUAGES)
+
     def get_content_in_language(self, language):
-        available_languages = self.get_content_languages()
+        # While sending, the transports share the resolver created in send()
+        content_resolver = getattr(self, '_content_resolver', None) or self.get_content_resolver()
 
-        if language not in available_languages:
-            # Sort available content languages by CARRIER_CONTENT_LANGUAGES and take the first available
-            ordered_languages = list(available_languages)
-            ordered_languages.sort(key=lambda x: settings.CARRIER_CONTENT_LANGUAGES.index(x) if
-                                   x in settings.CARRIER_CONTENT_LANGUAGES else 9999)
-            language = ordered_languages[0]
+        return content_resolver.get(language)
 
-        content = self.contents.filter(language=language).first()
+    @instrumented('fetch_contact_info')
+    def fetch_contact_info_for_recipients(self):
+        stale_before = Contact.get_stale_before()
 
-        return content
+        # Contacts fetched within CONTACT_INFO_TTL are used without asking the contact info service
+        fresh_contacts = Contact.objects.all()
+        if stale_before:
+            fresh_contacts = fresh_contacts.filter(fetched_at__gte=stale_before)
+
+        self.recipients.filter(uuid__in=fresh_contacts.values('id'), contact__isnull=True).update(contact=F('uuid'))
 
-    def fetch_contact_info_for_recipients(self):
         # Gather the uuids of the contacts we need to fetch info for
-        recipient_uuids = [
-            str(v) for v in self.recipients.filter(uuid__isnull=False, contact__isnull=True).values_list(
-                'uuid', flat=True)]
+        recipients = self.recipients.filter(uuid__isnull=False)
+        if stale_before:
+            recipients = recipients.filter(
+                Q(contact__isnull=True) | Q(contact__fetched_at__isnull=True) | Q(contact__fetched_at__lt=stale_before))
+        else:
+            recipients = recipients.filter(contact__isnull=True)
 
-        if not recipient_uuids:
-            return
+        recipient_uuids = [str(v) for v in recipients.values_list('uuid', flat=True)]
 
-        url = '{}?ids={}'.format(settings.CONTACT_INFO_URL, ','.join(recipient_uuids))
+        errors = []
 
-        r = requests.get(url, auth=(settings.TUNNISTAMO_USERNAME, settings.TUNNISTAMO_PASSWORD))
-        r.raise_for_status()
+        if not recipient_uuids:
+            return errors
 
-        for contact_id, contact_info in r.json().items():
-            if not contact_info.get('contact_method'):
+        # Pages are stored as they arrive, a failed page leaves only its own recipients without contact info
+        for page in ContactInfoClient().fetch(recipient_uuids):
+            if page.error:
+                errors.append(page.error)
                 continue
 
-            Contact.objects.update_or_create(
-                id=contact_id,
-                email=contact_info.get('email'),
-                pushbullet_access_token=contact_info.get('pushbullet'),
-                firebase_token=contact_info.get('firebase'),
-                phone=contact_info.get('phone'),
-                language=contact_info.get('language'),
-                preferred_transport=contact_info.get('contact_method')
-            )
-            # self.recipients.filter(uuid=contact_id).update(contact=contact)
+            contact_ids = Contact.upsert_from_contact_info(page.contact_infos, fetched_at=page.fetched_at)
+
+            for ids in chunked(contact_ids, getattr(settings, 'CARRIER_RECIPIENT_UPDATE_BATCH_SIZE', 1000)):
+                self.recipients.filter(uuid__in=ids, contact__isnull=True).update(contact=F('uuid'))
+
+        return errors
 
+    @instrumented('attach_contacts')
     def attach_contacts_to_recipients(self):
-        for recipient in self.recipients.filter(status=RecipientStatus.PENDING_INFO):
-            recipient.attach_contact()
+        # Contacts use the same ids as the recipient uuids
+        self.recipients.filter(
+            status=RecipientStatus.PENDING_INFO, contact__isnull=True, uuid__in=Contact.objects.values('id')
+        ).update(contact=F('uuid'))
 
+    @instrumented('validate_recipients')
     def validate_recipients(self, transports):
-        for recipient in self.recipients.filter():
-            # Check that at least one transport can send to the recipient
-            for transport in transports:
-                if transport.is_suitable_for_recipient(recipient):
-                    recipient.status = RecipientStatus.READY_TO_SEND
-                    break
+        recipient_filters = []
+        row_transports = []
+        for transport in transports:
+            recipient_filter = transport.get_recipient_filter()
+
+            if recipient_filter is None:
+                row_transports.append(transport)
             else:
-                recipient.status = RecipientStatus.IGNORED
+                recipient_filters.append(recipient_filter)
+
+        # Recipients that are being sent or have been sent already keep their status
+        recipients = self.recipients.filter(
+            status__in=[RecipientStatus.PENDING_INFO, RecipientStatus.READY_TO_SEND, RecipientStatus.IGNORED])
+
+        # Recipients are ignored unless at least one transport can send to them
+        recipients.update(status=RecipientStatus.IGNORED)
 
-            recipient.save()
+        if recipient_filters:
+            recipients.filter(reduce(or_, recipient_filters)).update(status=RecipientStatus.READY_TO_SEND)
+
+        if row_transports:
+            ready_ids = []
+            ignored_recipients = self.recipients.filter(status=RecipientStatus.IGNORED).select_related('contact')
+
+            for recipient in ignored_recipients.iterator():
+                if any(transport.is_suitable_for_recipient(recipient) for transport in row_transports):
+                    ready_ids.append(recipient.id)
+
+            for ids in chunked(ready_ids, getattr(settings, 'CARRIER_RECIPIENT_UPDATE_BATCH_SIZE', 1000)):
+                self.recipients.filter(id__in=ids).update(status=RecipientStatus.READY_TO_SEND)
 
         self.status = MessageStatus.READY_TO_SEND
         self.save()
 
-    def send(self, transports):
-        if not self.is_sendable():
-            return MessageSendResult(errors=self.get_validation_errors(), sent=False)
+    def route_recipients(self, transports):
+        """
+        Yield (transport, recipients) tuples assigning the recipients ready to send to the first suitable transport.
+
+        The recipients are loaded in chunks of CARRIER_RECIPIENT_CHUNK_SIZE with their contacts. Recipients no
+        transport can send to are yielded with None as the transport.
+        """
+        recipients = self.recipients.filter(status=RecipientStatus.READY_TO_SEND).select_related('contact')
+        chunk_size = getattr(settings, 'CARRIER_RECIPIENT_CHUNK_SIZE', 5000)
+
+        for recipient_chunk in queryset_chunks(recipients, chunk_size):
+            transport_recipients = defaultdict(list)
+            for recipient in recipient_chunk:
+                for transport in transports:
+                    # Use the first suitable transport
+                    if transport.is_suitable_for_recipient(recipient):
+                        transport_recipients[transport].append(recipient)
+                        break
+                else:
+                    transport_recipients[None].append(recipient)
+
+            for transport, transport_chunk in transport_recipients.items():
+                yield transport, transport_chunk
+
+    def claim_recipients(self, recipients):
+        """
+        Mark the given recipients that are still ready to send as sending and return the ones claimed.
+
+        The claim is a single UPDATE, so concurrent workers never claim the same recipient. Recipients that
+        have already been sent or claimed by another worker are left out.
+        """
+        claim_token = uuid.uuid4()
+
+        self.recipients.filter(
+            id__in=[recipient.id for recipient in recipients], status=RecipientStatus.READY_TO_SEND
+        ).update(status=RecipientStatus.SENDING, claim_token=claim_token, claimed_at=timezone.now())
+
+        claimed_ids = set(self.recipients.filter(claim_token=claim_token).values_list('id', flat=True))
+
+        claimed_recipients = []
+        for recipient in recipients:
+            if recipient.id in claimed_ids:
+                recipient.status = RecipientStatus.SENDING
+                recipient.claim_token = claim_token
+                claimed_recipients.append(recipient)
+
+        return claim_token, claimed_recipients
+
+    def send_to_recipients(self, transport, recipients):
+        claim_token, recipients = self.claim_recipients(recipients)
+
+        if not recipients:
+            return {
+                "success": True,
+                "errors": [],
+            }
+
+        # Load the contents once for all the transports and chunks
+        if getattr(self, '_content_resolver', None) is None:
+            self._content_resolver = self.get_content_resolver()
 
-        self.status = MessageStatus.SENDING
-        self.save()
+        try:
+            with stage('send', recipients=len(recipients), transport_path=get_transport_path(transport)) as counts:
+                result = transport.send(self, recipients)
 
-        errors = []
-        warnings = []
-        transport_recipients = defaultdict(list)
-        for recipient in self.recipients.filter(status=RecipientStatus.READY_TO_SEND):
-            for transport in transports:
-                # Use the first suitable transport
-                if transport.is_suitable_for_recipient(recipient):
-                    transport_recipients[transport].append(recipient)
-                    break
-            else:
-                warnings.append('No suitable transport found for recipient id {}. Skipping.'.format(recipient.id))
+                counts['errors'] = len(result['errors'])
+                counts['retries'] = len(result.get('retry_recipient_ids') or [])
+
+            return result
+        finally:
+            # The transport didn't record a result for recipients still sending, so they were not sent
+            self.recipients.filter(claim_token=claim_token, status=RecipientStatus.SENDING).update(
+                status=RecipientStatus.READY_TO_SEND, claim_token=None, claimed_at=None)
+
+    def fail_retries(self, result):
+        """Set the recipients a transport result left for retrying as failed and return their errors."""
+        recipient_ids = result.get('retry_recipient_ids')
+        if not recipient_ids:
+            return []
 
-        for transport, recipients in transport_recipients.items():
-            result = transport.send(self, recipients)
-            errors.extend(result['errors'])
+        batch_size = connections[self.recipients.db].ops.bulk_batch_size(['id'], recipient_ids)
+        for ids in chunked(recipient_ids, batch_size):
+            self.recipients.filter(id__in=ids, status=RecipientStatus.READY_TO_SEND).update(
+                status=RecipientStatus.ERROR)
 
+        return result['retry_errors']
+
+    def start_sending(self):
+        """Move the message from READY_TO_SEND to SENDING. Returns False if another worker started it first."""
+        sending_started_at = timezone.now()
+
+        started = Message.objects.filter(pk=self.pk, status=MessageStatus.READY_TO_SEND).update(
+            status=MessageStatus.SENDING, sending_started_at=sending_started_at)
+
+        if not started:
+            return False
+
+        self.status = MessageStatus.SENDING
+        self.sending_started_at = sending_started_at
+
+        return True
+
+    def finish_sending(self, errors):
+        self._content_resolver = None
         self.sent_at = timezone.now()
 
         if not errors:
@@ -158,6 +486,33 @@ class Message(models.Model):
 
         self.save()
 
+    def send(self, transports):
+        if not self.is_sendable():
+            return MessageSendResult(errors=self.get_validation_errors(), sent=False)
+
+        if not self.start_sending():
+            return MessageSendResult(warnings=['Message is already being sent.'], sent=False, skipped=True)
+
+        errors = []
+        warnings = []
+
+        try:
+            for transport, recipients in self.route_recipients(transports):
+                if transport is None:
+                    warnings.extend('No suitable transport found for recipient id {}. Skipping.'.format(recipient.id)
+                                    for recipient in recipients)
+                    continue
+
+                result = self.send_to_recipients(transport, recipients)
+                errors.extend(result['errors'])
+
+                # Sending synchronously has no task to retry later
+                errors.extend(self.fail_retries(result))
+        finally:
+            self._content_resolver = None
+
+        self.finish_sending(errors)
+
         return MessageSendResult(errors=errors, warnings=warnings, sent=True)
 
 
@@ -170,6 +525,19 @@ class Recipient(models.Model):
     language = models.CharField(max_length=7, choices=LANGUAGES, null=True, blank=True)
     transport = EnumField(TransportType, max_length=100, null=True, blank=True)
     status = EnumField(RecipientStatus, max_length=255, default=RecipientStatus.PENDING_INFO)
+    claim_token = models.UUIDField(null=True, blank=True, editable=False, db_index=True)
+    claimed_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    @classmethod
+    def release_expired_claims(cls, expired_before):
+        """
+        Return recipients claimed before expired_before and still sending to the ready to send state.
+
+        A worker that died while sending never recorded the results of its claimed recipients. Their
+        delivery can't be confirmed, so they will be sent again.
+        """
+        return cls.objects.filter(status=RecipientStatus.SENDING, claimed_at__lt=expired_before).update(
+            status=RecipientStatus.READY_TO_SEND, claim_token=None, claimed_at=None)
 
     def get_email(self):
         if self.email:
@@ -213,6 +581,28 @@ class Recipient(models.Model):
 
         return None
 
+    @classmethod
+    def bulk_create_with_contacts(cls, recipients, batch_size=None):
+        """
+        Create the recipients with bulk_create attaching their existing contacts.
+
+        Does what the check_for_contact signal does for single recipients with one contact query
+        for the whole batch. The post_save signal is not sent for bulk created recipients.
+        """
+        uuids = list({recipient.uuid for recipient in recipients if recipient.uuid and not recipient.contact_id})
+
+        contact_ids = set()
+        if uuids:
+            id_batch_size = connections[Contact.objects.db].ops.bulk_batch_size(['id'], uuids)
+            for ids in chunked(uuids, id_batch_size):
+                contact_ids.update(Contact.objects.filter(id__in=ids).values_list('id', flat=True))
+
+        for recipient in recipients:
+            if recipient.uuid in contact_ids and not recipient.contact_id:
+                recipient.contact_id = recipient.uuid
+
+        return cls.objects.bulk_create(recipients, batch_size=get_bulk_create_batch_size(cls, recipients, batch_size))
+
     def attach_contact(self):
         if not self.uuid or self.contact:
             return
@@ -225,6 +615,24 @@ class Recipient(models.Model):
         self.save()
 
 
+class RecipientUpdater:
+    """Collects changed recipients and writes them to the database in batches."""
+    def __init__(self, fields, batch_size=None):
+        self.fields = fields
+        self.batch_size = batch_size or getattr(settings, 'CARRIER_RECIPIENT_UPDATE_BATCH_SIZE', 1000)
+        self.pending = []
+
+    def add(self, recipient):
+        self.pending.append(recipient)
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        bulk_update(self.pending, self.fields, batch_size=self.batch_size)
+        self.pending = []
+
+
 class Content(models.Model):
     message = models.ForeignKey(Message, related_name="contents", on_delete=models.CASCADE)
     language = models.CharField(max_length=7, choices=LANGUAGES, null=True, blank=True)
@@ -234,15 +642,106 @@ class Content(models.Model):
     short_text = models.CharField(max_length=255, null=True, blank=True)
 
 
+class DeliveryChunk(models.Model):
+    """
+    A chunk of recipients of a message queued for delivery by a deliver_recipients task.
+
+    A chunk is queued until its task starts and finished when the task has recorded its results. Chunks
+    that are queued or were started within CARRIER_CLAIM_TIMEOUT seconds keep recover_messages from sending
+    the message again, even when none of their recipients have been claimed yet.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    message = models.ForeignKey(Message, related_name='delivery_chunks', on_delete=models.CASCADE)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def get_active_chunks(cls, expired_before):
+        """Return the unfinished chunks that are queued or were started after expired_before."""
+        return cls.objects.filter(finished_at__isnull=True).filter(
+            Q(started_at__isnull=True) | Q(started_at__gte=expired_before))
+
+
+class SendReport(models.Model):
+    """
+    Metrics of sending a part of a message collected by carrier.metrics, stored as JSON.
+
+    Every task sending a part of the message adds a report of its own, so the tasks never wait on each
+    other. The reports of a message are summed when they are read.
+    """
+    message = models.ForeignKey(Message, related_name='send_reports', on_delete=models.CASCADE)
+    data = models.TextField(default='{}')
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    @classmethod
+    def add(cls, message_id, data):
+        return cls.objects.create(message_id=message_id, data=json.dumps(data))
+
+    @classmethod
+    def get_message_data(cls, message_id):
+        data = {}
+        for report_data in cls.objects.filter(message_id=message_id).values_list('data', flat=True):
+            merge_data(data, json.loads(report_data))
+
+        return data
+
+    def get_data(self):
+        return json.loads(self.data)
+
+
+class SendReportTotal(models.Model):
+    """
+    Running totals of the send reports of all messages, stored as JSON.
+
+    The totals are advanced with the reports created since the last update, so updating them doesn't get
+    slower as the reports pile up. Reports are added CARRIER_METRICS_DELAY seconds after they are created
+    so that reports written by transactions still open at the time of an update aren't skipped.
+    """
+    data = models.TextField(default='{}')
+    reports_until = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def update(cls):
+        """Add the settled reports created since the last update to the totals and return the totals."""
+        reports_until = timezone.now() - timedelta(seconds=getattr(settings, 'CARRIER_METRICS_DELAY', 60))
+
+        with transaction.atomic():
+            total, created = cls.objects.select_for_update().get_or_create(pk=1)
+            data = total.get_data()
+
+            reports = SendReport.objects.filter(created_at__lt=reports_until)
+            if total.reports_until:
+                reports = reports.filter(created_at__gte=total.reports_until)
+
+            for report_data in reports.values_list('data', flat=True).iterator():
+                merge_data(data, json.loads(report_data))
+
+            total.data = json.dumps(data)
+            total.reports_until = reports_until
+            total.save()
+
+        return data
+
+    def get_data(self):
+        return json.loads(self.data)
+
+
+class RateLimitBucket(models.Model):
+    """Token bucket state of a rate limit shared by all workers. See carrier.ratelimit."""
+    key = models.CharField(max_length=255, primary_key=True)
+    tokens = models.FloatField()
+    updated_at = models.DateTimeField()
+
+
 @receiver(post_save, sender=Recipient)
 def check_for_contact(sender, instance, created, **kwargs):
     if not created:
         return
 
-    if instance.uuid:
+    if instance.uuid and not instance.contact_id:
         try:
             contact = Contact.objects.get(pk=instance.uuid)
             instance.contact = contact
-            instance.save()
+            instance.save(update_fields=['contact'])
         except Contact.DoesNotExist:
             pass
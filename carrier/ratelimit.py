@@ -0,0 +1,91 @@
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from carrier.models import RateLimitBucket
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter shared by all the workers through a RateLimitBucket database row.
+
+    The bucket holds at most capacity tokens and is refilled with rate tokens per second. Every request to
+    the provider takes one token, so the requests are paced to rate requests per second with bursts of at
+    most capacity requests.
+
+    To keep the workers from queuing on the bucket row, tokens are taken from it batch_size at a time, by
+    default a tenth of the capacity, and handed out from memory. Tokens left over are dropped once the
+    bucket would have earned them again, so a worker can't save them up for a burst.
+    """
+    def __init__(self, key, rate, capacity=None, batch_size=None):
+        self.key = key
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.batch_size = min(max(float(batch_size or self.capacity / 10), 1), self.capacity)
+
+        self.reserved = 0
+        self.reserved_until = 0
+        # Transports, and with them their limiters, are shared by the threads of a process
+        self.lock = threading.Lock()
+
+    def try_acquire(self, tokens=1):
+        """Take the tokens if they are available. Returns 0 if they were taken or else the seconds to wait."""
+        with transaction.atomic():
+            now = timezone.now()
+            bucket, created = RateLimitBucket.objects.select_for_update().get_or_create(
+                key=self.key, defaults={'tokens': self.capacity, 'updated_at': now})
+
+            elapsed = max((now - bucket.updated_at).total_seconds(), 0)
+            available = min(self.capacity, bucket.tokens + elapsed * self.rate)
+
+            if available < tokens:
+                return (tokens - available) / self.rate
+
+            bucket.tokens = available - tokens
+            bucket.updated_at = now
+            bucket.save()
+
+            return 0
+
+    def take_reserved(self, tokens):
+        if time.monotonic() > self.reserved_until:
+            self.reserved = 0
+
+        taken = min(tokens, self.reserved)
+        self.reserved -= taken
+
+        return taken
+
+    def acquire(self, tokens=1):
+        """Wait until the tokens are available and take them."""
+        with self.lock:
+            tokens -= self.take_reserved(tokens)
+
+            while tokens > 0:
+                # A whole batch is taken from the bucket and the rest is kept for the next requests. More tokens
+                # than the capacity are taken in parts.
+                part = min(max(tokens, self.batch_size), self.capacity)
+
+                wait = self.try_acquire(part)
+                if wait:
+                    time.sleep(wait)
+                    continue
+
+                taken = min(tokens, part)
+                tokens -= taken
+
+                self.reserved = part - taken
+                self.reserved_until = time.monotonic() + self.reserved / self.rate
+
+
+def get_rate_limiter(key):
+    """Return a RateLimiter configured for the key in the CARRIER_RATE_LIMITS setting, or None."""
+    config = getattr(settings, 'CARRIER_RATE_LIMITS', {}).get(key)
+
+    if not config:
+        return None
+
+    return RateLimiter(key, rate=config['rate'], capacity=config.get('capacity'), batch_size=config.get('batch_size'))
@@ -0,0 +1,101 @@
+import random
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+from django.conf import settings
+from django.utils import timezone
+from requests import ConnectionError, Timeout
+
+# Statuses meaning the provider is throttling or temporarily unavailable
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def is_retryable(exception):
+    """Return True if the request failed temporarily and sending it again later may succeed."""
+    if isinstance(exception, (ConnectionError, Timeout)):
+        return True
+
+    response = getattr(exception, 'response', None)
+    if response is not None:
+        return response.status_code in RETRYABLE_STATUS_CODES
+
+    return False
+
+
+def get_retry_after(exception):
+    """Return the seconds to wait from the Retry-After header of the failed response, or None."""
+    response = getattr(exception, 'response', None)
+    if response is None:
+        return None
+
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+
+    # The header can also be an HTTP date
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if retry_at.tzinfo is None:
+        retry_at = timezone.make_aware(retry_at, timezone.utc)
+
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+class RetryPolicy:
+    """
+    Capped exponential backoff with full jitter for retrying transient transport failures.
+
+    The policy is configured with the CARRIER_RETRY_MAX_RETRIES, CARRIER_RETRY_BACKOFF and
+    CARRIER_RETRY_MAX_BACKOFF settings.
+    """
+    def __init__(self, max_retries=None, backoff=None, max_backoff=None):
+        self.max_retries = max_retries if max_retries is not None else getattr(
+            settings, 'CARRIER_RETRY_MAX_RETRIES', 5)
+        self.backoff = backoff if backoff is not None else getattr(settings, 'CARRIER_RETRY_BACKOFF', 2)
+        self.max_backoff = max_backoff if max_backoff is not None else getattr(
+            settings, 'CARRIER_RETRY_MAX_BACKOFF', 10 * 60)
+
+    def should_retry(self, retries):
+        return retries < self.max_retries
+
+    def get_delay(self, retries, retry_after=None):
+        """Return the seconds to wait before the retry number retries + 1."""
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** retries))
+
+        # Never retry before the provider asked to
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_backoff))
+
+        return delay
+
+
+class RetryableFailures:
+    """Collects the recipients a transport failed to send to because of retryable errors."""
+    def __init__(self):
+        self.recipient_ids = []
+        self.errors = []
+        self.retry_after = None
+
+    def add(self, recipients, error, exception):
+        self.recipient_ids.extend(recipient.id for recipient in recipients)
+        self.errors.append(error)
+
+        retry_after = get_retry_after(exception)
+        if retry_after is not None:
+            self.retry_after = max(self.retry_after or 0, retry_after)
+
+    def get_result(self):
+        """Return the keys added to the result of Transport.send."""
+        return {
+            'retry_recipient_ids': self.recipient_ids,
+            'retry_errors': self.errors,
+            'retry_after': self.retry_after,
+        }
@@ -1,8 +1,11 @@
+from django.conf import settings
+from django.db import transaction
 from enumfields.drf import EnumSupportSerializerMixin
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
 from carrier.models import Content, Message, Recipient
+from carrier.utils import get_bulk_create_batch_size
 from carrier.validators import OrValidator
 
 
@@ -23,43 +26,68 @@ class CreateRelatedMixin:
         for field_name in self.Meta.create_related_fields:
             related_validated_data[field_name] = validated_data.pop(field_name, [])
 
-        instance = super().create(validated_data)
+        with transaction.atomic():
+            instance = super().create(validated_data)
 
-        for field_name in self.Meta.create_related_fields:
-            if field_name not in related_validated_data:
-                continue
-
-            child_model = self.fields[field_name].child.Meta.model
-            child_serializer_class = self.fields[field_name].child.__class__
-            child_manager = getattr(instance, field_name)
-
-            foreign_field_name = None
-            for child_field in child_model._meta.get_fields():
-                if child_field.remote_field and child_field.remote_field.model == self.__class__.Meta.model:
-                    foreign_field_name = child_field.name
-                    break
-
-            assert foreign_field_name, 'Foreign field for class {} not found from class {}'.format(
-                self.__class__, child_model)
-
-            for item in related_validated_data[field_name]:
-                serializer = child_serializer_class(data=item)
-
-                try:
-                    serializer.is_valid(raise_exception=True)
-                except ValidationError as e:
-                    raise ValidationError({
-                        field_name: e.detail
-                    })
-
-                item_instance = serializer.save(**{
-                    foreign_field_name: instance
-                })
+            for field_name in self.Meta.create_related_fields:
+                if field_name not in related_validated_data:
+                    continue
 
-                child_manager.add(item_instance)
+                if field_name in getattr(self.Meta, 'bulk_create_related_fields', ()):
+                    self.bulk_create_related(instance, field_name, related_validated_data[field_name])
+                else:
+                    self.create_related(instance, field_name, related_validated_data[field_name])
 
         return instance
 
+    def get_foreign_field_name(self, child_model):
+        foreign_field_name = None
+        for child_field in child_model._meta.get_fields():
+            if child_field.remote_field and child_field.remote_field.model == self.__class__.Meta.model:
+                foreign_field_name = child_field.name
+                break
+
+        assert foreign_field_name, 'Foreign field for class {} not found from class {}'.format(
+            self.__class__, child_model)
+
+        return foreign_field_name
+
+    def create_related(self, instance, field_name, items):
+        child_model = self.fields[field_name].child.Meta.model
+        child_serializer_class = self.fields[field_name].child.__class__
+        child_manager = getattr(instance, field_name)
+        foreign_field_name = self.get_foreign_field_name(child_model)
+
+        for item in items:
+            serializer = child_serializer_class(data=item)
+
+            try:
+                serializer.is_valid(raise_exception=True)
+            except ValidationError as e:
+                raise ValidationError({
+                    field_name: e.detail
+                })
+
+            item_instance = serializer.save(**{
+                foreign_field_name: instance
+            })
+
+            child_manager.add(item_instance)
+
+    def bulk_create_related(self, instance, field_name, items):
+        # The items have already been validated by the nested list serializer
+        child_model = self.fields[field_name].child.Meta.model
+        foreign_field_name = self.get_foreign_field_name(child_model)
+
+        child_instances = [child_model(**dict(item, **{foreign_field_name: instance})) for item in items]
+
+        self.perform_bulk_create(field_name, child_model, child_instances)
+
+    def perform_bulk_create(self, field_name, child_model, child_instances):
+        batch_size = get_bulk_create_batch_size(
+            child_model, child_instances, getattr(settings, 'CARRIER_BULK_CREATE_BATCH_SIZE', 1000))
+        child_model.objects.bulk_create(child_instances, batch_size=batch_size)
+
 
 class RecipientSerializer(EnumSupportSerializerMixin, serializers.ModelSerializer):
     class Meta:
@@ -77,7 +105,8 @@ class ContentSerializer(serializers.ModelSerializer):
 
 
 class MessageSerializer(CreateRelatedMixin, EnumSupportSerializerMixin, serializers.ModelSerializer):
-    recipients = RecipientSerializer(many=True)
+    # Recipients can be left out and uploaded separately to the created draft message
+    recipients = RecipientSerializer(many=True, required=False)
     contents = ContentSerializer(many=True)
 
     class Meta:
@@ -85,3 +114,13 @@ class MessageSerializer(CreateRelatedMixin, EnumSupportSerializerMixin, serializ
         fields = '__all__'
         read_only_fields = ('created_at', 'sent_at', 'status')
         create_related_fields = ('recipients', 'contents')
+        bulk_create_related_fields = ('recipients', 'contents')
+
+    def perform_bulk_create(self, field_name, child_model, child_instances):
+        if child_model is Recipient:
+            # Bulk created recipients don't get their contacts attached by the post_save signal
+            Recipient.bulk_create_with_contacts(
+                child_instances, batch_size=getattr(settings, 'CARRIER_BULK_CREATE_BATCH_SIZE', 1000))
+            return
+
+        super().perform_bulk_create(field_name, child_model, child_instances)
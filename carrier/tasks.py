@@ -1,21 +1,212 @@
-from celery import shared_task
+import uuid
+from datetime import timedelta
+
+from celery import chord, shared_task
+from celery.signals import worker_process_init
 from celery.utils.log import get_task_logger
+from django.conf import settings
 from django.core.management import call_command
+from django.db.models import F, Q
+from django.utils import timezone
 
-from carrier.enums import MessageStatus
-from carrier.models import Message
-from carrier.transports import get_transports
+from carrier.enums import MessageStatus, RecipientStatus
+from carrier.metrics import collect_metrics
+from carrier.models import DeliveryChunk, Message, Recipient, SendReport
+from carrier.retry import RetryPolicy
+from carrier.transports import get_transport, get_transport_path, get_transports, reset_transports
+from carrier.utils import chunked
 
 logger = get_task_logger(__name__)
 
 
+@worker_process_init.connect
+def warm_up_transports(**kwargs):
+    """Build the transports when a worker process starts instead of in its first task."""
+    reset_transports()
+    get_transports()
+
+
 @shared_task
 def send_messages():
     call_command('send_messages')
 
 
+def get_task_options(message):
+    """
+    Return the apply_async options of the tasks of the message by its priority.
+
+    CARRIER_PRIORITY_QUEUES maps priorities to queues and CARRIER_TASK_PRIORITIES to broker message priorities.
+    Priorities not listed use the default routing.
+    """
+    options = {}
+
+    queue = getattr(settings, 'CARRIER_PRIORITY_QUEUES', {}).get(message.priority.value)
+    if queue:
+        options['queue'] = queue
+
+    priority = getattr(settings, 'CARRIER_TASK_PRIORITIES', {}).get(message.priority.value)
+    if priority is not None:
+        options['priority'] = priority
+
+    return options
+
+
+def queue_message(message):
+    """
+    Queue a new message for preparation.
+
+    Messages scheduled more than CARRIER_SCHEDULE_PREPARE_AHEAD seconds from now are left for
+    dispatch_scheduled_messages, the others are claimed, prepared right away and delivered at send_at.
+    """
+    prepare_ahead = getattr(settings, 'CARRIER_SCHEDULE_PREPARE_AHEAD', 15 * 60)
+
+    if message.send_at and message.send_at > timezone.now() + timedelta(seconds=prepare_ahead):
+        logger.info('Message {} is scheduled at {}'.format(message.id, message.send_at))
+        return
+
+    # Claimed messages are no longer pending, so dispatch_scheduled_messages doesn't queue them again
+    claim_token = Message.claim_for_preparation(message.id)
+    if not claim_token:
+        logger.warning(' Message "{}" is not pending. Skipping.'.format(message.id))
+        return
+
+    prepare_message.apply_async((message.id,), {'claim_token': str(claim_token)}, **get_task_options(message))
+
+
+@shared_task
+def dispatch_scheduled_messages():
+    """
+    Queue the scheduled messages due within CARRIER_SCHEDULE_PREPARE_AHEAD seconds.
+
+    Meant to be run periodically, see CELERY_BEAT_SCHEDULE. The messages are claimed CARRIER_SCHEDULE_BATCH_SIZE
+    at a time and prepared right away, so large messages are ready when their delivery is released at send_at.
+    Prepared messages still waiting CARRIER_SCHEDULE_RELEASE_DELAY seconds after send_at are released again in
+    case the release was lost, and again every CARRIER_CLAIM_TIMEOUT seconds while they keep waiting.
+    """
+    now = timezone.now()
+    prepare_ahead = getattr(settings, 'CARRIER_SCHEDULE_PREPARE_AHEAD', 15 * 60)
+    batch_size = getattr(settings, 'CARRIER_SCHEDULE_BATCH_SIZE', 100)
+    release_delay = getattr(settings, 'CARRIER_SCHEDULE_RELEASE_DELAY', 60)
+
+    scheduled_messages = Message.get_due_messages(now + timedelta(seconds=prepare_ahead)).filter(
+        status=MessageStatus.PENDING_INFO, send_at__isnull=False)
+
+    while True:
+        claim_token = uuid.uuid4()
+        message_ids = Message.claim_for_sending(batch_size, scheduled_messages, claim_token=claim_token)
+        if not message_ids:
+            break
+
+        for message in Message.objects.filter(id__in=message_ids).only('id', 'priority'):
+            prepare_message.apply_async(
+                (message.id,), {'claim_token': str(claim_token)}, **get_task_options(message))
+
+    # claimed_at is the time the delivery was last queued. Deliveries queued before send_at were due to be released
+    # at send_at, deliveries queued later are queued again only when they have been waiting for the claim timeout.
+    overdue_messages = Message.objects.filter(
+        status=MessageStatus.READY_TO_SEND, send_at__lt=now - timedelta(seconds=release_delay)
+    ).filter(Q(claimed_at__isnull=True) | Q(claimed_at__lt=F('send_at')) | Q(claimed_at__lt=now - timedelta(
+        seconds=getattr(settings, 'CARRIER_CLAIM_TIMEOUT', 30 * 60))))
+
+    for message in list(overdue_messages.only('id', 'priority')):
+        # Another sweep may have released the message in the meantime
+        if not overdue_messages.filter(pk=message.id).update(claimed_at=timezone.now()):
+            continue
+
+        logger.warning(' Message "{}" was not released at its send time. Releasing it.'.format(message.id))
+        send_message.apply_async((message.id,), **get_task_options(message))
+
+
+@shared_task(bind=True)
+def prepare_message(self, message_id, claim_token=None):
+    """
+    Fetch the contact info of the recipients and validate them, moving the message to READY_TO_SEND.
+
+    The message is in FETCHING_INFO while it is being prepared. A pending message is claimed by the task,
+    a message claimed by the caller is handed over with claim_token. Messages that can't be claimed are
+    being prepared by someone else and are skipped. The delivery is queued with send_message when the
+    preparation is done or, if the message is scheduled later, at send_at.
+
+    If some of the contact info can't be fetched, the message is not validated and the task is retried with
+    capped exponential backoff. Only the recipients still missing their contact info are fetched again.
+    """
+    logger.info('Preparing message {}'.format(message_id))
+    transports = get_transports()
+
+    if not transports:
+        logger.error('No transports found! Please set CARRIER_TRANSPORT_CLASSES setting.')
+        return
+
+    claim_token = Message.claim_for_preparation(message_id, claim_token)
+    if not claim_token:
+        logger.warning(' Message "{}" does not exist or is not pending or claimed for this task. Skipping.'.format(
+            message_id))
+        return
+
+    message = Message.objects.get(pk=message_id)
+
+    with collect_metrics() as metrics:
+        errors = message.fetch_contact_info_for_recipients()
+
+        # Recipients without their contact info would be ignored, so the message is validated only when complete
+        if not errors:
+            message.attach_contacts_to_recipients()
+            message.validate_recipients(transports)
+
+    SendReport.add(message.id, metrics.get_data())
+
+    if errors:
+        retry_preparation(self, message, claim_token, errors)
+        return
+
+    if not message.is_sendable():
+        logger.warning(' Message "{}" Errors: {}.'.format(message_id, ', '.join(message.get_validation_errors())))
+        message.status = MessageStatus.ERROR
+        message.save()
+        return
+
+    # The time the delivery is queued tells dispatch_scheduled_messages whether it is still on its way
+    Message.objects.filter(pk=message.pk).update(claimed_at=timezone.now())
+
+    if not message.is_due():
+        logger.info(' Message "{}" prepared. Releasing it at {}.'.format(message_id, message.send_at))
+        send_message.apply_async((message.id,), eta=message.send_at, **get_task_options(message))
+        return
+
+    send_message.apply_async((message.id,), **get_task_options(message))
+
+
+def retry_preparation(task, message, claim_token, errors):
+    """Retry the preparation task, handing the claim of the message over to the retry."""
+    policy = RetryPolicy()
+
+    if not policy.should_retry(task.request.retries):
+        # The message keeps its claim, so recover_messages prepares it again once the claim has expired
+        logger.error(' Message "{}" contact info errors: {}. Giving up until the claim expires.'.format(
+            message.id, ', '.join(errors)))
+        return
+
+    countdown = policy.get_delay(task.request.retries)
+    logger.warning(' Message "{}" contact info errors: {}. Preparing it again in {:.0f} seconds.'.format(
+        message.id, ', '.join(errors), countdown))
+
+    raise task.retry(
+        args=(message.id,),
+        kwargs={'claim_token': str(claim_token)},
+        countdown=countdown,
+        max_retries=policy.max_retries,
+    )
+
+
 @shared_task
 def send_message(message_id):
+    """
+    Fan the delivery of a prepared message out to deliver_recipients subtasks.
+
+    Every subtask sends one chunk of CARRIER_DELIVERY_CHUNK_SIZE recipients using one transport.
+    When all the chunks are done, finish_message sets the final status of the message. Messages
+    that have not been prepared yet are passed to prepare_message.
+    """
     logger.info('Sending message {}'.format(message_id))
     transports = get_transports()
 
@@ -29,22 +220,184 @@ def send_message(message_id):
         logger.warning(' Message "{}" does not exist. Skipping.'.format(message_id))
         return
 
-    if message.status not in [MessageStatus.PENDING_INFO, MessageStatus.READY_TO_SEND]:
-        logger.warning(' Message "{}" status is not "{}" or "{}". Skipping.'.format(
-            message_id, MessageStatus.PENDING_INFO, MessageStatus.READY_TO_SEND))
+    if message.status == MessageStatus.PENDING_INFO:
+        prepare_message.apply_async((message.id,), **get_task_options(message))
+        return
+
+    if message.status != MessageStatus.READY_TO_SEND:
+        logger.warning(' Message "{}" status is not "{}". Skipping.'.format(message_id, MessageStatus.READY_TO_SEND))
+        return
+
+    start_delivery(message, transports)
+
+
+def start_delivery(message, transports):
+    if not message.start_sending():
+        logger.warning(' Message "{}" is already being sent. Skipping.'.format(message.id))
+        return
+
+    chunk_size = getattr(settings, 'CARRIER_DELIVERY_CHUNK_SIZE', 1000)
+    # The chunks are queued with the priority of the message so bulk messages don't hold up urgent ones
+    options = get_task_options(message)
+    chunks = []
+    deliveries = []
+    for transport, recipients in message.route_recipients(transports):
+        if transport is None:
+            logger.warning(' Message "{}": No suitable transport found for {} recipient(s). Skipping.'.format(
+                message.id, len(recipients)))
+            continue
+
+        for recipient_chunk in chunked(recipients, chunk_size):
+            chunk = DeliveryChunk(message=message)
+            chunks.append(chunk)
+            deliveries.append(deliver_recipients.s(
+                str(message.id), get_transport_path(transport), [recipient.id for recipient in recipient_chunk],
+                chunk_id=str(chunk.id),
+            ).set(**options))
+
+    if not deliveries:
+        finish_message([], str(message.id))
         return
 
-    message.fetch_contact_info_for_recipients()
-    message.attach_contacts_to_recipients()
-    message.validate_recipients(transports)
-    result = message.send(transports)
+    # The chunks are stored before they are queued so recover_messages knows they are on their way
+    DeliveryChunk.objects.bulk_create(chunks)
+
+    chord(deliveries)(finish_message.s(str(message.id)).set(**options))
+
+
+@shared_task(bind=True)
+def deliver_recipients(self, message_id, transport_path, recipient_ids, errors=None, chunk_id=None):
+    """
+    Send the message to a chunk of recipients using one transport.
+
+    Recipients that failed because of a retryable error are sent again by retrying the task with capped
+    exponential backoff. The errors of the earlier tries are carried over so the chord gets all of them.
+    The DeliveryChunk given by chunk_id is marked started while the task runs and finished when it is done.
+    """
+    if chunk_id:
+        DeliveryChunk.objects.filter(pk=chunk_id).update(started_at=timezone.now())
+
+    result = send_chunk(self, message_id, transport_path, recipient_ids, list(errors or []), chunk_id)
+
+    if chunk_id:
+        DeliveryChunk.objects.filter(pk=chunk_id).update(finished_at=timezone.now())
+
+    return result
+
+
+def send_chunk(task, message_id, transport_path, recipient_ids, errors, chunk_id):
+    transport = get_transport(transport_path)
+
+    if not transport:
+        return {'errors': errors + ['Transport "{}" is not available.'.format(transport_path)]}
+
+    message = Message.objects.get(pk=message_id)
+    recipients = list(message.recipients.filter(
+        id__in=recipient_ids, status=RecipientStatus.READY_TO_SEND).select_related('contact'))
 
-    if result.sent:
+    if not recipients:
+        return {'errors': errors}
+
+    try:
+        with collect_metrics() as metrics:
+            result = message.send_to_recipients(transport, recipients)
+    except Exception as e:
+        # The results of every chunk are needed for finish_message to run, so report unexpected errors as results
+        logger.exception(' Message "{}": Sending to {} recipient(s) failed.'.format(message_id, len(recipients)))
+        return {'errors': errors + ['Error when trying to send message "{}" to {} recipient(s): "{}"'.format(
+            message_id, len(recipients), e)]}
+    finally:
+        SendReport.add(message.id, metrics.get_data())
+
+    errors.extend(result['errors'])
+
+    retry_recipient_ids = result.get('retry_recipient_ids')
+    if retry_recipient_ids:
+        policy = RetryPolicy()
+
+        if policy.should_retry(task.request.retries):
+            countdown = policy.get_delay(task.request.retries, result.get('retry_after'))
+            logger.warning(' Message "{}": Sending to {} recipient(s) again in {:.0f} seconds.'.format(
+                message_id, len(retry_recipient_ids), countdown))
+
+            if chunk_id:
+                # The chunk waits in the queue again until the retry starts
+                DeliveryChunk.objects.filter(pk=chunk_id).update(started_at=None)
+
+            raise task.retry(
+                args=(message_id, transport_path, retry_recipient_ids),
+                kwargs={'errors': errors, 'chunk_id': chunk_id},
+                countdown=countdown,
+                max_retries=policy.max_retries,
+            )
+
+        errors.extend(message.fail_retries(result))
+
+    return {'errors': errors}
+
+
+@shared_task
+def finish_message(results, message_id):
+    errors = [error for result in results for error in result['errors']]
+
+    message = Message.objects.get(pk=message_id)
+    message.finish_sending(errors)
+
+    if errors:
+        logger.warning(' Message "{}" Errors: {}.'.format(message_id, ', '.join(errors)))
+    else:
         logger.info(' Message "{}" Sent.'.format(message_id))
-        message.status = MessageStatus.SENT
 
-    if result.errors:
-        logger.warning(' Message "{}" Errors: {}.'.format(message_id, ', '.join(result.errors)))
-        message.status = MessageStatus.ERROR
 
-    message.save()
+@shared_task
+def recover_messages():
+    """
+    Queue again the messages whose sending stalled, e.g. because a worker died in the middle of a chunk.
+
+    Meant to be run periodically, see CELERY_BEAT_SCHEDULE. Recipients claimed more than CARRIER_CLAIM_TIMEOUT
+    seconds ago are made ready to send again and messages sending for longer than that without recent claims or
+    queued or recently started delivery chunks are queued again.
+    Messages whose preparation stalled are prepared again.
+    Recipients that have been sent are never sent again.
+    """
+    expired_before = timezone.now() - timedelta(seconds=getattr(settings, 'CARRIER_CLAIM_TIMEOUT', 30 * 60))
+
+    recover_preparations(expired_before)
+
+    released = Recipient.release_expired_claims(expired_before)
+    if released:
+        logger.warning('Released {} expired recipient claim(s).'.format(released))
+
+    # Chunks still waiting in a queue or for a retry have not claimed their recipients yet
+    stalled_messages = Message.objects.filter(status=MessageStatus.SENDING).filter(
+        Q(sending_started_at__lt=expired_before) | Q(sending_started_at__isnull=True)
+    ).exclude(recipients__claimed_at__gte=expired_before).exclude(
+        id__in=DeliveryChunk.get_active_chunks(expired_before).values('message_id'))
+
+    for message in stalled_messages:
+        if message.recipients.filter(status=RecipientStatus.READY_TO_SEND).exists():
+            logger.warning(' Message "{}" stalled while sending. Queuing it again.'.format(message.id))
+            message.status = MessageStatus.READY_TO_SEND
+            message.save()
+            send_message.apply_async((message.id,), **get_task_options(message))
+            continue
+
+        # Every recipient has a result, only the final status of the message is missing
+        errors = []
+        if message.recipients.filter(status=RecipientStatus.ERROR).exists():
+            errors.append('Sending to some of the recipients failed.')
+
+        message.finish_sending(errors)
+
+
+def recover_preparations(expired_before):
+    """Queue again the messages claimed for preparation before expired_before that never got ready to send."""
+    expired_claims = Message.objects.filter(status=MessageStatus.FETCHING_INFO, claimed_at__lt=expired_before)
+
+    for message in list(expired_claims.only('id', 'priority')):
+        # The claim may have been finished or renewed in the meantime
+        claim_token = uuid.uuid4()
+        if expired_claims.filter(pk=message.id).update(claim_token=claim_token, claimed_at=timezone.now()):
+            logger.warning(' Message "{}" stalled while preparing. Queuing it again.'.format(message.id))
+            prepare_message.apply_async(
+                (message.id,), {'claim_token': str(claim_token)}, **get_task_options(message))
@@ -1,7 +1,9 @@
 import factory
+import pytest
 from pytest_factoryboy import register
 
 from carrier.models import Contact, Content, Message, Recipient
+from messaging import celery_app
 
 
 @register
@@ -26,3 +28,10 @@ class MessageFactory(factory.DjangoModelFactory):
 class RecipientFactory(factory.DjangoModelFactory):
     class Meta:
         model = Recipient
+
+
+@pytest.fixture
+def celery_eager():
+    celery_app.conf.task_always_eager = True
+    yield
+    celery_app.conf.task_always_eager = False
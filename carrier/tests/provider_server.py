@@ -0,0 +1,110 @@
+"""Local stand-ins for the HTTP APIs of the providers and the contact info service, used by the benchmarks."""
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+CONTACT_METHODS = ('email', 'firebase', 'pushbullet', 'sms')
+
+
+def get_contact_info(user_id):
+    """Return the contact info of the user, spreading the users evenly over the contact methods."""
+    contact_method = CONTACT_METHODS[uuid.UUID(user_id).int % len(CONTACT_METHODS)]
+
+    contact_info = {
+        'language': random.choice(['fi', 'sv', 'en']),
+        'contact_method': contact_method,
+    }
+
+    if contact_method == 'email':
+        contact_info['email'] = '{}@example.com'.format(user_id)
+    elif contact_method == 'sms':
+        contact_info['phone'] = '+358401234567'
+    else:
+        contact_info[contact_method] = 'token-{}'.format(user_id)
+
+    return contact_info
+
+
+class ProviderRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive needs HTTP/1.1
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, handler):
+        self.server.requests += 1
+        time.sleep(self.server.latency)
+
+        if random.random() < self.server.error_rate:
+            self.send_json({'error': 'Temporary error'}, status=503)
+            return
+
+        self.send_json(handler())
+
+    def do_GET(self):
+        url = urlparse(self.path)
+
+        if url.path == '/contact_info/':
+            ids = parse_qs(url.query)['ids'][0].split(',')
+            self.handle_request(lambda: {user_id: get_contact_info(user_id) for user_id in ids})
+        else:
+            self.send_json({}, status=404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+
+        if self.path.startswith('/mailgun/'):
+            self.handle_request(lambda: {'id': '<1@example.com>', 'message': 'Queued. Thank you.'})
+        elif self.path == '/pushbullet/pushes':
+            self.handle_request(lambda: {'active': True})
+        elif self.path == '/fcm/send':
+            payload = json.loads(body.decode())
+            tokens = payload.get('registration_ids', [payload.get('to')])
+            self.handle_request(lambda: {'results': [self.get_fcm_result() for _ in tokens]})
+        else:
+            self.send_json({}, status=404)
+
+    def get_fcm_result(self):
+        if random.random() < self.server.error_rate:
+            return {'error': 'NotRegistered'}
+
+        return {'message_id': '0:1'}
+
+
+class ProviderServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server emulating Mailgun, FCM, Pushbullet and the contact info endpoint.
+
+    Every request waits for latency seconds and fails with the probability error_rate. The server listens
+    on a free local port in a background thread, its root URL is in url.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0, error_rate=0):
+        super().__init__(('127.0.0.1', 0), ProviderRequestHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
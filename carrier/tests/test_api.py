@@ -0,0 +1,152 @@
+import uuid
+from datetime import timedelta
+from unittest import mock
+
+import pytest
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from carrier.enums import MessageStatus
+from carrier.models import Message
+
+
+@pytest.fixture
+def api_client():
+    client = APIClient()
+    client.force_authenticate(User.objects.create(username='test'))
+
+    return client
+
+
+@pytest.mark.django_db
+def test_create_message_sends(api_client):
+    data = {
+        "recipients": [{"email": "test@example.com"}],
+        "contents": [{"language": "fi", "subject": "Subject"}],
+    }
+
+    with mock.patch('carrier.tasks.prepare_message.apply_async') as prepare_message:
+        response = api_client.post('/v1/message/', data, format='json')
+
+    assert response.status_code == 201
+    message = Message.objects.get()
+    prepare_message.assert_called_once_with((message.id,), {'claim_token': str(message.claim_token)})
+    assert message.status == MessageStatus.FETCHING_INFO
+    assert response.data['status'] == message.status.value
+
+
+@pytest.mark.django_db
+def test_create_scheduled_message(settings, api_client):
+    settings.CARRIER_SCHEDULE_PREPARE_AHEAD = 60 * 60
+    data = {
+        "recipients": [{"email": "test@example.com"}],
+        "contents": [{"language": "fi", "subject": "Subject"}],
+    }
+
+    with mock.patch('carrier.tasks.prepare_message.apply_async') as prepare_message:
+        data['send_at'] = (timezone.now() + timedelta(minutes=30)).isoformat()
+        response = api_client.post('/v1/message/', data, format='json')
+        assert response.status_code == 201
+        prepare_message.assert_called_once_with((uuid.UUID(response.data['id']),), {'claim_token': mock.ANY})
+
+        prepare_message.reset_mock()
+
+        # Messages scheduled later are queued by dispatch_scheduled_messages
+        data['send_at'] = (timezone.now() + timedelta(days=1)).isoformat()
+        response = api_client.post('/v1/message/', data, format='json')
+        assert response.status_code == 201
+        assert not prepare_message.called
+
+
+@pytest.mark.django_db
+def test_create_message_priority(settings, api_client):
+    settings.CARRIER_PRIORITY_QUEUES = {'high': 'urgent'}
+    data = {
+        "recipients": [{"email": "test@example.com"}],
+        "contents": [{"language": "fi", "subject": "Subject"}],
+        "priority": "high",
+    }
+
+    with mock.patch('carrier.tasks.prepare_message.apply_async') as prepare_message:
+        response = api_client.post('/v1/message/', data, format='json')
+
+    assert response.status_code == 201
+    assert response.data['priority'] == 'high'
+    prepare_message.assert_called_once_with((Message.objects.get().id,), {'claim_token': mock.ANY}, queue='urgent')
+
+
+@pytest.mark.django_db
+def test_upload_recipients(api_client, contact_factory):
+    contact = contact_factory(id=uuid.uuid4())
+
+    with mock.patch('carrier.tasks.prepare_message.apply_async') as prepare_message:
+        response = api_client.post('/v1/message/', {"contents": [{"language": "fi"}]}, format='json')
+
+        assert response.status_code == 201
+        assert response.data['status'] == MessageStatus.DRAFT.value
+        message = Message.objects.get()
+
+        ndjson = '{{"uuid": "{}"}}\n\n{{"email": "test@example.com", "language": "sv"}}\n'.format(contact.id)
+        response = api_client.post('/v1/message/{}/recipients/'.format(message.id), ndjson,
+                                   content_type='application/x-ndjson')
+
+        assert response.status_code == 201
+        assert response.data == {'created': 2}
+
+        csv_data = 'email,phone,language\ntest2@example.com,,fi\n,+358401234567,\n'
+        response = api_client.post('/v1/message/{}/recipients/'.format(message.id), csv_data,
+                                   content_type='text/csv')
+
+        assert response.status_code == 201
+        assert response.data == {'created': 2}
+        assert not prepare_message.called
+
+        response = api_client.post('/v1/message/{}/finalize/'.format(message.id))
+
+        assert response.status_code == 200
+        assert response.data['status'] == MessageStatus.FETCHING_INFO.value
+        assert Message.objects.get(pk=message.id).status == MessageStatus.FETCHING_INFO
+        prepare_message.assert_called_once_with((message.id,), {'claim_token': mock.ANY})
+
+    assert message.recipients.count() == 4
+    assert message.recipients.get(uuid=contact.id).contact == contact
+    assert message.recipients.get(phone='+358401234567').language is None
+
+    response = api_client.post('/v1/message/{}/recipients/'.format(message.id), '{"email": "late@example.com"}',
+                               content_type='application/x-ndjson')
+
+    assert response.status_code == 400
+    assert message.recipients.count() == 4
+
+
+@pytest.mark.django_db
+def test_upload_invalid_recipients(api_client, message_factory):
+    message = message_factory(status=MessageStatus.DRAFT)
+
+    ndjson = '{"email": "test@example.com"}\n{"language": "fi"}\n'
+    response = api_client.post('/v1/message/{}/recipients/'.format(message.id), ndjson,
+                               content_type='application/x-ndjson')
+
+    assert response.status_code == 400
+    assert list(response.data) == ['line 2']
+    assert message.recipients.count() == 0
+
+    response = api_client.post('/v1/message/{}/recipients/'.format(message.id), '{"email": ',
+                               content_type='application/x-ndjson')
+
+    assert response.status_code == 400
+
+    response = api_client.post('/v1/message/{}/recipients/'.format(message.id), '<xml/>',
+                               content_type='application/xml')
+
+    assert response.status_code == 415
+
+
+@pytest.mark.django_db
+def test_finalize_without_recipients(api_client, message_factory):
+    message = message_factory(status=MessageStatus.DRAFT)
+
+    response = api_client.post('/v1/message/{}/finalize/'.format(message.id))
+
+    assert response.status_code == 400
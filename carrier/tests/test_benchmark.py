@@ -0,0 +1,132 @@
+"""
+Throughput benchmarks of sending a message through the whole send_message pipeline.
+
+The providers are emulated by a local ProviderServer. The benchmarks are skipped unless the CARRIER_BENCHMARK
+environment variable is set, e.g.
+
+    CARRIER_BENCHMARK=1 CARRIER_BENCHMARK_SIZES=1000,10000 py.test carrier/tests/test_benchmark.py
+
+CARRIER_BENCHMARK_LATENCY sets the latency of the providers in seconds and CARRIER_BENCHMARK_ERROR_RATE the
+share of failing provider requests.
+"""
+import os
+import time
+import tracemalloc
+import uuid
+
+import pytest
+
+from carrier.enums import MessageStatus, RecipientStatus
+from carrier.metrics import count_queries
+from carrier.models import Contact, Content, Recipient, SendReport
+from carrier.tasks import send_message
+from carrier.tests.provider_server import ProviderServer, get_contact_info
+
+pytestmark = pytest.mark.skipif(not os.environ.get('CARRIER_BENCHMARK'), reason='CARRIER_BENCHMARK is not set')
+
+SIZES = [int(size) for size in os.environ.get('CARRIER_BENCHMARK_SIZES', '1000,10000,100000').split(',')]
+
+
+@pytest.fixture
+def provider_server(settings):
+    server = ProviderServer(
+        latency=float(os.environ.get('CARRIER_BENCHMARK_LATENCY', 0.01)),
+        error_rate=float(os.environ.get('CARRIER_BENCHMARK_ERROR_RATE', 0.01)),
+    )
+    server.start()
+
+    settings.CONTACT_INFO_URL = server.url + '/contact_info/'
+    settings.CONTACT_INFO_CACHE = None
+    settings.MAILGUN_API_URL = server.url + '/mailgun'
+    settings.MAILGUN_DOMAIN = 'example.com'
+    settings.MAILGUN_API_KEY = 'key'
+    settings.PUSHBULLET_API_URL = server.url + '/pushbullet/pushes'
+    settings.FIREBASE_API_URL = server.url + '/fcm/send'
+    settings.FIREBASE_API_KEY = 'key'
+    settings.CARRIER_TRANSPORT_CLASSES = [
+        'carrier.transports.FirebaseMessagingTransport',
+        'carrier.transports.PushbulletTransport',
+        'carrier.transports.MailGunTransport',
+    ]
+    settings.CARRIER_RATE_LIMITS = {}
+    # Eager chords can't wait for delayed retries
+    settings.CARRIER_RETRY_MAX_RETRIES = 0
+
+    yield server
+
+    server.stop()
+
+
+def create_message(message_factory, recipient_count):
+    """
+    Create a message whose recipients are split evenly into recipients with their own email address, users
+    whose contact info is fetched and users whose contact info is stored already.
+    """
+    message = message_factory()
+    Content.objects.bulk_create(
+        Content(message=message, language=language, subject='Subject', text='Text', short_text='Short text')
+        for language in ['fi', 'sv', 'en']
+    )
+
+    recipients = []
+    contacts = []
+    for i in range(recipient_count):
+        if i % 3 == 0:
+            recipients.append(Recipient(message=message, email='recipient{}@example.com'.format(i)))
+            continue
+
+        user_id = uuid.uuid4()
+        recipients.append(Recipient(message=message, uuid=user_id))
+
+        if i % 3 == 2:
+            contacts.append(Contact(id=user_id, **Contact.get_values_from_contact_info(
+                get_contact_info(str(user_id)))))
+
+    Contact.objects.bulk_create(contacts)
+    Recipient.bulk_create_with_contacts(recipients)
+
+    return message
+
+
+def print_report(recipient_count, seconds, queries, peak_memory, report, server):
+    lines = [
+        '',
+        'Sent {} recipients in {:.2f} s ({:.0f} recipients/s), {} queries, peak memory {:.1f} MiB, '
+        '{} provider requests'.format(recipient_count, seconds, recipient_count / seconds, queries,
+                                      peak_memory / 1024 / 1024, server.requests),
+        '{:<50} {:>6} {:>10} {:>8} {:>11}'.format('Stage', 'Runs', 'Seconds', 'Queries', 'Recipients'),
+    ]
+
+    stages = sorted(report['stages'].items())
+    stages.extend(('send ' + path.split('.')[-1], values) for path, values in sorted(report['transports'].items()))
+
+    for name, values in stages:
+        lines.append('{:<50} {:>6} {:>10.3f} {:>8} {:>11}'.format(
+            name, values['runs'], values['seconds'], values['queries'], values['recipients']))
+
+    print('\n'.join(lines))
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('recipient_count', SIZES)
+def test_send_message_throughput(capsys, celery_eager, provider_server, message_factory, recipient_count):
+    message = create_message(message_factory, recipient_count)
+
+    tracemalloc.start()
+    started_at = time.perf_counter()
+
+    with count_queries() as counter:
+        send_message(message.id)
+
+    seconds = time.perf_counter() - started_at
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    message.refresh_from_db()
+    assert message.status in (MessageStatus.SENT, MessageStatus.ERROR)
+    assert not message.recipients.filter(
+        status__in=[RecipientStatus.PENDING_INFO, RecipientStatus.READY_TO_SEND, RecipientStatus.SENDING]).exists()
+
+    with capsys.disabled():
+        print_report(recipient_count, seconds, counter.count, peak_memory,
+                     SendReport.get_message_data(message.id), provider_server)
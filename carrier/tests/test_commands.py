@@ -0,0 +1,217 @@
+import threading
+import uuid
+from datetime import timedelta
+from unittest import mock
+
+import pytest
+import requests_mock
+from django.core.management import call_command
+from django.utils import timezone
+
+from carrier.enums import MessageStatus, RecipientStatus
+from carrier.management.commands.send_messages import Command
+from carrier.models import Message
+from carrier.tasks import recover_messages
+from carrier.tests.test_tasks import EmailTransport
+
+
+@pytest.fixture
+def email_transport(settings):
+    settings.CARRIER_TRANSPORT_CLASSES = ['carrier.tests.test_tasks.EmailTransport']
+    EmailTransport.sent_chunks = []
+    EmailTransport.temporary_failures = 0
+
+
+def create_message(message_factory, recipient_factory, content_factory, email, **kwargs):
+    message = message_factory(**kwargs)
+    content_factory(message=message, language='fi')
+    recipient_factory(message=message, email=email)
+
+    return message
+
+
+@pytest.mark.django_db
+def test_send_messages_command(email_transport, message_factory, recipient_factory, content_factory):
+    pending = create_message(message_factory, recipient_factory, content_factory, 'pending@example.com')
+    ready = create_message(message_factory, recipient_factory, content_factory, 'ready@example.com',
+                           status=MessageStatus.READY_TO_SEND)
+    claimed = create_message(message_factory, recipient_factory, content_factory, 'claimed@example.com',
+                             status=MessageStatus.FETCHING_INFO, claimed_at=timezone.now())
+
+    call_command('send_messages', '--batch-size', '1')
+
+    assert len(EmailTransport.sent_chunks) == 2
+
+    for message in (pending, ready):
+        message.refresh_from_db()
+        assert message.status == MessageStatus.SENT
+        assert message.recipients.get().status == RecipientStatus.SENT
+
+    claimed.refresh_from_db()
+    assert claimed.status == MessageStatus.FETCHING_INFO
+    assert claimed.recipients.get().status == RecipientStatus.PENDING_INFO
+
+
+@pytest.mark.django_db
+def test_send_messages_command_limit(email_transport, message_factory, recipient_factory, content_factory):
+    for i in range(3):
+        create_message(message_factory, recipient_factory, content_factory, 'test{}@example.com'.format(i))
+
+    call_command('send_messages', '--limit', '2')
+
+    assert len(EmailTransport.sent_chunks) == 2
+    assert Message.objects.filter(status=MessageStatus.SENT).count() == 2
+    assert Message.objects.filter(status=MessageStatus.PENDING_INFO).count() == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_send_messages_command_workers(email_transport, message_factory, recipient_factory, content_factory):
+    messages = [create_message(message_factory, recipient_factory, content_factory, 'test{}@example.com'.format(i))
+                for i in range(5)]
+
+    # The in-memory SQLite test database can't be written by several threads at once
+    database_lock = threading.Lock()
+    claim_sizes = []
+    claim_for_sending = Message.claim_for_sending
+    send_message = Command.send_message
+
+    def claim_for_sending_locked(limit, messages):
+        claim_sizes.append(limit)
+        with database_lock:
+            return claim_for_sending(limit, messages)
+
+    def send_message_locked(self, message_id, transports):
+        with database_lock:
+            return send_message(self, message_id, transports)
+
+    with mock.patch.object(Message, 'claim_for_sending', side_effect=claim_for_sending_locked), \
+            mock.patch.object(Command, 'send_message', autospec=True, side_effect=send_message_locked), \
+            mock.patch('carrier.management.commands.send_messages.connection') as connection:
+        call_command('send_messages', '--workers', '3', '--batch-size', '10')
+
+    # Every message is sent exactly once
+    assert sorted(EmailTransport.sent_chunks) == sorted([message.recipients.get().id] for message in messages)
+
+    for message in messages:
+        message.refresh_from_db()
+        assert message.status == MessageStatus.SENT
+
+    # No more messages are claimed at a time than there are idle workers
+    assert claim_sizes[0] == 3
+    assert all(0 < claim_size <= 3 for claim_size in claim_sizes)
+
+    # Every thread closes its database connection
+    assert connection.close.call_count == 5
+
+
+@pytest.mark.django_db
+def test_send_messages_command_message_ids(capsys, email_transport, message_factory, recipient_factory,
+                                           content_factory):
+    selected = create_message(message_factory, recipient_factory, content_factory, 'selected@example.com')
+    other = create_message(message_factory, recipient_factory, content_factory, 'other@example.com')
+    sent = create_message(message_factory, recipient_factory, content_factory, 'sent@example.com',
+                          status=MessageStatus.SENT)
+
+    call_command('send_messages', str(selected.id), str(sent.id))
+
+    selected.refresh_from_db()
+    assert selected.status == MessageStatus.SENT
+
+    other.refresh_from_db()
+    assert other.status == MessageStatus.PENDING_INFO
+
+    out, _ = capsys.readouterr()
+    assert 'Message "{}" does not exist, is scheduled later or its status'.format(sent.id) in out
+
+
+@pytest.mark.django_db
+def test_send_messages_command_skips_message_started_elsewhere(capsys, email_transport, message_factory,
+                                                               recipient_factory, content_factory):
+    message = create_message(message_factory, recipient_factory, content_factory, 'test@example.com')
+
+    start_sending = Message.start_sending
+
+    def start_sending_elsewhere(self):
+        # Another worker moves the message to SENDING between validation and sending
+        Message.objects.filter(pk=self.pk).update(status=MessageStatus.SENDING)
+        return start_sending(self)
+
+    with mock.patch.object(Message, 'start_sending', autospec=True, side_effect=start_sending_elsewhere):
+        call_command('send_messages')
+
+    assert EmailTransport.sent_chunks == []
+
+    message.refresh_from_db()
+    assert message.status == MessageStatus.SENDING
+
+    out, _ = capsys.readouterr()
+    assert 'Message "{}" is already being sent. Skipping.'.format(message.id) in out
+
+
+@pytest.mark.django_db
+def test_send_messages_command_contact_info_errors(settings, email_transport, message_factory, recipient_factory,
+                                                   content_factory):
+    settings.CONTACT_INFO_URL = 'http://example.com/'
+
+    message = message_factory()
+    content_factory(message=message, language='fi')
+    recipient = recipient_factory(message=message, uuid=uuid.uuid4())
+
+    with requests_mock.Mocker() as m:
+        m.get(settings.CONTACT_INFO_URL, status_code=503)
+        call_command('send_messages')
+
+    assert EmailTransport.sent_chunks == []
+
+    # The message is left for a later run instead of ignoring the recipients without contact info
+    message.refresh_from_db()
+    assert message.status == MessageStatus.PENDING_INFO
+    assert message.recipients.get(pk=recipient.id).status == RecipientStatus.PENDING_INFO
+
+
+@pytest.mark.django_db
+def test_claim_for_sending(message_factory):
+    first = message_factory()
+    second = message_factory(status=MessageStatus.READY_TO_SEND)
+    message_factory(status=MessageStatus.SENDING)
+
+    assert Message.claim_for_sending(1) == [first.id]
+    assert Message.claim_for_sending(10) == [second.id]
+    assert Message.claim_for_sending(10) == []
+
+    first.refresh_from_db()
+    assert first.status == MessageStatus.FETCHING_INFO
+    assert first.claimed_at is not None
+
+
+@pytest.mark.django_db
+def test_start_sending_only_once(message_factory):
+    message = message_factory(status=MessageStatus.READY_TO_SEND)
+    same_message = Message.objects.get(pk=message.pk)
+
+    assert message.start_sending() is True
+    assert same_message.start_sending() is False
+
+    message.refresh_from_db()
+    assert message.status == MessageStatus.SENDING
+
+
+@pytest.mark.django_db
+def test_recover_messages_prepares_expired_message_claims(settings, message_factory):
+    settings.CARRIER_CLAIM_TIMEOUT = 60
+
+    expired = message_factory(status=MessageStatus.FETCHING_INFO, claimed_at=timezone.now() - timedelta(hours=1))
+    active = message_factory(status=MessageStatus.FETCHING_INFO, claimed_at=timezone.now())
+
+    with mock.patch('carrier.tasks.prepare_message.apply_async') as prepare_message_apply_async:
+        recover_messages()
+
+    expired.refresh_from_db()
+    assert expired.status == MessageStatus.FETCHING_INFO
+    assert expired.claimed_at > timezone.now() - timedelta(minutes=1)
+
+    # The renewed claim is handed over to the new preparation
+    prepare_message_apply_async.assert_called_once_with((expired.id,), {'claim_token': str(expired.claim_token)})
+
+    active.refresh_from_db()
+    assert active.status == MessageStatus.FETCHING_INFO
@@ -0,0 +1,58 @@
+from unittest import mock
+
+from carrier.http import get_client_config, get_session
+from carrier.transports import MailGunTransport, get_transports
+
+
+def test_get_client_config(settings):
+    settings.CARRIER_HTTP_CLIENTS = {
+        'default': {'timeout': 10},
+        'mailgun': {'pool_maxsize': 2},
+    }
+
+    config = get_client_config('mailgun')
+    assert config['timeout'] == 10
+    assert config['pool_maxsize'] == 2
+    assert config['retries'] == 0
+
+    assert get_client_config('unknown')['pool_maxsize'] == 10
+
+
+def test_get_session_is_shared(settings):
+    session = get_session('mailgun')
+    assert get_session('mailgun') is session
+    assert get_session('pushbullet') is not session
+
+    # Changing the configuration creates new sessions
+    settings.CARRIER_HTTP_CLIENTS = {'mailgun': {'pool_maxsize': 2}}
+    assert get_session('mailgun') is not session
+
+
+def test_get_session_after_fork():
+    session = get_session('mailgun')
+
+    with mock.patch('carrier.http.os.getpid', return_value=-1):
+        assert get_session('mailgun') is not session
+
+
+def test_session_default_timeout(settings):
+    settings.CARRIER_HTTP_CLIENTS = {'default': {'timeout': 5}}
+    adapter = get_session().get_adapter('https://example.com/')
+
+    with mock.patch('requests.adapters.HTTPAdapter.send') as send:
+        adapter.send(mock.Mock())
+        adapter.send(mock.Mock(), timeout=1)
+
+    assert [call[1]['timeout'] for call in send.call_args_list] == [5, 1]
+
+
+def test_get_transports_shares_sessions(settings):
+    settings.CARRIER_TRANSPORT_CLASSES = ['carrier.transports.MailGunTransport']
+    settings.MAILGUN_DOMAIN = 'example.com'
+    settings.MAILGUN_API_KEY = 'key'
+
+    transport = get_transports()[0]
+
+    assert transport.get_session() is get_session('mailgun')
+    assert get_transports()[0].get_session() is transport.get_session()
+    assert MailGunTransport().get_session() is transport.get_session()
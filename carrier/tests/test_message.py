@@ -1,12 +1,22 @@
 import json
+import math
 import uuid
+from datetime import timedelta
+from unittest import mock
 
 import pytest
 import requests_mock
+from django.core.cache import caches
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
 from carrier.enums import MessageStatus, RecipientStatus
-from carrier.models import Contact
+from carrier.models import Contact, Recipient
 from carrier.serializers import MessageSerializer
+from carrier.transports import (
+    DummySmsTransport, FirebaseMessagingTransport, MailGunTransport, PushbulletTransport, TransportBase)
+from carrier.utils import get_bulk_create_batch_size
 
 
 @pytest.mark.django_db
@@ -53,6 +63,43 @@ def test_create_message():
     assert len(instance.contents.all()) == 2
 
 
+@pytest.mark.django_db
+def test_create_message_bulk_creates_related(contact_factory):
+    contact = contact_factory(id=uuid.uuid4())
+
+    data = {
+        "recipients": [{"email": "test{}@example.com".format(i)} for i in range(200)] + [{"uuid": str(contact.id)}],
+        "contents": [{"language": "fi", "subject": "Test subject fi"}],
+    }
+
+    serializer = MessageSerializer(data=data)
+    assert serializer.is_valid(raise_exception=True)
+
+    with CaptureQueriesContext(connection) as context:
+        instance = serializer.save()
+
+    # Savepoint, message, contacts, recipients, contents and savepoint release. On databases that limit the
+    # number of query parameters, e.g. SQLite, the recipients are inserted in several batches.
+    recipient_batch_size = get_bulk_create_batch_size(Recipient, list(instance.recipients.all()), 1000)
+    assert len(context.captured_queries) == 5 + math.ceil(201 / recipient_batch_size)
+    assert instance.recipients.count() == 201
+    assert instance.recipients.get(uuid=contact.id).contact == contact
+    assert instance.contents.get().subject == "Test subject fi"
+
+
+@pytest.mark.django_db
+def test_create_message_invalid_recipient():
+    data = {
+        "recipients": [{"email": "test@example.com"}, {"language": "fi"}],
+        "contents": [{"language": "fi"}],
+    }
+
+    serializer = MessageSerializer(data=data)
+
+    assert serializer.is_valid() is False
+    assert 'recipients' in serializer.errors
+
+
 @pytest.mark.django_db
 def test_empty_message_is_not_sendable(message_factory):
     message = message_factory()
@@ -131,6 +178,25 @@ def test_message_get_content_in_language_fallback(settings, message_factory, con
     assert message.get_content_in_language("ff").language == "dd"
 
 
+@pytest.mark.django_db
+def test_content_resolver(settings, message_factory, content_factory):
+    settings.CARRIER_CONTENT_LANGUAGES = ['cc', 'dd', 'ee']
+
+    message = message_factory(status=MessageStatus.READY_TO_SEND)
+    content_dd = content_factory(message=message, language="dd")
+    content_ee = content_factory(message=message, language="ee")
+    content_factory(message=message, language="ee")
+
+    with CaptureQueriesContext(connection) as context:
+        content_resolver = message.get_content_resolver()
+
+        assert content_resolver.get("ee") == content_ee
+        assert content_resolver.get("ff") == content_dd
+        assert content_resolver.get(None) == content_dd
+
+    assert len(context.captured_queries) == 1
+
+
 @pytest.mark.django_db
 def test_fetch_contact_info_for_recipients(settings, message_factory, recipient_factory, contact_factory):
     settings.CONTACT_INFO_URL = 'http://example.com/'
@@ -162,3 +228,272 @@ def test_fetch_contact_info_for_recipients(settings, message_factory, recipient_
     message.attach_contacts_to_recipients()
 
     assert message.recipients.get(pk=recipient1.id).contact.email == "test1@example.com"
+
+
+class PhoneOnlyTransport(TransportBase):
+    def is_suitable_for_recipient(self, recipient):
+        return bool(recipient.get_phone())
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('transport_class', [
+    MailGunTransport, DummySmsTransport, PushbulletTransport, FirebaseMessagingTransport, PhoneOnlyTransport])
+def test_validate_recipients(message_factory, recipient_factory, contact_factory, transport_class):
+    message = message_factory()
+    contacts = [
+        contact_factory(),
+        contact_factory(email='', phone=''),
+        contact_factory(email='contact@example.com'),
+        contact_factory(phone='+358401234567'),
+        contact_factory(pushbullet_access_token='token'),
+        contact_factory(firebase_token='token'),
+    ]
+    recipients = [recipient_factory(message=message, contact=contact) for contact in contacts]
+    recipients.extend([
+        recipient_factory(message=message),
+        recipient_factory(message=message, email=''),
+        recipient_factory(message=message, email='recipient@example.com'),
+        recipient_factory(message=message, phone='+358401234567'),
+    ])
+
+    transport = transport_class()
+    message.validate_recipients([transport])
+
+    for recipient in recipients:
+        recipient.refresh_from_db()
+        expected_status = (RecipientStatus.READY_TO_SEND if transport.is_suitable_for_recipient(recipient)
+                           else RecipientStatus.IGNORED)
+
+        assert recipient.status == expected_status
+
+    assert message.status == MessageStatus.READY_TO_SEND
+
+
+@pytest.mark.django_db
+def test_validate_recipients_query_count(message_factory, recipient_factory, contact_factory):
+    message = message_factory()
+    for i in range(20):
+        recipient_factory(message=message, contact=contact_factory(email='test{}@example.com'.format(i)))
+
+    with CaptureQueriesContext(connection) as context:
+        message.validate_recipients([MailGunTransport(), FirebaseMessagingTransport()])
+
+    assert len(context.captured_queries) == 3
+    assert message.recipients.filter(status=RecipientStatus.READY_TO_SEND).count() == 20
+
+
+@pytest.mark.django_db
+def test_fetch_contact_info_for_recipients_updates_contacts(settings, message_factory, recipient_factory,
+                                                            contact_factory):
+    settings.CONTACT_INFO_URL = 'http://example.com/'
+
+    changed_contact = contact_factory(id=uuid.uuid4(), email='old@example.com', language='fi')
+    new_contact_uuid = uuid.uuid4()
+    no_method_uuid = uuid.uuid4()
+
+    message = message_factory(status=MessageStatus.PENDING_INFO)
+    recipient_factory(message=message, uuid=changed_contact.id)
+    new_recipient = recipient_factory(message=message, uuid=new_contact_uuid)
+    recipient_factory(message=message, uuid=no_method_uuid)
+    # Recipients created before their contact exist are not attached on save
+    message.recipients.update(contact=None)
+
+    data = {
+        str(changed_contact.id): {
+            "email": "new@example.com",
+            "language": "fi",
+            "contact_method": "email"
+        },
+        str(new_contact_uuid): {
+            "firebase": "token",
+            "language": "sv",
+            "contact_method": "firebase"
+        },
+        str(no_method_uuid): {
+            "email": "ignored@example.com",
+        },
+    }
+
+    with requests_mock.Mocker() as m:
+        m.get(settings.CONTACT_INFO_URL, json=data)
+
+        message.fetch_contact_info_for_recipients()
+
+    assert Contact.objects.count() == 2
+    assert Contact.objects.get(pk=changed_contact.id).email == "new@example.com"
+    assert Contact.objects.get(pk=new_contact_uuid).firebase_token == "token"
+
+    assert message.recipients.filter(contact__isnull=False).count() == 2
+    assert message.recipients.get(pk=new_recipient.id).contact_id == new_contact_uuid
+
+
+@pytest.mark.django_db
+def test_upsert_from_contact_info_inserted_concurrently(contact_factory):
+    concurrent_contact = contact_factory(id=uuid.uuid4(), email='old@example.com')
+    new_contact_uuid = uuid.uuid4()
+
+    contact_infos = {
+        str(concurrent_contact.id): {"email": "new@example.com", "contact_method": "email"},
+        str(new_contact_uuid): {"email": "test@example.com", "contact_method": "email"},
+    }
+
+    # Another preparation inserts the contact after it has been looked up
+    with mock.patch.object(Contact.objects, 'in_bulk', return_value={}):
+        contact_ids = Contact.upsert_from_contact_info(contact_infos)
+
+    assert set(contact_ids) == {concurrent_contact.id, new_contact_uuid}
+    assert Contact.objects.count() == 2
+    assert Contact.objects.get(pk=concurrent_contact.id).email == 'new@example.com'
+    assert Contact.objects.get(pk=new_contact_uuid).email == 'test@example.com'
+
+
+@pytest.mark.django_db
+def test_fetch_contact_info_for_recipients_pages(settings, message_factory, recipient_factory):
+    settings.CONTACT_INFO_URL = 'http://example.com/'
+    settings.CONTACT_INFO_PAGE_SIZE = 2
+
+    contact_uuids = sorted(str(uuid.uuid4()) for _ in range(5))
+
+    message = message_factory(status=MessageStatus.PENDING_INFO)
+    for contact_uuid in contact_uuids:
+        recipient_factory(message=message, uuid=contact_uuid)
+
+    def contact_info_response(request, context):
+        ids = request.qs['ids'][0].split(',')
+
+        if contact_uuids[0] in ids:
+            context.status_code = 404
+            return {}
+
+        return {contact_id: {"email": "{}@example.com".format(contact_id), "contact_method": "email"}
+                for contact_id in ids}
+
+    with requests_mock.Mocker() as m:
+        m.get(settings.CONTACT_INFO_URL, json=contact_info_response)
+
+        errors = message.fetch_contact_info_for_recipients()
+
+        assert m.call_count == 3
+
+    assert len(errors) == 1
+    assert set(str(v) for v in Contact.objects.values_list('id', flat=True)) == set(contact_uuids[2:])
+    assert message.recipients.filter(contact__isnull=False).count() == 3
+
+
+@pytest.mark.django_db
+def test_fetch_contact_info_for_recipients_ttl(settings, message_factory, recipient_factory, contact_factory):
+    settings.CONTACT_INFO_URL = 'http://example.com/'
+    settings.CONTACT_INFO_TTL = 60 * 60
+
+    fresh_contact = contact_factory(id=uuid.uuid4(), email='fresh@example.com', fetched_at=timezone.now())
+    stale_contact = contact_factory(id=uuid.uuid4(), email='stale@example.com',
+                                    fetched_at=timezone.now() - timedelta(hours=2))
+
+    message = message_factory(status=MessageStatus.PENDING_INFO)
+    fresh_recipient = recipient_factory(message=message, uuid=fresh_contact.id)
+    recipient_factory(message=message, uuid=stale_contact.id)
+    message.recipients.update(contact=None)
+
+    data = {
+        str(stale_contact.id): {
+            "email": "updated@example.com",
+            "contact_method": "email"
+        },
+    }
+
+    with requests_mock.Mocker() as m:
+        m.get('{}?ids={}'.format(settings.CONTACT_INFO_URL, stale_contact.id), json=data)
+
+        assert message.fetch_contact_info_for_recipients() == []
+        assert m.call_count == 1
+
+    stale_contact.refresh_from_db()
+    assert stale_contact.email == "updated@example.com"
+    assert stale_contact.fetched_at > timezone.now() - timedelta(minutes=1)
+    assert message.recipients.get(pk=fresh_recipient.id).contact == fresh_contact
+    assert message.recipients.filter(contact__isnull=True).count() == 0
+
+    with requests_mock.Mocker() as m:
+        message.fetch_contact_info_for_recipients()
+
+        assert m.call_count == 0
+
+
+@pytest.mark.django_db
+def test_fetch_contact_info_for_recipients_without_contact_method(settings, message_factory, recipient_factory,
+                                                                  contact_factory):
+    settings.CONTACT_INFO_URL = 'http://example.com/'
+    settings.CONTACT_INFO_TTL = 60 * 60
+
+    stale_contact = contact_factory(id=uuid.uuid4(), email='stale@example.com', language='fi',
+                                    fetched_at=timezone.now() - timedelta(hours=2))
+
+    message = message_factory(status=MessageStatus.PENDING_INFO)
+    recipient = recipient_factory(message=message, uuid=stale_contact.id)
+    assert recipient.contact_id == stale_contact.id
+
+    data = {
+        str(stale_contact.id): {
+            "email": "stale@example.com",
+            "contact_method": None
+        },
+    }
+
+    with requests_mock.Mocker() as m:
+        m.get(settings.CONTACT_INFO_URL, json=data)
+
+        assert message.fetch_contact_info_for_recipients() == []
+
+    # The outdated contact info is no longer used for sending
+    stale_contact.refresh_from_db()
+    assert stale_contact.email is None
+    assert stale_contact.language is None
+    assert stale_contact.fetched_at > timezone.now() - timedelta(minutes=1)
+
+    message.attach_contacts_to_recipients()
+    message.validate_recipients([MailGunTransport()])
+    assert message.recipients.get(pk=recipient.id).status == RecipientStatus.IGNORED
+
+    # and it is not fetched again before it goes stale
+    with requests_mock.Mocker() as m:
+        message.fetch_contact_info_for_recipients()
+
+        assert m.call_count == 0
+
+
+@pytest.fixture
+def contact_info_cache(settings):
+    settings.CONTACT_INFO_CACHE = 'default'
+    yield caches['default']
+    caches['default'].clear()
+
+
+@pytest.mark.django_db
+def test_fetch_contact_info_for_recipients_cache(settings, contact_info_cache, message_factory, recipient_factory):
+    settings.CONTACT_INFO_URL = 'http://example.com/'
+
+    contact_uuid = uuid.uuid4()
+    message = message_factory(status=MessageStatus.PENDING_INFO)
+    recipient_factory(message=message, uuid=contact_uuid)
+
+    data = {
+        str(contact_uuid): {
+            "email": "test1@example.com",
+            "contact_method": "email"
+        }
+    }
+
+    with requests_mock.Mocker() as m:
+        m.get(settings.CONTACT_INFO_URL, json=data)
+
+        message.fetch_contact_info_for_recipients()
+
+    # The contact is fetched from the cache even if it is missing from the database
+    Contact.objects.all().delete()
+
+    with requests_mock.Mocker() as m:
+        message.fetch_contact_info_for_recipients()
+
+        assert m.call_count == 0
+
+    assert message.recipients.get().contact.email == "test1@example.com"
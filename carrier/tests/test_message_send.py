@@ -1,7 +1,11 @@
+import uuid
+
 import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from carrier.enums import MessageStatus, RecipientStatus
-from carrier.models import MessageSendResult
+from carrier.models import Contact, MessageSendResult, Recipient
 from carrier.transports import TransportBase
 
 
@@ -19,6 +23,25 @@ class SuccessTransport(TransportBase):
         }
 
 
+class ContactTransport(TransportBase):
+    def __init__(self):
+        self.sent_to = []
+
+    def is_valid(self):
+        return True
+
+    def is_suitable_for_recipient(self, recipient):
+        return bool(recipient.get_email())
+
+    def send(self, message, recipients):
+        self.sent_to.extend((recipient.get_email(), recipient.get_language()) for recipient in recipients)
+
+        return {
+            "success": True,
+            "errors": [],
+        }
+
+
 class FailTransport(TransportBase):
     def is_valid(self):
         return True
@@ -77,3 +100,31 @@ def test_success(settings, message_factory, recipient_factory, content_factory):
     assert isinstance(result, MessageSendResult)
     assert result.has_errors() is False
     assert result.sent is True
+
+
+@pytest.mark.django_db
+def test_send_query_count(settings, message_factory, content_factory):
+    settings.CARRIER_RECIPIENT_CHUNK_SIZE = 1000
+
+    message = message_factory(status=MessageStatus.READY_TO_SEND)
+    content_factory(message=message, language="fi", subject="Subject", text="Text")
+
+    contacts = [Contact(id=uuid.uuid4(), email='test{}@example.com'.format(i), language='sv') for i in range(5000)]
+    Contact.objects.bulk_create(contacts)
+
+    recipients = [Recipient(message=message, contact=contact, uuid=contact.id, status=RecipientStatus.READY_TO_SEND)
+                  for contact in contacts]
+    recipients.extend(Recipient(message=message, email='other{}@example.com'.format(i),
+                                status=RecipientStatus.READY_TO_SEND) for i in range(5000))
+    Recipient.objects.bulk_create(recipients)
+
+    transport = ContactTransport()
+
+    with CaptureQueriesContext(connection) as context:
+        result = message.send([transport])
+
+    assert result.has_errors() is False
+    assert len(transport.sent_to) == 10000
+    assert ('test0@example.com', 'sv') in transport.sent_to
+    # Validation and status updates, and loading, claiming and releasing every chunk of 1000 recipients
+    assert len(context.captured_queries) <= 6 + 4 * 10
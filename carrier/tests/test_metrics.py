@@ -0,0 +1,181 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
+
+import pytest
+import requests_mock
+from django.contrib.auth.models import User
+from django.test import Client
+from django.utils import timezone
+
+from carrier.enums import RecipientStatus
+from carrier.http import get_session
+from carrier.metrics import MetricsThreadPoolExecutor, collect_metrics, count_queries, merge_data, stage
+from carrier.models import Message, SendReport
+from carrier.tasks import deliver_recipients, send_message
+
+
+def test_merge_data():
+    data = {'stages': {'send': {'runs': 1, 'seconds': 0.5}}}
+
+    merge_data(data, {'stages': {'send': {'runs': 1, 'seconds': 1}, 'validate': {'runs': 1}}})
+    assert data == {'stages': {'send': {'runs': 2, 'seconds': 1.5}, 'validate': {'runs': 1}}}
+
+    merge_data(data, {'stages': {'send': {'runs': 2}}}, sign=-1)
+    assert data['stages']['send']['runs'] == 0
+
+
+@pytest.mark.django_db
+def test_count_queries():
+    with count_queries() as counter:
+        list(Message.objects.all())
+        Message.objects.count()
+
+    assert counter.count == 2
+
+    with count_queries() as outer_counter:
+        with count_queries() as counter:
+            Message.objects.count()
+        Message.objects.count()
+
+    assert counter.count == 1
+    assert outer_counter.count == 2
+
+
+@pytest.mark.django_db
+def test_stages_are_recorded_only_when_collecting():
+    with stage('validate_recipients', recipients=3) as counts:
+        Message.objects.count()
+    assert counts == {'recipients': 3}
+
+    with collect_metrics() as metrics:
+        for _ in range(2):
+            with stage('validate_recipients', recipients=3):
+                Message.objects.count()
+
+        with stage('send', recipients=2, transport_path='carrier.transports.MailGunTransport') as counts:
+            counts['errors'] = 1
+
+    data = metrics.get_data()
+    assert data['stages']['validate_recipients']['runs'] == 2
+    assert data['stages']['validate_recipients']['queries'] == 2
+    assert data['stages']['validate_recipients']['recipients'] == 6
+    assert data['stages']['validate_recipients']['seconds'] >= 0
+    assert data['transports']['carrier.transports.MailGunTransport']['errors'] == 1
+
+
+def test_request_latencies_are_collected():
+    with collect_metrics() as metrics:
+        with requests_mock.Mocker() as m:
+            m.get('https://example.com/', json={})
+            get_session('latency_test').get('https://example.com/')
+
+    histogram = metrics.get_data()['requests']['latency_test']
+    assert histogram['count'] == 1
+    assert histogram['buckets']['0.05'] == 1
+    assert histogram['buckets']['30'] == 1
+
+
+def test_request_latencies_are_collected_per_send():
+    def send(request_count):
+        with collect_metrics() as metrics:
+            # The requests are made in the threads of the transport
+            with MetricsThreadPoolExecutor(max_workers=2) as executor:
+                list(executor.map(get_session('latency_test').get, ['https://example.com/'] * request_count))
+
+        return metrics.get_data()['requests']['latency_test']['count']
+
+    with requests_mock.Mocker() as m:
+        m.get('https://example.com/', json={})
+
+        with collect_metrics() as metrics:
+            # Another send of the same process runs meanwhile
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                assert executor.submit(send, 3).result() == 3
+
+            with MetricsThreadPoolExecutor(max_workers=2) as executor:
+                list(executor.map(get_session('latency_test').get, ['https://example.com/'] * 2))
+
+        # Requests made outside collect_metrics are not recorded
+        get_session('latency_test').get('https://example.com/')
+
+    assert metrics.get_data()['requests']['latency_test']['count'] == 2
+
+
+@pytest.mark.django_db
+def test_send_report(settings, celery_eager, message_factory, recipient_factory, content_factory):
+    settings.CARRIER_TRANSPORT_CLASSES = ['carrier.tests.test_tasks.EmailTransport']
+
+    message = message_factory()
+    content_factory(message=message, language='fi')
+    recipient_factory(message=message, email='test@example.com')
+    recipient_factory(message=message, email='fail@example.com')
+
+    send_message(message.id)
+
+    data = SendReport.get_message_data(message.id)
+    assert set(data['stages']) == {'fetch_contact_info', 'attach_contacts', 'validate_recipients'}
+    assert data['transports']['carrier.tests.test_tasks.EmailTransport'] == {
+        'runs': 1,
+        'seconds': mock.ANY,
+        'queries': mock.ANY,
+        'recipients': 2,
+        'errors': 1,
+        'retries': 0,
+    }
+
+    # Every task adds a report of its own
+    reports_count = message.send_reports.count()
+    recipient = message.recipients.get(email='test@example.com')
+    recipient.status = RecipientStatus.READY_TO_SEND
+    recipient.save()
+    deliver_recipients(str(message.id), 'carrier.tests.test_tasks.EmailTransport', [recipient.id])
+
+    assert message.send_reports.count() == reports_count + 1
+    data = SendReport.get_message_data(message.id)
+    assert data['transports']['carrier.tests.test_tasks.EmailTransport']['recipients'] == 3
+
+
+@pytest.mark.django_db
+def test_metrics_view(message_factory, recipient_factory):
+    message = message_factory()
+    recipient_factory(message=message, status=RecipientStatus.SENT)
+    recipient_factory(message=message, status=RecipientStatus.SENT)
+
+    old_message = message_factory()
+    Message.objects.filter(pk=old_message.pk).update(created_at=timezone.now() - timedelta(days=2))
+
+    for _ in range(2):
+        SendReport.add(message.id, {
+            'stages': {'validate_recipients': {'runs': 1, 'seconds': 0.5, 'queries': 3, 'recipients': 0}},
+            'transports': {'carrier.transports.MailGunTransport': {'runs': 1, 'recipients': 10, 'errors': 0}},
+            'requests': {'mailgun': {'buckets': {'0.05': 0, '0.1': 1}, 'count': 1, 'sum': 0.08}},
+        })
+    # Settled reports are added to the totals
+    SendReport.objects.update(created_at=timezone.now() - timedelta(hours=1))
+
+    # A report too recent to have settled is left for a later scrape
+    SendReport.add(message.id, {'stages': {'validate_recipients': {'runs': 1}}})
+
+    assert Client().get('/metrics').status_code in (401, 403)
+
+    client = Client()
+    client.force_login(User.objects.create(username='admin', is_staff=True))
+
+    for _ in range(2):
+        # Scraping again doesn't add the same reports twice
+        response = client.get('/metrics')
+
+        assert response.status_code == 200
+        assert response['Content-Type'].startswith('text/plain; version=0.0.4')
+
+        lines = response.content.decode().splitlines()
+        assert 'carrier_stage_runs_total{stage="validate_recipients"} 2' in lines
+        assert 'carrier_stage_queries_total{stage="validate_recipients"} 6' in lines
+        assert ('carrier_stage_recipients_total{stage="send",transport="carrier.transports.MailGunTransport"} 20'
+                in lines)
+        assert 'carrier_provider_request_duration_seconds_bucket{client="mailgun",le="0.1"} 2' in lines
+        assert 'carrier_provider_request_duration_seconds_bucket{client="mailgun",le="+Inf"} 2' in lines
+        assert 'carrier_provider_request_duration_seconds_count{client="mailgun"} 2' in lines
+        assert 'carrier_recipients{status="sent"} 2' in lines
+        assert 'carrier_messages{status="pending_info"} 1' in lines
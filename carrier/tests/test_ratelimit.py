@@ -0,0 +1,99 @@
+from datetime import timedelta
+from unittest import mock
+
+import pytest
+
+from carrier.models import RateLimitBucket
+from carrier.ratelimit import RateLimiter, get_rate_limiter
+from carrier.transports import PushbulletTransport
+
+
+@pytest.mark.django_db
+def test_rate_limiter_allows_bursts_up_to_capacity():
+    limiter = RateLimiter('test', rate=1, capacity=3)
+
+    assert [limiter.try_acquire() for _ in range(3)] == [0, 0, 0]
+    assert limiter.try_acquire() > 0
+
+
+@pytest.mark.django_db
+def test_rate_limiter_refills_tokens():
+    limiter = RateLimiter('test', rate=2, capacity=2)
+    limiter.try_acquire(2)
+
+    # Pretend that a second has passed since the tokens were taken
+    bucket = RateLimitBucket.objects.get(key='test')
+    RateLimitBucket.objects.filter(key='test').update(updated_at=bucket.updated_at - timedelta(seconds=1))
+
+    assert limiter.try_acquire(2) == 0
+    assert limiter.try_acquire(1) == pytest.approx(0.5, abs=0.1)
+
+
+@pytest.mark.django_db
+def test_rate_limiter_acquire_waits():
+    limiter = RateLimiter('test', rate=10, capacity=1)
+
+    with mock.patch('carrier.ratelimit.time.sleep') as sleep:
+        limiter.acquire(1)
+        assert not sleep.called
+
+        # Refill the bucket when sleeping so the loop can continue
+        sleep.side_effect = lambda seconds: RateLimitBucket.objects.update(tokens=1)
+        limiter.acquire(1)
+        assert sleep.call_count == 1
+        assert sleep.call_args[0][0] == pytest.approx(0.1, abs=0.01)
+
+
+def test_get_rate_limiter(settings):
+    settings.CARRIER_RATE_LIMITS = {'carrier.transports.MailGunTransport': {'rate': 10}}
+
+    limiter = get_rate_limiter('carrier.transports.MailGunTransport')
+    assert limiter.rate == 10
+    assert limiter.capacity == 10
+    assert limiter.batch_size == 1
+
+    assert get_rate_limiter('carrier.transports.PushbulletTransport') is None
+
+
+@pytest.mark.django_db
+def test_rate_limiter_takes_tokens_in_batches():
+    limiter = RateLimiter('test', rate=1, capacity=10, batch_size=4)
+
+    with mock.patch.object(limiter, 'try_acquire', wraps=limiter.try_acquire) as try_acquire:
+        for _ in range(5):
+            limiter.acquire()
+
+    assert try_acquire.call_count == 2
+    assert RateLimitBucket.objects.get(key='test').tokens == pytest.approx(2, abs=0.1)
+
+
+@pytest.mark.django_db
+def test_rate_limiter_drops_expired_reserve():
+    limiter = RateLimiter('test', rate=1, capacity=10, batch_size=4)
+
+    with mock.patch('carrier.ratelimit.time.monotonic', return_value=1000):
+        limiter.acquire()
+
+    # The three reserved tokens would have been earned again by now
+    with mock.patch('carrier.ratelimit.time.monotonic', return_value=1004):
+        limiter.acquire()
+
+    assert limiter.reserved == 3
+    assert RateLimitBucket.objects.get(key='test').tokens == pytest.approx(2, abs=0.1)
+
+
+@pytest.mark.django_db
+def test_transport_acquires_rate_limit_in_batches(settings, message_factory, recipient_factory):
+    settings.CARRIER_RATE_LIMITS = {
+        'carrier.transports.PushbulletTransport': {'rate': 100, 'capacity': 100, 'batch_size': 10}}
+    message = message_factory()
+    message.contents.create(language='fi', subject='Subject', text='Text')
+    recipients = [recipient_factory(message=message) for _ in range(3)]
+
+    transport = PushbulletTransport()
+    with mock.patch.object(transport, 'send_to_recipient'):
+        transport.send(message, recipients)
+
+    bucket = RateLimitBucket.objects.get(key='carrier.transports.PushbulletTransport')
+    assert bucket.tokens == pytest.approx(90, abs=1)
+    assert transport.rate_limiter.reserved == 7
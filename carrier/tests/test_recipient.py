@@ -1,6 +1,8 @@
 import uuid
 
 import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils.crypto import get_random_string
 
 from carrier.enums import RecipientStatus
@@ -91,3 +93,38 @@ def test_contact_attach_on_save(message_factory, contact_factory):
     recipient = Recipient.objects.create(message=message, uuid=contact.id)
 
     assert recipient.contact == contact
+
+
+@pytest.mark.django_db
+def test_bulk_create_with_contacts(message_factory, contact_factory):
+    message = message_factory()
+    contact = contact_factory(id=uuid.uuid4())
+
+    recipients = [
+        Recipient(message=message, uuid=contact.id),
+        Recipient(message=message, uuid=uuid.uuid4()),
+        Recipient(message=message, email='test@example.com'),
+    ]
+
+    with CaptureQueriesContext(connection) as context:
+        Recipient.bulk_create_with_contacts(recipients)
+
+    assert len(context.captured_queries) == 2
+    assert Recipient.objects.get(uuid=contact.id).contact == contact
+    assert Recipient.objects.filter(contact__isnull=True).count() == 2
+
+
+@pytest.mark.django_db
+def test_bulk_create_with_contacts_batch_size(message_factory, contact_factory):
+    message = message_factory()
+    contact = contact_factory(id=uuid.uuid4())
+
+    recipients = [Recipient(message=message, uuid=contact.id)] + [
+        Recipient(message=message, email='test{}@example.com'.format(i)) for i in range(4)]
+
+    with CaptureQueriesContext(connection) as context:
+        Recipient.bulk_create_with_contacts(recipients, batch_size=2)
+
+    # One contact lookup and the recipients inserted two at a time
+    assert len(context.captured_queries) == 4
+    assert Recipient.objects.count() == 5
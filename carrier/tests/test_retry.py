@@ -0,0 +1,59 @@
+from unittest import mock
+
+import pytest
+import requests
+import requests_mock
+
+from carrier.retry import RetryPolicy, get_retry_after, is_retryable
+
+
+def get_exception(status_code, headers=None):
+    with requests_mock.Mocker() as m:
+        m.get('https://example.com/', status_code=status_code, headers=headers or {})
+        response = requests.get('https://example.com/')
+
+    try:
+        response.raise_for_status()
+    except requests.HTTPError as e:
+        return e
+
+
+@pytest.mark.parametrize('status_code, retryable', [
+    (400, False),
+    (401, False),
+    (404, False),
+    (429, True),
+    (500, True),
+    (503, True),
+])
+def test_is_retryable_status(status_code, retryable):
+    assert is_retryable(get_exception(status_code)) is retryable
+
+
+def test_is_retryable_connection_errors():
+    assert is_retryable(requests.ConnectionError())
+    assert is_retryable(requests.ReadTimeout())
+    assert not is_retryable(requests.RequestException())
+
+
+def test_get_retry_after():
+    assert get_retry_after(get_exception(503)) is None
+    assert get_retry_after(get_exception(503, {'Retry-After': '120'})) == 120
+    assert get_retry_after(get_exception(503, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})) == 0
+    assert get_retry_after(get_exception(503, {'Retry-After': 'invalid'})) is None
+    assert get_retry_after(requests.ConnectionError()) is None
+
+
+def test_retry_policy_delay():
+    policy = RetryPolicy(max_retries=3, backoff=2, max_backoff=10)
+
+    with mock.patch('carrier.retry.random.uniform', side_effect=lambda low, high: high):
+        assert [policy.get_delay(retries) for retries in range(5)] == [2, 4, 8, 10, 10]
+
+    with mock.patch('carrier.retry.random.uniform', side_effect=lambda low, high: low):
+        assert policy.get_delay(0) == 0
+        assert policy.get_delay(0, retry_after=5) == 5
+        assert policy.get_delay(0, retry_after=60) == 10
+
+    assert policy.should_retry(2)
+    assert not policy.should_retry(3)
@@ -0,0 +1,544 @@
+import uuid
+from datetime import timedelta
+from unittest import mock
+
+import pytest
+import requests_mock
+from django.db.models import Q
+from django.utils import timezone
+
+from carrier.enums import MessagePriority, MessageStatus, RecipientStatus
+from carrier.models import DeliveryChunk, Message
+from carrier.tasks import (
+    deliver_recipients, dispatch_scheduled_messages, prepare_message, queue_message, recover_messages, send_message)
+from carrier.transports import TransportBase
+from messaging import celery_app
+
+
+class EmailTransport(TransportBase):
+    sent_chunks = []
+    # Number of times sending to retry@example.com fails with a retryable error
+    temporary_failures = 0
+
+    def is_valid(self):
+        return True
+
+    def is_suitable_for_recipient(self, recipient):
+        return bool(recipient.get_email())
+
+    def send(self, message, recipients):
+        self.sent_chunks.append(sorted(recipient.id for recipient in recipients))
+
+        retry_recipient_ids = []
+        for recipient in recipients:
+            if recipient.email == 'retry@example.com' and EmailTransport.temporary_failures:
+                EmailTransport.temporary_failures -= 1
+                retry_recipient_ids.append(recipient.id)
+                continue
+
+            recipient.status = RecipientStatus.SENT
+            recipient.save()
+
+        errors = ['Error'] if any(recipient.email == 'fail@example.com' for recipient in recipients) else []
+
+        return {
+            "success": not errors and not retry_recipient_ids,
+            "errors": errors,
+            "retry_recipient_ids": retry_recipient_ids,
+            "retry_errors": ['Temporary error'] * len(retry_recipient_ids),
+            "retry_after": None,
+        }
+
+
+@pytest.fixture
+def email_transport(settings):
+    settings.CARRIER_TRANSPORT_CLASSES = ['carrier.tests.test_tasks.EmailTransport']
+    EmailTransport.sent_chunks = []
+    EmailTransport.temporary_failures = 0
+
+
+@pytest.mark.django_db
+def test_send_message_fans_out_chunks(settings, celery_eager, email_transport, message_factory, recipient_factory,
+                                      content_factory):
+    settings.CARRIER_DELIVERY_CHUNK_SIZE = 2
+
+    message = message_factory()
+    content_factory(message=message, language='fi')
+    recipients = [recipient_factory(message=message, email='test{}@example.com'.format(i)) for i in range(5)]
+    ignored_recipient = recipient_factory(message=message, phone='+358401234567')
+
+    send_message(message.id)
+
+    assert EmailTransport.sent_chunks == [
+        [recipients[0].id, recipients[1].id],
+        [recipients[2].id, recipients[3].id],
+        [recipients[4].id],
+    ]
+
+    message.refresh_from_db()
+    assert message.status == MessageStatus.SENT
+    assert message.sent_at is not None
+    assert message.recipients.filter(status=RecipientStatus.SENT).count() == 5
+    assert message.recipients.get(pk=ignored_recipient.id).status == RecipientStatus.IGNORED
+
+    assert message.delivery_chunks.count() == 3
+    assert not message.delivery_chunks.filter(Q(started_at__isnull=True) | Q(finished_at__isnull=True)).exists()
+
+
+@pytest.mark.django_db
+def test_send_message_chunk_errors(settings, celery_eager, email_transport, message_factory, recipient_factory,
+                                   content_factory):
+    settings.CARRIER_DELIVERY_CHUNK_SIZE = 2
+
+    message = message_factory()
+    content_factory(message=message, language='fi')
+    for email in ['test1@example.com', 'test2@example.com', 'fail@example.com']:
+        recipient_factory(message=message, email=email)
+
+    send_message(message.id)
+
+    message.refresh_from_db()
+    assert len(EmailTransport.sent_chunks) == 2
+    assert message.status == MessageStatus.ERROR
+
+
+@pytest.mark.django_db
+def test_send_message_without_recipients(celery_eager, email_transport, message_factory, content_factory):
+    message = message_factory()
+    content_factory(message=message, language='fi')
+
+    send_message(message.id)
+
+    message.refresh_from_db()
+    assert message.status == MessageStatus.ERROR
+    assert EmailTransport.sent_chunks == []
+
+
+@pytest.mark.django_db
+def test_send_to_recipients_skips_claimed_and_sent(email_transport, message_factory, recipient_factory,
+                                                   content_factory):
+    message = message_factory(status=MessageStatus.SENDING)
+    content_factory(message=message, language='fi')
+    ready = recipient_factory(message=message, email='ready@example.com', status=RecipientStatus.READY_TO_SEND)
+    sent = recipient_factory(message=message, email='sent@example.com', status=RecipientStatus.SENT)
+    claimed = recipient_factory(message=message, email='claimed@example.com', status=RecipientStatus.SENDING,
+                                claim_token=uuid.uuid4(), claimed_at=timezone.now())
+
+    message.send_to_recipients(EmailTransport(), [ready, sent, claimed])
+
+    assert EmailTransport.sent_chunks == [[ready.id]]
+    assert message.recipients.get(pk=claimed.id).status == RecipientStatus.SENDING
+
+
+@pytest.mark.django_db
+def test_recover_messages(settings, email_transport, message_factory, recipient_factory, content_factory):
+    settings.CARRIER_CLAIM_TIMEOUT = 60
+
+    an_hour_ago = timezone.now() - timedelta(hours=1)
+
+    message = message_factory(status=MessageStatus.SENDING, sending_started_at=an_hour_ago)
+    content_factory(message=message, language='fi')
+    sent = recipient_factory(message=message, email='sent@example.com', status=RecipientStatus.SENT,
+                             claim_token=uuid.uuid4(), claimed_at=an_hour_ago)
+    expired = recipient_factory(message=message, email='expired@example.com', status=RecipientStatus.SENDING,
+                                claim_token=uuid.uuid4(), claimed_at=an_hour_ago)
+
+    active_message = message_factory(status=MessageStatus.SENDING, sending_started_at=an_hour_ago)
+    active = recipient_factory(message=active_message, email='active@example.com', status=RecipientStatus.SENDING,
+                               claim_token=uuid.uuid4(), claimed_at=timezone.now())
+
+    finished_message = message_factory(status=MessageStatus.SENDING, sending_started_at=an_hour_ago)
+    recipient_factory(message=finished_message, email='done@example.com', status=RecipientStatus.SENT)
+
+    with mock.patch('carrier.tasks.send_message.apply_async') as send_message_apply_async:
+        recover_messages()
+
+    send_message_apply_async.assert_called_once_with((message.id,))
+
+    message.refresh_from_db()
+    assert message.status == MessageStatus.READY_TO_SEND
+    assert message.recipients.get(pk=expired.id).status == RecipientStatus.READY_TO_SEND
+    assert message.recipients.get(pk=sent.id).status == RecipientStatus.SENT
+
+    active_message.refresh_from_db()
+    assert active_message.status == MessageStatus.SENDING
+    assert active_message.recipients.get(pk=active.id).status == RecipientStatus.SENDING
+
+    finished_message.refresh_from_db()
+    assert finished_message.status == MessageStatus.SENT
+
+
+@pytest.mark.django_db
+def test_recover_messages_waits_for_queued_chunks(settings, email_transport, message_factory, recipient_factory,
+                                                  content_factory):
+    settings.CARRIER_CLAIM_TIMEOUT = 60
+
+    an_hour_ago = timezone.now() - timedelta(hours=1)
+
+    message = message_factory(status=MessageStatus.SENDING, sending_started_at=an_hour_ago)
+    content_factory(message=message, language='fi')
+    recipient_factory(message=message, email='queued@example.com', status=RecipientStatus.READY_TO_SEND)
+
+    # The chunk is waiting in a backlogged queue and has not claimed its recipients yet
+    chunk = DeliveryChunk.objects.create(message=message)
+    DeliveryChunk.objects.create(message=message, started_at=an_hour_ago, finished_at=an_hour_ago)
+
+    with mock.patch('carrier.tasks.send_message.apply_async') as send_message_apply_async:
+        recover_messages()
+
+    assert not send_message_apply_async.called
+    message.refresh_from_db()
+    assert message.status == MessageStatus.SENDING
+
+    # A chunk started long ago and never finished was lost with its worker
+    chunk.started_at = an_hour_ago
+    chunk.save()
+
+    with mock.patch('carrier.tasks.send_message.apply_async') as send_message_apply_async:
+        recover_messages()
+
+    send_message_apply_async.assert_called_once_with((message.id,))
+    message.refresh_from_db()
+    assert message.status == MessageStatus.READY_TO_SEND
+
+
+@pytest.mark.django_db
+def test_deliver_recipients_requeues_chunk_for_retry(email_transport, message_factory, recipient_factory,
+                                                     content_factory):
+    EmailTransport.temporary_failures = 1
+
+    message = message_factory(status=MessageStatus.SENDING)
+    content_factory(message=message, language='fi')
+    retry = recipient_factory(message=message, email='retry@example.com', status=RecipientStatus.READY_TO_SEND)
+    chunk = DeliveryChunk.objects.create(message=message)
+
+    with mock.patch('carrier.tasks.deliver_recipients.retry', side_effect=Exception('retry')) as task_retry:
+        with pytest.raises(Exception):
+            deliver_recipients(str(message.id), 'carrier.tests.test_tasks.EmailTransport', [retry.id],
+                               chunk_id=str(chunk.id))
+
+    assert task_retry.call_args[1]['kwargs']['chunk_id'] == str(chunk.id)
+
+    chunk.refresh_from_db()
+    assert chunk.started_at is None
+    assert chunk.finished_at is None
+
+
+@pytest.mark.django_db
+def test_resend_after_recovery(celery_eager, email_transport, message_factory, recipient_factory, content_factory):
+    message = message_factory(status=MessageStatus.READY_TO_SEND)
+    content_factory(message=message, language='fi')
+    sent = recipient_factory(message=message, email='sent@example.com', status=RecipientStatus.SENT)
+    ready = recipient_factory(message=message, email='ready@example.com', status=RecipientStatus.READY_TO_SEND)
+
+    send_message(message.id)
+
+    assert EmailTransport.sent_chunks == [[ready.id]]
+    assert message.recipients.get(pk=sent.id).status == RecipientStatus.SENT
+
+
+@pytest.mark.django_db
+def test_deliver_recipients_retries_temporary_failures(settings, email_transport, message_factory,
+                                                       recipient_factory, content_factory):
+    settings.CARRIER_RETRY_BACKOFF = 10
+    EmailTransport.temporary_failures = 1
+
+    message = message_factory(status=MessageStatus.SENDING)
+    content_factory(message=message, language='fi')
+    sent = recipient_factory(message=message, email='sent@example.com', status=RecipientStatus.READY_TO_SEND)
+    retry = recipient_factory(message=message, email='retry@example.com', status=RecipientStatus.READY_TO_SEND)
+
+    with mock.patch('carrier.tasks.deliver_recipients.retry', side_effect=Exception('retry')) as task_retry:
+        with pytest.raises(Exception):
+            deliver_recipients(str(message.id), 'carrier.tests.test_tasks.EmailTransport', [sent.id, retry.id])
+
+    assert task_retry.call_args[1]['args'][2] == [retry.id]
+    assert 0 <= task_retry.call_args[1]['countdown'] <= 10
+    assert message.recipients.get(pk=sent.id).status == RecipientStatus.SENT
+    assert message.recipients.get(pk=retry.id).status == RecipientStatus.READY_TO_SEND
+
+
+@pytest.mark.django_db
+def test_deliver_recipients_retries_until_sent(email_transport, message_factory, recipient_factory, content_factory):
+    EmailTransport.temporary_failures = 2
+
+    message = message_factory(status=MessageStatus.SENDING)
+    content_factory(message=message, language='fi')
+    retry = recipient_factory(message=message, email='retry@example.com', status=RecipientStatus.READY_TO_SEND)
+
+    # Eager retries run right away
+    deliver_recipients.apply(args=(str(message.id), 'carrier.tests.test_tasks.EmailTransport', [retry.id]))
+
+    assert EmailTransport.sent_chunks == [[retry.id]] * 3
+    assert message.recipients.get(pk=retry.id).status == RecipientStatus.SENT
+
+
+@pytest.mark.django_db
+def test_deliver_recipients_gives_up_retrying(settings, email_transport, message_factory, recipient_factory,
+                                              content_factory):
+    settings.CARRIER_RETRY_MAX_RETRIES = 2
+    EmailTransport.temporary_failures = 5
+
+    message = message_factory(status=MessageStatus.SENDING)
+    content_factory(message=message, language='fi')
+    retry = recipient_factory(message=message, email='retry@example.com', status=RecipientStatus.READY_TO_SEND)
+
+    result = deliver_recipients.apply(
+        args=(str(message.id), 'carrier.tests.test_tasks.EmailTransport', [retry.id]),
+        kwargs={'errors': ['Earlier error']},
+        retries=2,
+    )
+
+    assert result.get() == {'errors': ['Earlier error', 'Temporary error']}
+    assert message.recipients.get(pk=retry.id).status == RecipientStatus.ERROR
+
+
+@pytest.mark.django_db
+def test_send_message_prepares_scheduled_message(email_transport, message_factory, recipient_factory,
+                                                 content_factory):
+    message = message_factory(send_at=timezone.now() + timedelta(minutes=5))
+    content_factory(message=message, language='fi')
+    recipient = recipient_factory(message=message, email='test@example.com')
+
+    with mock.patch('carrier.tasks.send_message.apply_async') as send_message_apply_async:
+        prepare_message(message.id)
+
+    send_message_apply_async.assert_called_once_with((message.id,), eta=message.send_at)
+    assert EmailTransport.sent_chunks == []
+
+    message.refresh_from_db()
+    assert message.status == MessageStatus.READY_TO_SEND
+    assert message.recipients.get(pk=recipient.id).status == RecipientStatus.READY_TO_SEND
+    # The release is on its way until send_at
+    assert message.claimed_at < message.send_at
+
+
+def test_beat_schedule_tasks_exist(settings):
+    for entry in settings.CELERY_BEAT_SCHEDULE.values():
+        assert entry['task'] in celery_app.tasks
+
+
+@pytest.mark.django_db
+def test_dispatch_scheduled_messages(settings, message_factory):
+    settings.CARRIER_SCHEDULE_PREPARE_AHEAD = 60 * 60
+    settings.CARRIER_SCHEDULE_BATCH_SIZE = 1
+    now = timezone.now()
+
+    due_soon = [message_factory(send_at=now + timedelta(minutes=30)) for i in range(2)]
+    later = message_factory(send_at=now + timedelta(days=1))
+    unscheduled = message_factory()
+    overdue = message_factory(status=MessageStatus.READY_TO_SEND, send_at=now - timedelta(hours=1))
+    prepared_message = message_factory(status=MessageStatus.READY_TO_SEND, send_at=now + timedelta(minutes=30))
+
+    with mock.patch('carrier.tasks.prepare_message.apply_async') as prepare_message_apply_async, \
+            mock.patch('carrier.tasks.send_message.apply_async') as send_message_apply_async:
+        dispatch_scheduled_messages()
+
+    prepared = {call[0][0][0]: call[0][1]['claim_token'] for call in prepare_message_apply_async.call_args_list}
+    assert sorted(prepared) == sorted(message.id for message in due_soon)
+    send_message_apply_async.assert_called_once_with((overdue.id,))
+
+    for message in due_soon:
+        message.refresh_from_db()
+        assert message.status == MessageStatus.FETCHING_INFO
+        assert prepared[message.id] == str(message.claim_token)
+
+    for message in (later, unscheduled):
+        message.refresh_from_db()
+        assert message.status == MessageStatus.PENDING_INFO
+
+    prepared_message.refresh_from_db()
+    assert prepared_message.status == MessageStatus.READY_TO_SEND
+
+
+@pytest.mark.django_db
+def test_dispatch_scheduled_messages_releases_overdue_messages_once(settings, message_factory):
+    settings.CARRIER_CLAIM_TIMEOUT = 30 * 60
+    now = timezone.now()
+
+    # Prepared ahead of send_at, but the release at send_at was lost
+    lost = message_factory(status=MessageStatus.READY_TO_SEND, send_at=now - timedelta(hours=1),
+                           claimed_at=now - timedelta(hours=2))
+    # Queued after send_at and still waiting in the queue
+    queued = message_factory(status=MessageStatus.READY_TO_SEND, send_at=now - timedelta(hours=1),
+                             claimed_at=now - timedelta(minutes=5))
+    # Queued after send_at, but waiting longer than the claim timeout
+    expired = message_factory(status=MessageStatus.READY_TO_SEND, send_at=now - timedelta(hours=2),
+                              claimed_at=now - timedelta(hours=1))
+
+    with mock.patch('carrier.tasks.send_message.apply_async') as send_message_apply_async:
+        dispatch_scheduled_messages()
+        dispatch_scheduled_messages()
+
+    assert sorted(call[0][0][0] for call in send_message_apply_async.call_args_list) == sorted([lost.id, expired.id])
+
+    queued.refresh_from_db()
+    assert queued.claimed_at < now
+
+    for message in (lost, expired):
+        message.refresh_from_db()
+        assert message.claimed_at >= now
+
+
+@pytest.mark.django_db
+def test_dispatch_scheduled_messages_skips_queued_messages(settings, message_factory):
+    settings.CARRIER_SCHEDULE_PREPARE_AHEAD = 60 * 60
+    message = message_factory(send_at=timezone.now() + timedelta(minutes=30))
+
+    with mock.patch('carrier.tasks.prepare_message.apply_async') as prepare_message_apply_async:
+        queue_message(message)
+        dispatch_scheduled_messages()
+
+    assert prepare_message_apply_async.call_count == 1
+
+
+@pytest.mark.django_db
+def test_prepare_message_skips_messages_claimed_elsewhere(email_transport, message_factory, recipient_factory,
+                                                          content_factory):
+    message = message_factory()
+    content_factory(message=message, language='fi')
+    recipient = recipient_factory(message=message, email='test@example.com')
+    claim_token = Message.claim_for_preparation(message.id)
+
+    with mock.patch('carrier.tasks.send_message.apply_async') as send_message_apply_async:
+        # Without the claim token, or with a token that was already taken over, the claim is someone else's
+        prepare_message(message.id)
+        prepare_message(message.id, claim_token=str(uuid.uuid4()))
+
+        assert not send_message_apply_async.called
+        assert message.recipients.get(pk=recipient.id).status == RecipientStatus.PENDING_INFO
+
+        prepare_message(message.id, claim_token=str(claim_token))
+        prepare_message(message.id, claim_token=str(claim_token))
+
+    send_message_apply_async.assert_called_once_with((message.id,))
+
+    message.refresh_from_db()
+    assert message.status == MessageStatus.READY_TO_SEND
+
+
+@pytest.mark.django_db
+def test_claim_for_sending_skips_scheduled_messages(message_factory):
+    due = message_factory(send_at=timezone.now() - timedelta(minutes=1))
+    message_factory(send_at=timezone.now() + timedelta(minutes=1))
+
+    assert Message.claim_for_sending(10) == [due.id]
+
+
+@pytest.mark.django_db
+def test_prepare_message(email_transport, message_factory, recipient_factory, content_factory):
+    message = message_factory()
+    content_factory(message=message, language='fi')
+    recipient = recipient_factory(message=message, email='test@example.com')
+
+    with mock.patch('carrier.tasks.send_message.apply_async') as send_message_apply_async:
+        prepare_message(message.id)
+
+    send_message_apply_async.assert_called_once_with((message.id,))
+    assert EmailTransport.sent_chunks == []
+
+    message.refresh_from_db()
+    assert message.status == MessageStatus.READY_TO_SEND
+    assert message.recipients.get(pk=recipient.id).status == RecipientStatus.READY_TO_SEND
+
+
+@pytest.mark.django_db
+def test_prepare_message_retries_failed_contact_info(settings, email_transport, message_factory, recipient_factory,
+                                                     content_factory):
+    settings.CONTACT_INFO_URL = 'http://example.com/'
+    contact_uuid = uuid.uuid4()
+
+    message = message_factory()
+    content_factory(message=message, language='fi')
+    recipient = recipient_factory(message=message, uuid=contact_uuid)
+
+    with requests_mock.Mocker() as m, \
+            mock.patch('carrier.tasks.send_message.apply_async') as send_message_apply_async:
+        m.get(settings.CONTACT_INFO_URL, [
+            {'status_code': 503},
+            {'json': {str(contact_uuid): {'email': 'test@example.com', 'contact_method': 'email'}}},
+        ])
+
+        # Eager retries run right away
+        prepare_message.apply(args=(message.id,))
+
+        assert m.call_count == 2
+
+    send_message_apply_async.assert_called_once_with((message.id,))
+
+    message.refresh_from_db()
+    assert message.status == MessageStatus.READY_TO_SEND
+    recipient.refresh_from_db()
+    assert recipient.status == RecipientStatus.READY_TO_SEND
+    assert recipient.contact_id == contact_uuid
+
+
+@pytest.mark.django_db
+def test_prepare_message_gives_up_on_failed_contact_info(settings, email_transport, message_factory,
+                                                         recipient_factory, content_factory):
+    settings.CONTACT_INFO_URL = 'http://example.com/'
+    settings.CARRIER_RETRY_MAX_RETRIES = 0
+
+    message = message_factory()
+    content_factory(message=message, language='fi')
+    recipient = recipient_factory(message=message, uuid=uuid.uuid4())
+
+    with requests_mock.Mocker() as m, \
+            mock.patch('carrier.tasks.send_message.apply_async') as send_message_apply_async:
+        m.get(settings.CONTACT_INFO_URL, status_code=503)
+        prepare_message(message.id)
+
+    assert not send_message_apply_async.called
+
+    # The message keeps its claim until recover_messages prepares it again
+    message.refresh_from_db()
+    assert message.status == MessageStatus.FETCHING_INFO
+    assert message.recipients.get(pk=recipient.id).status == RecipientStatus.PENDING_INFO
+
+
+@pytest.mark.django_db
+def test_send_message_prepares_pending_message(email_transport, message_factory, recipient_factory,
+                                               content_factory):
+    message = message_factory()
+    content_factory(message=message, language='fi')
+    recipient_factory(message=message, email='test@example.com')
+
+    with mock.patch('carrier.tasks.prepare_message.apply_async') as prepare_message_apply_async:
+        send_message(message.id)
+
+    prepare_message_apply_async.assert_called_once_with((message.id,))
+    assert EmailTransport.sent_chunks == []
+
+    message.refresh_from_db()
+    assert message.status == MessageStatus.PENDING_INFO
+
+
+@pytest.mark.django_db
+def test_send_message_routes_chunks_by_priority(settings, email_transport, message_factory, recipient_factory,
+                                                content_factory):
+    settings.CARRIER_DELIVERY_CHUNK_SIZE = 1
+    settings.CARRIER_PRIORITY_QUEUES = {'high': 'urgent', 'low': 'bulk'}
+    settings.CARRIER_TASK_PRIORITIES = {'high': 9}
+
+    message = message_factory(status=MessageStatus.READY_TO_SEND, priority=MessagePriority.HIGH)
+    content_factory(message=message, language='fi')
+    for i in range(2):
+        recipient_factory(message=message, email='test{}@example.com'.format(i), status=RecipientStatus.READY_TO_SEND)
+
+    with mock.patch('carrier.tasks.chord') as chord:
+        send_message(message.id)
+
+    deliveries = chord.call_args[0][0]
+    assert len(deliveries) == 2
+    assert all(delivery.options == {'queue': 'urgent', 'priority': 9} for delivery in deliveries)
+    assert chord.return_value.call_args[0][0].options == {'queue': 'urgent', 'priority': 9}
+
+
+@pytest.mark.django_db
+def test_claim_for_sending_by_priority(message_factory):
+    low = message_factory(priority=MessagePriority.LOW)
+    normal = message_factory()
+    high = message_factory(priority=MessagePriority.HIGH)
+
+    assert Message.claim_for_sending(1) == [high.id]
+    assert Message.claim_for_sending(10) == [normal.id, low.id]
@@ -1,6 +1,17 @@
+from unittest import mock
+from urllib.parse import parse_qs
+
 import pytest
+import requests_mock
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
-from carrier.transports import TransportBase, get_transports
+from carrier.enums import RecipientStatus, TransportType
+from carrier.models import Contact
+from carrier.tasks import warm_up_transports
+from carrier.transports import (
+    DummySmsTransport, FirebaseMessagingTransport, MailGunTransport, PushbulletTransport, TransportBase, get_transport,
+    get_transports)
 
 
 class TestTransport(TransportBase):
@@ -51,3 +62,239 @@ def test_get_transports_fail(settings):
 
     with pytest.raises(ImportError):
         get_transports()
+
+
+def test_get_transports_reuses_instances(settings):
+    settings.CARRIER_TRANSPORT_CLASSES = ['carrier.tests.test_transports.TestTransport']
+
+    transports = get_transports()
+    assert get_transports()[0] is transports[0]
+    assert get_transport('carrier.tests.test_transports.TestTransport') is transports[0]
+    assert get_transport('carrier.tests.test_transports.TestTransport2') is None
+
+    # Changed settings build the transports again
+    settings.CARRIER_TRANSPORT_CLASSES = [
+        'carrier.tests.test_transports.TestTransport',
+        'carrier.tests.test_transports.TestTransport2',
+    ]
+    new_transports = get_transports()
+    assert len(new_transports) == 2
+    assert new_transports[0] is not transports[0]
+
+    with mock.patch('carrier.transports.load_transports') as load_transports:
+        warm_up_transports()
+
+    assert load_transports.call_count == 1
+
+
+@pytest.mark.django_db
+def test_dummy_sms_transport_batch_update(settings, message_factory, recipient_factory, content_factory):
+    settings.CARRIER_RECIPIENT_UPDATE_BATCH_SIZE = 10
+
+    message = message_factory()
+    content_factory(message=message, language='fi')
+    for i in range(25):
+        recipient_factory(message=message, phone='+3584000000{:02d}'.format(i), status=RecipientStatus.READY_TO_SEND)
+
+    recipients = list(message.recipients.all())
+
+    with CaptureQueriesContext(connection) as context:
+        result = DummySmsTransport().send(message, recipients)
+
+    assert result['success'] is True
+    update_queries = [q for q in context.captured_queries if q['sql'].startswith('UPDATE')]
+    assert len(update_queries) == 3
+    assert message.recipients.filter(status=RecipientStatus.SENT, transport=TransportType.SMS,
+                                     language='fi').count() == 25
+
+
+@pytest.mark.django_db
+def test_mailgun_transport_batches(settings, message_factory, recipient_factory, content_factory):
+    settings.MAILGUN_DOMAIN = 'example.com'
+    settings.MAILGUN_BATCH_SIZE = 2
+    settings.CARRIER_CONTENT_LANGUAGES = ['fi']
+
+    message = message_factory(from_name='John Doe', from_email='john@example.com')
+    content_factory(message=message, language='fi', subject='Subject', text='Text')
+    for i in range(5):
+        recipient_factory(message=message, email='test{}@example.com'.format(i), status=RecipientStatus.READY_TO_SEND)
+
+    batches = []
+
+    def mailgun_response(request, context):
+        to = parse_qs(request.text)['to']
+        batches.append(to)
+
+        if 'test2@example.com' in to:
+            context.status_code = 400
+
+        return {}
+
+    with requests_mock.Mocker() as m:
+        m.post('https://api.mailgun.net/v3/example.com/messages', json=mailgun_response)
+
+        result = MailGunTransport().send(message, list(message.recipients.order_by('id')))
+
+    assert sorted(len(batch) for batch in batches) == [1, 2, 2]
+    assert result['success'] is False
+    assert len(result['errors']) == 1
+
+    failed_emails = set(message.recipients.filter(status=RecipientStatus.ERROR).values_list('email', flat=True))
+    assert failed_emails == {'test2@example.com', 'test3@example.com'}
+    assert message.recipients.filter(status=RecipientStatus.SENT).count() == 3
+
+
+@pytest.mark.django_db
+def test_pushbullet_transport(settings, message_factory, recipient_factory, contact_factory, content_factory):
+    settings.PUSHBULLET_MAX_CONCURRENT_REQUESTS = 3
+
+    message = message_factory()
+    content_factory(message=message, language='fi', subject='Subject', short_text='Short text')
+    for i in range(6):
+        contact = contact_factory(pushbullet_access_token='token{}'.format(i))
+        recipient_factory(message=message, contact=contact, status=RecipientStatus.READY_TO_SEND)
+
+    def pushbullet_response(request, context):
+        assert request.json() == {'body': 'Short text', 'title': 'Subject', 'type': 'note'}
+
+        if request.headers['Access-Token'] == 'token4':
+            context.status_code = 401
+
+        return {}
+
+    with requests_mock.Mocker() as m:
+        m.post('https://api.pushbullet.com/v2/pushes', json=pushbullet_response)
+
+        result = PushbulletTransport().send(message, list(message.recipients.select_related('contact')))
+
+        assert m.call_count == 6
+
+    assert result['success'] is False
+    assert len(result['errors']) == 1
+    assert message.recipients.get(status=RecipientStatus.ERROR).contact.pushbullet_access_token == 'token4'
+    assert message.recipients.filter(status=RecipientStatus.SENT, transport=TransportType.PUSHBULLET,
+                                     language='fi').count() == 5
+
+
+@pytest.mark.django_db
+def test_mailgun_transport_retryable_errors(settings, message_factory, recipient_factory, content_factory):
+    settings.MAILGUN_BATCH_SIZE = 2
+    settings.CARRIER_CONTENT_LANGUAGES = ['fi']
+
+    message = message_factory(from_name='John Doe', from_email='john@example.com')
+    content_factory(message=message, language='fi', subject='Subject', text='Text')
+    recipients = [
+        recipient_factory(message=message, email='test{}@example.com'.format(i), status=RecipientStatus.SENDING)
+        for i in range(3)
+    ]
+
+    def mailgun_response(request, context):
+        if 'test2@example.com' in parse_qs(request.text)['to']:
+            context.status_code = 429
+            context.headers['Retry-After'] = '30'
+
+        return {}
+
+    with requests_mock.Mocker() as m:
+        m.post('https://api.mailgun.net/v3/example.com/messages', json=mailgun_response)
+
+        result = MailGunTransport().send(message, recipients)
+
+    assert result['success'] is False
+    assert result['errors'] == []
+    assert result['retry_recipient_ids'] == [recipients[2].id]
+    assert len(result['retry_errors']) == 1
+    assert result['retry_after'] == 30
+
+    # Recipients to retry are left for the caller to release
+    assert message.recipients.get(pk=recipients[2].id).status == RecipientStatus.SENDING
+    assert message.recipients.filter(status=RecipientStatus.SENT).count() == 2
+
+
+@pytest.mark.django_db
+def test_firebase_transport(settings, message_factory, recipient_factory, contact_factory, content_factory):
+    settings.FIREBASE_API_KEY = 'key'
+    settings.FIREBASE_BATCH_SIZE = 2
+    settings.CARRIER_CONTENT_LANGUAGES = ['fi']
+
+    message = message_factory()
+    content_factory(message=message, language='fi', subject='Subject', text='Text')
+    tokens = ['sent', 'replaced', 'unregistered', 'unavailable', 'failed_batch']
+    recipients = [
+        recipient_factory(message=message, contact=contact_factory(firebase_token=token),
+                          status=RecipientStatus.SENDING)
+        for token in tokens
+    ]
+
+    token_results = {
+        'sent': {'message_id': '1'},
+        'replaced': {'message_id': '2', 'registration_id': 'new'},
+        'unregistered': {'error': 'NotRegistered'},
+        'unavailable': {'error': 'Unavailable'},
+    }
+    batches = []
+
+    def fcm_response(request, context):
+        # A request to a single device has the token in "to"
+        payload = request.json()
+        registration_ids = payload.get('registration_ids', [payload.get('to')])
+        batches.append(registration_ids)
+
+        if 'failed_batch' in registration_ids:
+            context.status_code = 400
+            return {}
+
+        return {'results': [token_results[token] for token in registration_ids]}
+
+    with requests_mock.Mocker() as m:
+        m.post('https://fcm.googleapis.com/fcm/send', json=fcm_response)
+
+        transport = FirebaseMessagingTransport()
+        result = transport.send(message, recipients)
+
+    assert sorted(len(batch) for batch in batches) == [1, 2, 2]
+    assert len(result['errors']) == 2
+    assert result['retry_recipient_ids'] == [recipients[3].id]
+
+    statuses = dict(message.recipients.values_list('contact__firebase_token', 'status'))
+    assert statuses == {
+        'sent': RecipientStatus.SENT,
+        'new': RecipientStatus.SENT,
+        None: RecipientStatus.ERROR,
+        'unavailable': RecipientStatus.SENDING,
+        'failed_batch': RecipientStatus.ERROR,
+    }
+    assert not Contact.objects.filter(firebase_token__in=['replaced', 'unregistered']).exists()
+
+    # The client is reused by the next sends
+    assert transport.get_push_service() is transport.push_service
+
+
+@pytest.mark.django_db
+def test_firebase_transport_truncated_results(settings, message_factory, recipient_factory, contact_factory,
+                                              content_factory):
+    settings.FIREBASE_API_KEY = 'key'
+    settings.CARRIER_CONTENT_LANGUAGES = ['fi']
+
+    message = message_factory()
+    content_factory(message=message, language='fi', subject='Subject', text='Text')
+    recipients = [
+        recipient_factory(message=message, contact=contact_factory(firebase_token=token),
+                          status=RecipientStatus.SENDING)
+        for token in ['sent', 'malformed', 'missing']
+    ]
+
+    with requests_mock.Mocker() as m:
+        m.post('https://fcm.googleapis.com/fcm/send', json={'results': [{'message_id': '1'}, 'malformed']})
+
+        result = FirebaseMessagingTransport().send(message, recipients)
+
+    assert result['errors'] == []
+    assert sorted(result['retry_recipient_ids']) == sorted([recipients[1].id, recipients[2].id])
+
+    statuses = dict(message.recipients.values_list('contact__firebase_token', 'status'))
+    assert statuses == {
+        'sent': RecipientStatus.SENT,
+        'malformed': RecipientStatus.SENDING,
+        'missing': RecipientStatus.SENDING,
+    }
@@ -0,0 +1,42 @@
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from carrier.enums import RecipientStatus, TransportType
+from carrier.models import Recipient
+from carrier.utils import bulk_update, chunked, get_bulk_create_batch_size
+
+
+def test_chunked():
+    assert list(chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(chunked([], 2)) == []
+
+
+@pytest.mark.django_db
+def test_bulk_update(message_factory, recipient_factory):
+    message = message_factory()
+    recipients = [recipient_factory(message=message) for _ in range(5)]
+
+    for i, recipient in enumerate(recipients):
+        recipient.email = 'test{}@example.com'.format(i)
+        recipient.transport = TransportType.EMAIL
+        recipient.status = RecipientStatus.SENT
+
+    with CaptureQueriesContext(connection) as context:
+        bulk_update(recipients, ['email', 'transport', 'status'], batch_size=2)
+
+    assert len(context.captured_queries) == 3
+
+    for i, recipient in enumerate(Recipient.objects.order_by('id')):
+        assert recipient.email == 'test{}@example.com'.format(i)
+        assert recipient.transport == TransportType.EMAIL
+        assert recipient.status == RecipientStatus.SENT
+
+
+def test_get_bulk_create_batch_size():
+    recipients = [Recipient() for _ in range(10)]
+    max_batch_size = connection.ops.bulk_batch_size(Recipient._meta.concrete_fields, recipients)
+
+    assert get_bulk_create_batch_size(Recipient, recipients, 5) == min(5, max_batch_size)
+    assert get_bulk_create_batch_size(Recipient, recipients, 100000) == max_batch_size
+    assert get_bulk_create_batch_size(Recipient, recipients) == max_batch_size
@@ -1,28 +1,88 @@
 import json
+import os
+import threading
 from collections import defaultdict
+from concurrent.futures import as_completed
 from importlib import import_module
 
-import requests
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.models import Q
+from django.dispatch import receiver
 from pyfcm import FCMNotification
 from requests import RequestException
 
 from carrier.enums import RecipientStatus, TransportType
+from carrier.http import get_session
+from carrier.metrics import MetricsThreadPoolExecutor
+from carrier.models import Contact, RecipientUpdater
+from carrier.ratelimit import get_rate_limiter
+from carrier.retry import RetryableFailures, is_retryable
+from carrier.utils import chunked, get_transport_path
+
+_transports = None
+_transports_pid = None
+_transports_lock = threading.Lock()
 
 
 class TransportBase:
+    # Name of the client in the CARRIER_HTTP_CLIENTS setting whose session get_transports gives the transport
+    http_client_name = None
+
+    def __init__(self, session=None):
+        self.session = session
+
+    def get_session(self):
+        """Return the keep-alive HTTP session of the transport, shared with the other transports of the worker."""
+        if getattr(self, 'session', None) is None:
+            self.session = get_session(self.http_client_name or 'default')
+
+        return self.session
+
     def is_valid(self):
         raise NotImplementedError('Method "valid" must be implemented.')
 
     def is_suitable_for_recipient(self, recipient):
         raise NotImplementedError('Method "is_suitable_for_recipient" must be implemented.')
 
+    def get_recipient_filter(self):
+        """
+        Return a Q object matching the recipients this transport can send to.
+
+        The filter must match the same recipients as is_suitable_for_recipient. Transports returning None
+        are checked with is_suitable_for_recipient one recipient at a time.
+        """
+        return None
+
+    def acquire_rate_limit(self, tokens=1):
+        """
+        Wait until the rate limit of the transport allows making the given number of requests.
+
+        The limits are configured per transport class path in the CARRIER_RATE_LIMITS setting and are shared
+        by all the workers. Transports without a configured limit are not paced.
+        """
+        if not hasattr(self, 'rate_limiter'):
+            self.rate_limiter = get_rate_limiter(get_transport_path(self))
+
+        if self.rate_limiter:
+            self.rate_limiter.acquire(tokens)
+
     def send(self, message, recipients):
+        """
+        Send the message to the recipients and record the result of every recipient.
+
+        Returns a dict with "success" and "errors". Transports may also leave recipients that failed because
+        of a retryable error untouched and return them in "retry_recipient_ids" with their "retry_errors" and
+        an optional "retry_after" in seconds, so they are sent again later.
+        """
         raise NotImplementedError('Method send must be implemented.')
 
 
 class MailGunTransport(TransportBase):
-    def __init__(self):
+    http_client_name = 'mailgun'
+
+    def __init__(self, session=None):
+        super().__init__(session=session)
         self.transport_type = TransportType.EMAIL
 
     def is_valid(self):
@@ -34,60 +94,98 @@ class MailGunTransport(TransportBase):
     def is_suitable_for_recipient(self, recipient):
         return bool(recipient.get_email())
 
+    def get_recipient_filter(self):
+        # Greater than an empty string matches values that are neither NULL nor empty
+        return Q(email__gt='') | Q(contact__email__gt='')
+
+    def get_batch_data(self, message, content, recipients):
+        # Make Mailgun send a separate email to every recipient by using the Recipient Variables functionality.
+        # See http://mailgun-documentation.readthedocs.io/en/latest/user_manual.html#batch-sending
+        recipient_variables = {r.get_email(): {"id": r.id} for r in recipients}
+
+        data = {
+            "from": "{} <{}>".format(message.from_name, message.from_email),
+            "to": [recipient.get_email() for recipient in recipients],
+            "subject": content.subject,
+            "text": content.text,
+            "recipient-variables": json.dumps(recipient_variables),
+        }
+        if content.html:
+            data['html'] = content.html
+
+        return data
+
+    def post_batch(self, session, data):
+        r = session.post(
+            "{}/{}/messages".format(getattr(settings, 'MAILGUN_API_URL', 'https://api.mailgun.net/v3'),
+                                    settings.MAILGUN_DOMAIN),
+            auth=("api", settings.MAILGUN_API_KEY),
+            data=data
+        )
+
+        r.raise_for_status()
+
     def send(self, message, recipients):
         recipients_by_language = defaultdict(list)
         for recipient in recipients:
             recipients_by_language[recipient.get_language()].append(recipient)
 
+        # Mailgun accepts at most 1000 recipients in one batch sending request
+        batch_size = getattr(settings, 'MAILGUN_BATCH_SIZE', 1000)
+        max_workers = getattr(settings, 'MAILGUN_MAX_CONCURRENT_REQUESTS', 4)
+
         errors = []
-        for language, lang_recipients in recipients_by_language.items():
-            content = message.get_content_in_language(language)
+        retryable = RetryableFailures()
+        updater = RecipientUpdater(fields=['transport', 'language', 'email', 'status'])
+
+        session = self.get_session()
+
+        with MetricsThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for language, lang_recipients in recipients_by_language.items():
+                content = message.get_content_in_language(language)
 
-            # Make Mailgun send a separate email to every recipient by using the Recipient Variables functionality.
-            # See http://mailgun-documentation.readthedocs.io/en/latest/user_manual.html#batch-sending
-            recipient_variables = {r.get_email(): {"id": r.id} for r in lang_recipients}
-
-            data = {
-                "from": "{} <{}>".format(message.from_name, message.from_email),
-                "to": [recipient.get_email() for recipient in lang_recipients],
-                "subject": content.subject,
-                "text": content.text,
-                "recipient-variables": json.dumps(recipient_variables),
-            }
-            if content.html:
-                data['html'] = content.html
-
-            message.recipients.filter(id__in=[recipient.id for recipient in lang_recipients]).update(
-                status=RecipientStatus.SENDING)
-
-            try:
-                # TODO: Make requests in 1000 recipient batches
-                r = requests.post(
-                    "https://api.mailgun.net/v3/{}/messages".format(settings.MAILGUN_DOMAIN),
-                    auth=("api", settings.MAILGUN_API_KEY),
-                    data=data
-                )
-
-                r.raise_for_status()
-
-                for recipient in lang_recipients:
+                for batch in chunked(lang_recipients, batch_size):
+                    data = self.get_batch_data(message, content, batch)
+                    self.acquire_rate_limit()
+                    futures[executor.submit(self.post_batch, session, data)] = (language, content, batch)
+
+            # Database writes stay in this thread, only the HTTP requests are made in the pool
+            for future in as_completed(futures):
+                language, content, batch = futures[future]
+
+                try:
+                    future.result()
+                    status = RecipientStatus.SENT
+                except RequestException as e:
+                    error = 'Error when trying to send message "{}", content "{}" to {} recipient(s): "{}"'.format(
+                        message.id, content.id, len(batch), e)
+
+                    if is_retryable(e):
+                        retryable.add(batch, error, e)
+                        continue
+
+                    status = RecipientStatus.ERROR
+                    errors.append(error)
+
+                for recipient in batch:
                     recipient.transport = self.transport_type
                     recipient.language = language
                     recipient.email = recipient.get_email()
-                    recipient.status = RecipientStatus.SENT
-                    recipient.save()
-            except RequestException as e:
-                errors.append('Error when trying to send message "{}", content "{}" to {} recipient(s): "{}"'.format(
-                    message.id, content.id, len(lang_recipients), e))
+                    recipient.status = status
+                    updater.add(recipient)
 
-        return {
-            "success": not bool(errors),
+        updater.flush()
+
+        return dict({
+            "success": not (errors or retryable.errors),
             "errors": errors,
-        }
+        }, **retryable.get_result())
 
 
 class DummySmsTransport(TransportBase):
-    def __init__(self):
+    def __init__(self, session=None):
+        super().__init__(session=session)
         self.transport_type = TransportType.SMS
 
     def is_valid(self):
@@ -96,17 +194,23 @@ class DummySmsTransport(TransportBase):
     def is_suitable_for_recipient(self, recipient):
         return bool(recipient.get_phone())
 
+    def get_recipient_filter(self):
+        return Q(phone__gt='') | Q(contact__phone__gt='')
+
     def send(self, message, recipients):
         print("Send message {} using transport DummySmsTransport to recipients: {}".format(message.id, recipients))
 
         content = message.get_content_in_language(None)
 
+        updater = RecipientUpdater(fields=['transport', 'language', 'phone', 'status'])
         for recipient in recipients:
             recipient.transport = self.transport_type
-            recipient.lang = content.language
+            recipient.language = content.language
             recipient.phone = recipient.get_phone()
             recipient.status = RecipientStatus.SENT
-            recipient.save()
+            updater.add(recipient)
+
+        updater.flush()
 
         return {
             "success": True,
@@ -114,8 +218,76 @@ class DummySmsTransport(TransportBase):
         }
 
 
-class PushbulletTransport(TransportBase):
-    def __init__(self):
+class ConcurrentTransportBase(TransportBase):
+    """
+    Base class for transports making one HTTP request per recipient.
+
+    The requests are made in a pool of threads sharing the keep-alive session of the transport. The size of the
+    pool is read from the setting named by max_concurrent_requests_setting. Subclasses implement
+    send_to_recipient.
+    """
+    max_concurrent_requests_setting = None
+    default_max_concurrent_requests = 10
+
+    def get_max_concurrent_requests(self):
+        if not self.max_concurrent_requests_setting:
+            return self.default_max_concurrent_requests
+
+        return getattr(settings, self.max_concurrent_requests_setting, self.default_max_concurrent_requests)
+
+    def send_to_recipient(self, session, message, recipient, content):
+        raise NotImplementedError('Method send_to_recipient must be implemented.')
+
+    def send(self, message, recipients):
+        session = self.get_session()
+        errors = []
+        retryable = RetryableFailures()
+        updater = RecipientUpdater(fields=['transport', 'language', 'status'])
+
+        with MetricsThreadPoolExecutor(max_workers=self.get_max_concurrent_requests()) as executor:
+            futures = {}
+            for recipient in recipients:
+                content = message.get_content_in_language(recipient.get_language())
+                self.acquire_rate_limit()
+                future = executor.submit(self.send_to_recipient, session, message, recipient, content)
+                futures[future] = (recipient, content)
+
+            # Database writes stay in this thread, only the HTTP requests are made in the pool
+            for future in as_completed(futures):
+                recipient, content = futures[future]
+
+                try:
+                    future.result()
+                    recipient.status = RecipientStatus.SENT
+                except RequestException as e:
+                    error = 'Error when trying to send message "{}", content "{}" to recipient "{}": "{}"'.format(
+                        message.id, content.id, recipient.id, e)
+
+                    if is_retryable(e):
+                        retryable.add([recipient], error, e)
+                        continue
+
+                    recipient.status = RecipientStatus.ERROR
+                    errors.append(error)
+
+                recipient.transport = self.transport_type
+                recipient.language = content.language
+                updater.add(recipient)
+
+        updater.flush()
+
+        return dict({
+            "success": not (errors or retryable.errors),
+            "errors": errors,
+        }, **retryable.get_result())
+
+
+class PushbulletTransport(ConcurrentTransportBase):
+    http_client_name = 'pushbullet'
+    max_concurrent_requests_setting = 'PUSHBULLET_MAX_CONCURRENT_REQUESTS'
+
+    def __init__(self, session=None):
+        super().__init__(session=session)
         self.transport_type = TransportType.PUSHBULLET
 
     def is_valid(self):
@@ -124,43 +296,42 @@ class PushbulletTransport(TransportBase):
     def is_suitable_for_recipient(self, recipient):
         return bool(recipient.get_pushbullet_access_token())
 
-    def send(self, message, recipients):
-        errors = []
-        for recipient in recipients:
-            content = message.get_content_in_language(recipient.get_language())
+    def get_recipient_filter(self):
+        return Q(contact__pushbullet_access_token__gt='')
 
-            text = content.short_text if content.short_text else content.text
+    def send_to_recipient(self, session, message, recipient, content):
+        text = content.short_text if content.short_text else content.text
 
-            try:
-                r = requests.post('https://api.pushbullet.com/v2/pushes', json={
-                    'body': text,
-                    'title': content.subject,
-                    'type': 'note',
-                }, headers={
-                    'Access-Token': recipient.get_pushbullet_access_token(),
-                    'Content-Type': 'application/json'
-                })
+        r = session.post(getattr(settings, 'PUSHBULLET_API_URL', 'https://api.pushbullet.com/v2/pushes'), json={
+            'body': text,
+            'title': content.subject,
+            'type': 'note',
+        }, headers={
+            'Access-Token': recipient.get_pushbullet_access_token(),
+            'Content-Type': 'application/json'
+        })
 
-                r.raise_for_status()
+        r.raise_for_status()
 
-                recipient.transport = self.transport_type
-                recipient.lang = content.language
-                recipient.status = RecipientStatus.SENT
-                recipient.save()
-            except RequestException as e:
-                errors.append(
-                    'Error when trying to send message "{}", content "{}" to {} recipient(s): "{}"'.format(
-                        message.id, content.id, recipients, e))
 
-        return {
-            "success": not bool(errors),
-            "errors": errors,
-        }
+class FirebaseMessagingTransport(TransportBase):
+    """
+    Sends push notifications with FCM multicast requests of at most FIREBASE_BATCH_SIZE registration ids.
 
+    The requests are made concurrently over the keep-alive session of the transport. Tokens FCM reports
+    as invalid or unregistered are removed from the contacts and tokens it has replaced are updated.
+    """
+    # Per-token errors meaning the token will never work again
+    invalid_token_errors = ('InvalidRegistration', 'NotRegistered', 'MissingRegistration')
+    # Per-token errors meaning FCM could not handle the token right now
+    retryable_token_errors = ('Unavailable', 'InternalServerError')
 
-class FirebaseMessagingTransport(TransportBase):
-    def __init__(self):
+    http_client_name = 'firebase'
+
+    def __init__(self, session=None):
+        super().__init__(session=session)
         self.transport_type = TransportType.FIREBASE
+        self.push_service = None
 
     def is_valid(self):
         if getattr(settings, 'FIREBASE_API_KEY', None):
@@ -171,40 +342,145 @@ class FirebaseMessagingTransport(TransportBase):
     def is_suitable_for_recipient(self, recipient):
         return bool(recipient.get_firebase_token())
 
-    def send(self, message, recipients):
+    def get_recipient_filter(self):
+        return Q(contact__firebase_token__gt='')
+
+    def get_push_service(self):
+        if self.push_service is None:
+            self.push_service = FCMNotification(api_key=settings.FIREBASE_API_KEY)
+
+        return self.push_service
+
+    def post_batch(self, session, payload):
+        push_service = self.get_push_service()
+
+        url = getattr(settings, 'FIREBASE_API_URL', push_service.FCM_END_POINT)
+
+        r = session.post(url, headers=push_service.request_headers(), data=payload)
+        r.raise_for_status()
+
+        # FCM returns one result per registration id in the order of the request
+        results = r.json()['results']
+        if not isinstance(results, list):
+            raise ValueError('Unexpected FCM results: {!r}'.format(results))
+
+        return results
+
+    def update_tokens(self, token_updates):
+        """Update the tokens of the contacts with the new tokens or clear them when the new token is None."""
+        invalid_tokens = [token for token, new_token in token_updates.items() if new_token is None]
+        for tokens in chunked(invalid_tokens, 500):
+            Contact.objects.filter(firebase_token__in=tokens).update(firebase_token=None)
+
+        for token, new_token in token_updates.items():
+            if new_token is not None:
+                Contact.objects.filter(firebase_token=token).update(firebase_token=new_token)
+
+    def record_result(self, message, recipient, result, errors, retryable, token_updates):
+        """Set the status of the recipient from its FCM result. Returns False if the recipient is retried."""
+        token = recipient.get_firebase_token()
+
+        if not isinstance(result, dict):
+            # A truncated or malformed response doesn't tell whether the notification was sent
+            retryable.add([recipient], 'Error when trying to send message "{}" to recipient "{}": "{}"'.format(
+                message.id, recipient.id, 'No result in the FCM response'), None)
+            return False
+
+        if result.get('error'):
+            error = 'Error when trying to send message "{}" to recipient "{}": "{}"'.format(
+                message.id, recipient.id, result['error'])
+
+            if result['error'] in self.retryable_token_errors:
+                retryable.add([recipient], error, None)
+                return False
+
+            if result['error'] in self.invalid_token_errors:
+                token_updates[token] = None
+
+            recipient.status = RecipientStatus.ERROR
+            errors.append(error)
+            return True
+
+        recipient.status = RecipientStatus.SENT
+
+        # FCM tells the new token of the device when the token has been replaced
+        if result.get('registration_id'):
+            token_updates[token] = result['registration_id']
+
+        return True
+
+    def submit_batches(self, executor, session, message, recipients, batch_size):
         recipients_by_language = defaultdict(list)
         for recipient in recipients:
             recipients_by_language[recipient.get_language()].append(recipient)
 
-        push_service = FCMNotification(api_key=settings.FIREBASE_API_KEY)
+        push_service = self.get_push_service()
 
-        errors = []
+        futures = {}
         for language, lang_recipients in recipients_by_language.items():
             content = message.get_content_in_language(language)
 
-            message.recipients.filter(id__in=[recipient.id for recipient in lang_recipients]).update(
-                status=RecipientStatus.SENDING)
+            for batch in chunked(lang_recipients, batch_size):
+                payload = push_service.parse_payload(
+                    registration_ids=[r.get_firebase_token() for r in batch],
+                    message_title=content.subject, message_body=content.text)
+                self.acquire_rate_limit()
+                futures[executor.submit(self.post_batch, session, payload)] = (language, content, batch)
 
-            registration_ids = [r.get_firebase_token() for r in lang_recipients]
+        return futures
 
-            result = push_service.notify_multiple_devices(
-                registration_ids=registration_ids, message_title=content.subject, message_body=content.text)
+    def send(self, message, recipients):
+        # FCM accepts at most 1000 registration ids in one multicast request
+        batch_size = getattr(settings, 'FIREBASE_BATCH_SIZE', FCMNotification.FCM_MAX_RECIPIENTS)
+        max_workers = getattr(settings, 'FIREBASE_MAX_CONCURRENT_REQUESTS', 4)
+        session = self.get_session()
 
-            # TODO: check result
+        errors = []
+        retryable = RetryableFailures()
+        token_updates = {}
+        updater = RecipientUpdater(fields=['transport', 'language', 'status'])
 
-            for recipient in lang_recipients:
-                recipient.transport = self.transport_type
-                recipient.language = language
-                recipient.status = RecipientStatus.SENT
-                recipient.save()
+        with MetricsThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = self.submit_batches(executor, session, message, recipients, batch_size)
 
-        return {
-            "success": not bool(errors),
+            # Database writes stay in this thread, only the HTTP requests are made in the pool
+            for future in as_completed(futures):
+                language, content, batch = futures[future]
+
+                try:
+                    results = future.result()
+                except (RequestException, ValueError, KeyError) as e:
+                    error = 'Error when trying to send message "{}", content "{}" to {} recipient(s): "{}"'.format(
+                        message.id, content.id, len(batch), e)
+
+                    if isinstance(e, RequestException) and is_retryable(e):
+                        retryable.add(batch, error, e)
+                        continue
+
+                    errors.append(error)
+                    results = None
+
+                for i, recipient in enumerate(batch):
+                    if results is None:
+                        recipient.status = RecipientStatus.ERROR
+                    elif not self.record_result(message, recipient, results[i] if i < len(results) else None,
+                                                errors, retryable, token_updates):
+                        continue
+
+                    recipient.transport = self.transport_type
+                    recipient.language = language
+                    updater.add(recipient)
+
+        updater.flush()
+        self.update_tokens(token_updates)
+
+        return dict({
+            "success": not (errors or retryable.errors),
             "errors": errors,
-        }
+        }, **retryable.get_result())
 
 
-def get_transports():
+def load_transports():
     transports = []
     for transport_class_string in settings.CARRIER_TRANSPORT_CLASSES:
         try:
@@ -213,7 +489,11 @@ def get_transports():
             module_name = import_module(module_path)
 
             transport_class = getattr(module_name, class_name)
-            transport_instance = transport_class()
+
+            if getattr(transport_class, 'http_client_name', None):
+                transport_instance = transport_class(session=get_session(transport_class.http_client_name))
+            else:
+                transport_instance = transport_class()
 
             if transport_instance.is_valid():
                 transports.append(transport_instance)
@@ -223,3 +503,42 @@ def get_transports():
             raise ImportError(msg)
 
     return transports
+
+
+def get_transports():
+    """
+    Return the valid transports of the CARRIER_TRANSPORT_CLASSES setting.
+
+    The transports are built once per process and the same instances are returned until the settings change,
+    so their sessions and clients stay open between messages.
+    """
+    global _transports, _transports_pid
+
+    with _transports_lock:
+        if _transports is None or _transports_pid != os.getpid():
+            _transports = load_transports()
+            _transports_pid = os.getpid()
+
+        return list(_transports)
+
+
+def get_transport(transport_path):
+    """Return the transport whose class path is transport_path, or None if it is not available."""
+    for transport in get_transports():
+        if get_transport_path(transport) == transport_path:
+            return transport
+
+    return None
+
+
+def reset_transports():
+    global _transports
+
+    with _transports_lock:
+        _transports = None
+
+
+@receiver(setting_changed)
+def reset_transports_on_setting_change(**kwargs):
+    # The transports are configured with many settings, so any change may change them
+    reset_transports()
@@ -0,0 +1,125 @@
+from itertools import islice
+
+from django.db import connections
+from django.db.models import Case, Value, When
+
+
+def get_transport_path(transport):
+    return '{}.{}'.format(transport.__class__.__module__, transport.__class__.__name__)
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+
+        yield chunk
+
+
+def queryset_chunks(queryset, chunk_size):
+    """
+    Yield the objects of the queryset in lists of chunk_size objects ordered by primary key.
+
+    Every chunk is fetched with its own query filtered by the last seen primary key, so the memory
+    use stays flat regardless of the size of the queryset.
+    """
+    queryset = queryset.order_by('pk')
+    last_pk = None
+
+    while True:
+        chunk_queryset = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        chunk = list(chunk_queryset[:chunk_size])
+
+        if chunk:
+            yield chunk
+
+        if len(chunk) < chunk_size:
+            return
+
+        last_pk = chunk[-1].pk
+
+
+def get_bulk_create_batch_size(model, objs, batch_size=None):
+    """
+    Return batch_size capped to the number of objects the database accepts in one INSERT query.
+
+    Django 1.11 uses an explicit bulk_create batch_size as is, which fails e.g. on SQLite with large batches.
+    """
+    max_batch_size = max(connections[model._default_manager.db].ops.bulk_batch_size(
+        model._meta.concrete_fields, objs), 1)
+
+    return min(batch_size, max_batch_size) if batch_size else max_batch_size
+
+
+def bulk_update(objs, fields, batch_size=None):
+    """
+    Update the given fields of the model instances with one UPDATE query per batch.
+
+    Backport of QuerySet.bulk_update from Django 2.2.
+    """
+    objs = list(objs)
+
+    if not objs or not fields:
+        return
+
+    model = objs[0]._meta.model
+    manager = model._default_manager
+    model_fields = [model._meta.get_field(field_name) for field_name in fields]
+
+    # Every field needs a primary key and a value parameter per object
+    max_batch_size = connections[manager.db].ops.bulk_batch_size(['pk', 'pk'] * len(model_fields), objs)
+    batch_size = min(batch_size, max_batch_size) if batch_size else max_batch_size
+
+    for batch in chunked(objs, max(batch_size, 1)):
+        update_kwargs = {}
+        for field in model_fields:
+            values = [getattr(obj, field.attname) for obj in batch]
+
+            if all(value == values[0] for value in values):
+                # Skip the CASE expression when the whole batch gets the same value
+                update_kwargs[field.attname] = Value(values[0], output_field=field)
+                continue
+
+            update_kwargs[field.attname] = Case(*[
+                When(pk=obj.pk, then=Value(value, output_field=field)) for obj, value in zip(batch, values)
+            ], output_field=field)
+
+        manager.filter(pk__in=[obj.pk for obj in batch]).update(**update_kwargs)
+
+
+def bulk_upsert(objs, fields, batch_size=None):
+    """
+    Insert the model instances, updating the given fields of the rows that already have their primary keys.
+
+    Uses INSERT ... ON CONFLICT DO UPDATE, which needs PostgreSQL 9.5 or newer.
+    """
+    objs = list(objs)
+
+    if not objs:
+        return
+
+    model = objs[0]._meta.model
+    connection = connections[model._default_manager.db]
+    quote_name = connection.ops.quote_name
+    model_fields = [model._meta.pk] + [model._meta.get_field(field_name) for field_name in fields]
+
+    max_batch_size = connection.ops.bulk_batch_size(model_fields, objs)
+    batch_size = min(batch_size, max_batch_size) if batch_size else max_batch_size
+
+    row_sql = '({})'.format(', '.join(['%s'] * len(model_fields)))
+    sql = 'INSERT INTO {} ({}) VALUES {{}} ON CONFLICT ({}) DO UPDATE SET {}'.format(
+        quote_name(model._meta.db_table),
+        ', '.join(quote_name(field.column) for field in model_fields),
+        quote_name(model._meta.pk.column),
+        ', '.join('{0} = EXCLUDED.{0}'.format(quote_name(field.column)) for field in model_fields[1:]),
+    )
+
+    with connection.cursor() as cursor:
+        for batch in chunked(objs, max(batch_size, 1)):
+            cursor.execute(sql.format(', '.join([row_sql] * len(batch))), [
+                field.get_db_prep_save(getattr(obj, field.attname), connection)
+                for obj in batch for field in model_fields
+            ])
@@ -1,12 +1,29 @@
 import random
 import string
 import uuid
+from datetime import timedelta
 
+from django.conf import settings
+from django.db.models import Count
+from django.http import HttpResponse
+from django.utils import timezone
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.exceptions import ValidationError
-from rest_framework.permissions import AllowAny
+from rest_framework.permissions import AllowAny, IsAdminUser
 from rest_framework.response import Response
 
+from carrier.metrics import LATENCY_BUCKETS
+from carrier.models import Message, Recipient, SendReportTotal
+
+STAGE_COUNTERS = (
+    ('runs', 'carrier_stage_runs_total', 'Number of times a stage of sending messages has run.'),
+    ('seconds', 'carrier_stage_seconds_total', 'Seconds spent in a stage of sending messages.'),
+    ('queries', 'carrier_stage_queries_total', 'Database queries made in a stage of sending messages.'),
+    ('recipients', 'carrier_stage_recipients_total', 'Recipients handled in a stage of sending messages.'),
+    ('errors', 'carrier_stage_errors_total', 'Errors reported by the transports.'),
+    ('retries', 'carrier_stage_retries_total', 'Recipients left for retrying by the transports.'),
+)
+
 
 @api_view(['GET'], exclude_from_schema=True)
 @permission_classes([AllowAny])
@@ -36,3 +53,56 @@ def get_contact_info(request):
         }
 
     return Response(contact_info)
+
+
+def format_labels(**labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in sorted(labels.items())) + '}'
+
+
+def get_metrics_lines():
+    data = SendReportTotal.update()
+
+    stages = [(format_labels(stage=name), values) for name, values in sorted(data.get('stages', {}).items())]
+    stages.extend((format_labels(stage='send', transport=path), values)
+                  for path, values in sorted(data.get('transports', {}).items()))
+
+    for key, name, help_text in STAGE_COUNTERS:
+        yield '# HELP {} {}'.format(name, help_text)
+        yield '# TYPE {} counter'.format(name)
+        for labels, values in stages:
+            if key in values:
+                yield '{}{} {}'.format(name, labels, values[key])
+
+    name = 'carrier_provider_request_duration_seconds'
+    yield '# HELP {} Latency of the requests made to the providers.'.format(name)
+    yield '# TYPE {} histogram'.format(name)
+    for client, histogram in sorted(data.get('requests', {}).items()):
+        for bound in LATENCY_BUCKETS:
+            yield '{}_bucket{} {}'.format(
+                name, format_labels(client=client, le=bound), histogram['buckets'].get(str(bound), 0))
+        yield '{}_bucket{} {}'.format(name, format_labels(client=client, le='+Inf'), histogram['count'])
+        yield '{}_sum{} {}'.format(name, format_labels(client=client), histogram['sum'])
+        yield '{}_count{} {}'.format(name, format_labels(client=client), histogram['count'])
+
+    created_since = timezone.now() - timedelta(seconds=getattr(settings, 'CARRIER_METRICS_WINDOW', 24 * 60 * 60))
+    gauges = (
+        (Message.objects.filter(created_at__gte=created_since), 'carrier_messages'),
+        (Recipient.objects.filter(message__created_at__gte=created_since), 'carrier_recipients'),
+    )
+    for queryset, name in gauges:
+        yield '# HELP {} Number of {} of the recently created messages by status.'.format(
+            name, queryset.model._meta.verbose_name_plural)
+        yield '# TYPE {} gauge'.format(name)
+        for row in queryset.order_by().values('status').annotate(count=Count('pk')).order_by('status'):
+            yield '{}{} {}'.format(name, format_labels(status=row['status'].value), row['count'])
+
+
+@api_view(['GET'], exclude_from_schema=True)
+@permission_classes([IsAdminUser])
+def metrics(request):
+    """Metrics of sending messages in the Prometheus text format, summed from the send reports of the messages."""
+    return HttpResponse(''.join(line + '\n' for line in get_metrics_lines()),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
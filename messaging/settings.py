@@ -129,7 +129,43 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': ['rest_framework.permissions.DjangoModelPermissions', ],
 }
 
+# The results of the delivery tasks are collected by a chord, which needs a result backend
+CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
+
+# Periodic tasks run by celery beat. dispatch_scheduled_messages queues the messages scheduled with send_at when
+# they are due within CARRIER_SCHEDULE_PREPARE_AHEAD seconds, so it must run more often than that. recover_messages
+# sends again the messages whose preparation or delivery stalled after CARRIER_CLAIM_TIMEOUT seconds.
+CELERY_BEAT_SCHEDULE = {
+    'dispatch-scheduled-messages': {
+        'task': 'carrier.tasks.dispatch_scheduled_messages',
+        'schedule': 60,
+    },
+    'recover-messages': {
+        'task': 'carrier.tasks.recover_messages',
+        'schedule': 5 * 60,
+    },
+}
+
+# Preparing messages (prepare_message) and sending them (send_message, deliver_recipients and finish_message)
+# can be routed to queues of their own and scaled with separate workers, for example:
+# {'carrier.tasks.prepare_message': {'queue': 'prepare'}, 'carrier.tasks.deliver_recipients': {'queue': 'send'}}
+CELERY_TASK_ROUTES = {}
+
+# The tasks of a message, including its delivery chunks, are routed by the priority of the message. Priorities
+# are mapped to queues, e.g. {'high': 'urgent', 'low': 'bulk'}, served by workers of their own, and to broker
+# message priorities for brokers that support them. The queues override CELERY_TASK_ROUTES.
+CARRIER_PRIORITY_QUEUES = {}
+CARRIER_TASK_PRIORITIES = {}
+
 CONTACT_INFO_URL = 'http://example.com/'
+# Contact info is requested for CONTACT_INFO_PAGE_SIZE uuids per request
+CONTACT_INFO_PAGE_SIZE = 100
+CONTACT_INFO_MAX_CONCURRENT_REQUESTS = 4
+CONTACT_INFO_TIMEOUT = 30
+# Seconds fetched contact info is used before it is fetched again. None keeps it forever.
+CONTACT_INFO_TTL = 24 * 60 * 60
+# Name of a cache in CACHES used to share fetched contact info between processes. None disables caching.
+CONTACT_INFO_CACHE = None
 
 CARRIER_CONTENT_LANGUAGES = ['fi', 'sv', 'en']
 
@@ -140,10 +176,75 @@ CARRIER_TRANSPORT_CLASSES = [
     'carrier.transports.DummySmsTransport',
 ]
 
+# Number of nested recipients and contents inserted in one query when a message is created
+CARRIER_BULK_CREATE_BATCH_SIZE = 1000
+
+# Number of recipients loaded from the database and handed to the transports at a time
+CARRIER_RECIPIENT_CHUNK_SIZE = 5000
+
+# Number of recipients sent by one delivery task
+CARRIER_DELIVERY_CHUNK_SIZE = 1000
+
+# Seconds after which recipients claimed by a delivery worker that never finished are sent again
+CARRIER_CLAIM_TIMEOUT = 30 * 60
+
+# Scheduled messages are prepared up to CARRIER_SCHEDULE_PREPARE_AHEAD seconds before send_at and delivered
+# at send_at. dispatch_scheduled_messages claims CARRIER_SCHEDULE_BATCH_SIZE messages at a time and releases
+# prepared messages still waiting CARRIER_SCHEDULE_RELEASE_DELAY seconds after send_at.
+CARRIER_SCHEDULE_PREPARE_AHEAD = 15 * 60
+CARRIER_SCHEDULE_BATCH_SIZE = 100
+CARRIER_SCHEDULE_RELEASE_DELAY = 60
+
+# Number of recipients written to the database in one UPDATE query
+CARRIER_RECIPIENT_UPDATE_BATCH_SIZE = 1000
+
+# Seconds a send report waits before it is added to the totals served at /metrics, so that reports of
+# transactions still open during a scrape aren't skipped
+CARRIER_METRICS_DELAY = 60
+# Seconds for which messages are counted by status at /metrics after they are created
+CARRIER_METRICS_WINDOW = 24 * 60 * 60
+
+# Keep-alive HTTP sessions shared by the transports and the contact info client of a worker process. The
+# "default" client configures the clients not listed. See carrier.http.HTTP_CLIENT_DEFAULTS for the options.
+CARRIER_HTTP_CLIENTS = {
+    'default': {'pool_maxsize': 10, 'timeout': 30},
+    'contact_info': {
+        'pool_maxsize': 4,
+        'retries': 3,
+        'retry_backoff_factor': 0.5,
+        'retry_statuses': (500, 502, 503, 504),
+    },
+    'mailgun': {'pool_maxsize': 4},
+    'pushbullet': {'pool_maxsize': 10},
+    'firebase': {'pool_maxsize': 4},
+}
+
+# Provider request rate limits shared by all workers, keyed by transport class path. Rate is requests per
+# second and capacity the size of allowed bursts. A worker takes batch_size requests at a time from the shared
+# limit, by default a tenth of the capacity. For example:
+# {'carrier.transports.PushbulletTransport': {'rate': 5, 'capacity': 20, 'batch_size': 5}}
+CARRIER_RATE_LIMITS = {}
+
+# Retries of recipients a provider failed to send to because of a temporary error. The delay before a retry
+# is random up to CARRIER_RETRY_BACKOFF * 2 ** retries seconds and at most CARRIER_RETRY_MAX_BACKOFF seconds.
+CARRIER_RETRY_MAX_RETRIES = 5
+CARRIER_RETRY_BACKOFF = 2
+CARRIER_RETRY_MAX_BACKOFF = 10 * 60
+
+# The provider URLs can be changed e.g. to run the benchmarks against local stand-ins
+MAILGUN_API_URL = 'https://api.mailgun.net/v3'
 MAILGUN_DOMAIN = 'example.com'
 MAILGUN_API_KEY = 'key-12345123451234512345123451234512'
+MAILGUN_BATCH_SIZE = 1000
+MAILGUN_MAX_CONCURRENT_REQUESTS = 4
+
+PUSHBULLET_API_URL = 'https://api.pushbullet.com/v2/pushes'
+PUSHBULLET_MAX_CONCURRENT_REQUESTS = 10
 
+FIREBASE_API_URL = 'https://fcm.googleapis.com/fcm/send'
 FIREBASE_API_KEY = ''
+FIREBASE_BATCH_SIZE = 1000
+FIREBASE_MAX_CONCURRENT_REQUESTS = 4
 
 TUNNISTAMO_USERNAME = ''
 TUNNISTAMO_PASSWORD = ''